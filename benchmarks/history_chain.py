@@ -0,0 +1,103 @@
+"""
+Benchmark of the operations of a large migration history.
+
+Builds linear histories of synthetic migration nodes (no files) and measures:
+- build: linking the nodes and building the chain (MigrationHistory.from_nodes).
+- memory: the memory allocated by the nodes and the history.
+- validate: checking the history for bifurcations.
+- last: 1000 calls to get_last_version.
+- slice: 1000 calls to get_migrations for the last 10 migrations.
+- print: printing the whole history (to /dev/null).
+
+Usage:
+```
+python benchmarks/history_chain.py [sizes...]
+```
+"""
+
+import contextlib
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from mongo_migrator.migration_history import (  # noqa: E402
+    MigrationHistory,
+    MigrationNode,
+)
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+CALLS = 1000
+
+
+def generate_nodes(size: int) -> list:
+    """
+    Generate the nodes of a linear history.
+    Args:
+        size: The number of migrations to generate.
+    Returns:
+        The migration nodes.
+    """
+    nodes = []
+    last_version = None
+    for i in range(size):
+        version = f"{20250101000000000000 + i}"
+        nodes.append(MigrationNode(f"Migration {i}", version, last_version))
+        last_version = version
+    return nodes
+
+
+def _timed(function) -> float:
+    """Private function to measure the seconds a function takes."""
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def benchmark(size: int) -> tuple:
+    """
+    Measure the operations of a history of the given size.
+    Args:
+        size: The number of migrations.
+    Returns:
+        The times of build, validate, last, slice and print, and the memory in MB.
+    """
+    tracemalloc.start()
+    nodes = generate_nodes(size)
+    start = time.perf_counter()
+    history = MigrationHistory.from_nodes(nodes)
+    build = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+    tracemalloc.stop()
+
+    validate = _timed(history.validate)
+    last = _timed(lambda: [history.get_last_version() for _ in range(CALLS)])
+    start_version = nodes[-10].version
+    sliced = _timed(
+        lambda: [history.get_migrations(start_version) for _ in range(CALLS)]
+    )
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        printed = _timed(lambda: history.print_history(nodes[size // 2].version))
+
+    return build, validate, last, sliced, printed, memory
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    print(
+        f"{'migrations':>10} {'build (s)':>10} {'validate (s)':>13} "
+        f"{'last x' + str(CALLS) + ' (s)':>16} {'slice x' + str(CALLS) + ' (s)':>17} "
+        f"{'print (s)':>10} {'memory (MB)':>12}"
+    )
+    for size in sizes:
+        build, validate, last, sliced, printed, memory = benchmark(size)
+        print(
+            f"{size:>10} {build:>10.4f} {validate:>13.4f} {last:>16.4f} "
+            f"{sliced:>17.4f} {printed:>10.4f} {memory:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark of the time needed to load the migration history.
+
+Generates linear histories of increasing size in a temporary directory and
+measures how long MigrationHistory takes to load them:
+- headers: parsing the header of every file (cold manifest cache).
+- manifest: loading with a warm manifest cache (one stat per file).
+- imports: also importing every migration module (the behaviour before lazy imports).
+
+Usage:
+```
+python benchmarks/history_load.py [sizes...]
+```
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from mongo_migrator.migration_history import MigrationHistory  # noqa: E402
+from mongo_migrator.migration_template import MigrationTemplate  # noqa: E402
+
+DEFAULT_SIZES = [100, 500, 1000, 2000, 5000]
+
+
+def generate_migrations(migrations_dir: str, size: int):
+    """
+    Generate a linear history of migration files.
+    Args:
+        migrations_dir: The directory where the migrations are written.
+        size: The number of migrations to generate.
+    """
+    last_version = None
+    for i in range(size):
+        version = f"{20250101000000000000 + i}"
+        file_path = os.path.join(migrations_dir, f"{version}_migration_{i}.py")
+        MigrationTemplate.create_migration_file(
+            file_path, f"Migration {i}", version, last_version
+        )
+        last_version = version
+
+
+def benchmark(size: int) -> tuple:
+    """
+    Measure the load time of a history of the given size.
+    Args:
+        size: The number of migrations.
+    Returns:
+        The load times parsing the headers, using the manifest and importing every module.
+    """
+    with tempfile.TemporaryDirectory() as migrations_dir:
+        generate_migrations(migrations_dir, size)
+
+        start = time.perf_counter()
+        MigrationHistory(migrations_dir)
+        header_only = time.perf_counter() - start
+
+        start = time.perf_counter()
+        MigrationHistory(migrations_dir)
+        with_manifest = time.perf_counter() - start
+
+        start = time.perf_counter()
+        history = MigrationHistory(migrations_dir, use_manifest=False)
+        for node in history.migrations.values():
+            node._load_module()
+        with_imports = time.perf_counter() - start
+
+    return header_only, with_manifest, with_imports
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    print(
+        f"{'migrations':>10} {'headers (s)':>12} {'manifest (s)':>13} {'imports (s)':>12}"
+    )
+    for size in sizes:
+        header_only, with_manifest, with_imports = benchmark(size)
+        print(
+            f"{size:>10} {header_only:>12.4f} {with_manifest:>13.4f} {with_imports:>12.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+This module handles precompiled bundles of the migration history.
+
+A bundle is a single file with the header and the compiled code of every
+migration. The migration history can be loaded from it with one sequential read,
+without walking, reading or importing the migrations directory.
+
+Bundles are tied to the Python version that built them. A bundle is outdated
+when the migrations directory (if it is deployed too) lists other migration files
+than the bundled ones, or one of them changed (its modification time or size, as
+in the manifest), so new or edited migrations are never shadowed by an old bundle.
+
+load_history and load_valid_history load the migration history from the bundle
+when it is current, or from the migrations directory, for every entry point (the
+commands and the Migrator).
+"""
+
+import contextlib
+import importlib.util
+import marshal
+import os
+import struct
+
+from typing import BinaryIO, Optional
+
+from mongo_migrator import declarative
+from mongo_migrator.migration_history import (
+    EmptyHistoryError,
+    InvalidHistoryError,
+    MigrationHistory,
+    MigrationNode,
+    is_migration_file,
+)
+
+BUNDLE_MAGIC = b"MMBUNDLE"
+FORMAT_VERSION = 3
+METADATA_SIZE = struct.Struct("<I")
+
+
+def create_bundle(migrations_dir: str, bundle_path: str) -> int:
+    """
+    Compile the migrations of a directory into a bundle file.
+    Args:
+        migrations_dir: The directory where the migrations are stored.
+        bundle_path: The path of the bundle file to write.
+    Raises:
+        FileNotFoundError: If a migration file is not found.
+        ValueError: If a migration file format or the migration history is invalid.
+        SyntaxError: If a migration file cannot be compiled.
+    Returns:
+        The number of bundled migrations.
+    """
+    history = MigrationHistory(migrations_dir)
+    if history.is_empty() or not history.validate():
+        raise ValueError("Invalid migration history.")
+
+    entries = []
+    files = {}
+    for node in history.get_migrations():
+        # Before reading it, so a file changed meanwhile outdates the bundle
+        stat = os.stat(node.file_path)
+        files[os.path.basename(node.file_path)] = (stat.st_mtime_ns, stat.st_size)
+        if declarative.is_declarative(node.file_path):
+            source = declarative.to_source(node.file_path)
+        else:
+            with open(node.file_path, "r") as f:
+                source = f.read()
+        code = compile(source, node.file_path, "exec")
+        entries.append(
+            (
+                node.title,
+                node.version,
+                node.last_version,
+                node.file_path,
+                marshal.dumps(code),
+            )
+        )
+
+    # The metadata goes first so it can be read without the migrations
+    metadata = marshal.dumps(
+        (FORMAT_VERSION, history.get_last_version(), len(entries), files)
+    )
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(importlib.util.MAGIC_NUMBER)
+        f.write(METADATA_SIZE.pack(len(metadata)))
+        f.write(metadata)
+        marshal.dump(entries, f)
+    os.replace(tmp_path, bundle_path)
+
+    return len(entries)
+
+
+def rebuild_bundle(migrations_dir: str, bundle_path: str) -> int:
+    """
+    Rebuild a bundle (see create_bundle), e.g. after a migration is created.
+    If it cannot be rebuilt, the outdated bundle is removed, so it is not loaded.
+    Args:
+        migrations_dir: The directory where the migrations are stored.
+        bundle_path: The path of the bundle file.
+    Raises:
+        Exception: The error of create_bundle, once the bundle is removed.
+    Returns:
+        The number of bundled migrations.
+    """
+    try:
+        return create_bundle(migrations_dir, bundle_path)
+    except Exception:
+        # The error of the removal would hide the one of the bundling
+        with contextlib.suppress(OSError):
+            os.remove(bundle_path)
+        raise
+
+
+def _read_metadata(f: BinaryIO, bundle_path: str) -> tuple:
+    """
+    Private function to read and check the metadata at the start of a bundle.
+    Args:
+        f: The bundle file, opened in binary mode.
+        bundle_path: The path of the bundle file.
+    Raises:
+        ValueError: If the file is not a bundle or was built by another Python version.
+    Returns:
+        The format version, the last version, the number of migrations and the
+        (modification time, size) of each bundled migration file by name.
+    """
+    if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+        raise ValueError(f"Invalid migration bundle {bundle_path}.")
+    python_magic = importlib.util.MAGIC_NUMBER
+    if f.read(len(python_magic)) != python_magic:
+        raise ValueError(
+            f"Migration bundle {bundle_path} was built with another Python version."
+        )
+
+    (size,) = METADATA_SIZE.unpack(f.read(METADATA_SIZE.size))
+    metadata = marshal.loads(f.read(size))
+    if metadata[0] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported migration bundle format on {bundle_path}.")
+    return metadata
+
+
+def get_bundle_last_version(bundle_path: str) -> str:
+    """
+    Get the last version of a bundle without loading its migrations.
+    Args:
+        bundle_path: The path of the bundle file.
+    Raises:
+        FileNotFoundError: If the bundle file is not found.
+        ValueError: If the file is not a bundle or was built by another Python version.
+    Returns:
+        The last version of the bundled migration history.
+    """
+    with open(bundle_path, "rb") as f:
+        _, last_version, _, _ = _read_metadata(f, bundle_path)
+    return last_version
+
+
+def is_bundle_current(bundle_path: str, migrations_dir: str) -> bool:
+    """
+    Check if a bundle still covers the migrations directory, without loading its
+    migrations. The file names are compared, and the modification time and size of
+    each file (as in the manifest). A bundle is also current when there is no
+    migrations directory or it has no migrations (e.g. when only the bundle is
+    deployed).
+    Args:
+        bundle_path: The path of the bundle file.
+        migrations_dir: The directory where the migrations are stored.
+    Raises:
+        FileNotFoundError: If the bundle file is not found.
+        ValueError: If the file is not a bundle or was built by another Python version.
+    Returns:
+        True if the bundle has the unchanged migration files of the directory, False
+        otherwise.
+    """
+    try:
+        file_names = {f for f in os.listdir(migrations_dir) if is_migration_file(f)}
+    except FileNotFoundError:
+        return True
+    if not file_names:
+        return True
+    with open(bundle_path, "rb") as f:
+        _, _, _, bundled_files = _read_metadata(f, bundle_path)
+    if file_names != set(bundled_files):
+        return False
+    for file_name in file_names:
+        stat = os.stat(os.path.join(migrations_dir, file_name))
+        if (stat.st_mtime_ns, stat.st_size) != bundled_files[file_name]:
+            return False
+    return True
+
+
+def load_bundle(bundle_path: str) -> MigrationHistory:
+    """
+    Load the migration history from a bundle file.
+    The code of each migration is only unmarshalled when the migration is run.
+    Args:
+        bundle_path: The path of the bundle file.
+    Raises:
+        FileNotFoundError: If the bundle file is not found.
+        ValueError: If the file is not a bundle or was built by another Python version.
+    Returns:
+        The migration history.
+    """
+    with open(bundle_path, "rb") as f:
+        _read_metadata(f, bundle_path)
+        entries = marshal.load(f)
+
+    nodes = [
+        MigrationNode(title, version, last_version, file_path=file_path, code=code)
+        for title, version, last_version, file_path, code in entries
+    ]
+    return MigrationHistory.from_nodes(nodes)
+
+
+def uses_bundle(bundle_path: Optional[str], migrations_dir: str) -> bool:
+    """
+    Check if the migration history is loaded from a bundle: it is built and has
+    the migration files of the migrations directory (see is_bundle_current).
+    Args:
+        bundle_path: The path of the bundle file. None if no bundle is configured.
+        migrations_dir: The directory where the migrations are stored.
+    Returns:
+        True if the history is loaded from the bundle, False otherwise.
+    """
+    if not bundle_path or not os.path.exists(bundle_path):
+        return False
+    try:
+        return is_bundle_current(bundle_path, migrations_dir)
+    except (OSError, ValueError):
+        # The error is reported when the bundle is loaded
+        return True
+
+
+def load_history(migrations_dir: str, bundle_path: str = None) -> MigrationHistory:
+    """
+    Load the migration history from the bundle if it is built and current.
+    Otherwise, load it from the migrations directory.
+    Args:
+        migrations_dir: The directory where the migrations are stored.
+        bundle_path: The path of the bundle file. None if no bundle is configured.
+    Raises:
+        FileNotFoundError: If a migration or the bundle file is not found.
+        ValueError: If a migration file format or the bundle is invalid.
+    Returns:
+        The migration history.
+    """
+    if uses_bundle(bundle_path, migrations_dir):
+        return load_bundle(bundle_path)
+    if bundle_path and os.path.exists(bundle_path):
+        print(
+            "[!] The migrations bundle is outdated, loading the migrations directory."
+        )
+        print("[!] Run 'mongo-migrator bundle' to rebuild it.")
+    return MigrationHistory(migrations_dir)
+
+
+def load_valid_history(
+    migrations_dir: str, bundle_path: str = None
+) -> MigrationHistory:
+    """
+    Load the migration history (see load_history) and check that it is linear.
+    Args:
+        migrations_dir: The directory where the migrations are stored.
+        bundle_path: The path of the bundle file. None if no bundle is configured.
+    Raises:
+        FileNotFoundError: If a migration or the bundle file is not found.
+        EmptyHistoryError: If there are no migrations.
+        InvalidHistoryError: If the history is not a linear tree.
+        ValueError: If a migration file format or the bundle is invalid.
+    Returns:
+        The migration history.
+    """
+    history = load_history(migrations_dir, bundle_path)
+    if history.is_empty():
+        raise EmptyHistoryError("No migrations found.")
+    if not history.validate():
+        raise InvalidHistoryError("Migration history is not valid.")
+    return history
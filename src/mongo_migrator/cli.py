@@ -3,12 +3,29 @@ Command line interface for the mongo migrator
 """
 
 import argparse
+import functools
 import os
 import sys
+import time
 
 from datetime import datetime
-
-from mongo_migrator import __version__
+from typing import List, Optional
+
+from pymongo.database import Database
+
+from mongo_migrator import (
+    __version__,
+    instrumentation,
+    isolation,
+    ledger,
+    multi_database,
+    ops,
+    planner,
+    preflight as preflight_checks,
+    profiling,
+    progress,
+    work_queue,
+)
 from mongo_migrator.config import Config
 from mongo_migrator.db_utils import (
     get_db,
@@ -17,8 +34,267 @@ from mongo_migrator.db_utils import (
     set_current_version,
 )
 
+from mongo_migrator.bundle import (
+    create_bundle,
+    get_bundle_last_version,
+    load_history,
+    load_valid_history,
+    rebuild_bundle,
+    uses_bundle,
+)
+from mongo_migrator.manifest import Manifest
 from mongo_migrator.migration_template import MigrationTemplate
-from mongo_migrator.migration_history import MigrationHistory
+from mongo_migrator.migration_history import (
+    EmptyHistoryError,
+    InvalidHistoryError,
+    MigrationHistory,
+    MigrationNode,
+    is_migration_file,
+)
+
+
+def _connect(config: Config, db_name: str = None) -> Database:
+    """
+    Get the database connection with the configured connection details.
+    Every database of the same cluster shares the pooled client.
+    Args:
+        config: The configuration.
+        db_name: The database. The configured one by default.
+    Raises:
+        Exception: If the connection cannot be established.
+    """
+    return get_db(
+        config.db_host,
+        config.db_port,
+        db_name or config.db_name,
+        config.db_user,
+        config.db_password,
+        uri=config.db_uri,
+        driver_options=config.driver_options,
+    )
+
+
+def _has_bundle(config: Config) -> bool:
+    """Whether the configured bundle is built."""
+    return bool(config.migrations_bundle) and os.path.exists(config.migrations_bundle)
+
+
+def _uses_bundle(config: Config) -> bool:
+    """Whether the migration history is loaded from the configured bundle."""
+    return uses_bundle(config.migrations_bundle, config.migrations_dir)
+
+
+def _get_cached_last_version(config: Config) -> str:
+    """
+    Get the last version of the migration history without loading it.
+    It is read from the bundle if it is built and has the migration files of the
+    directory, or from the manifest of the migrations directory if it still lists
+    the same unchanged files.
+    Returns:
+        The last version, or None if it is not known.
+    """
+    try:
+        if _uses_bundle(config):
+            return get_bundle_last_version(config.migrations_bundle)
+        file_names = [
+            f for f in os.listdir(config.migrations_dir) if is_migration_file(f)
+        ]
+        manifest = Manifest(config.migrations_dir)
+        return manifest.last_version if manifest.is_current(file_names) else None
+    except (OSError, ValueError):
+        return None
+
+
+def _load_history(config: Config) -> MigrationHistory:
+    """
+    Load the migration history from the configured bundle if it is built and
+    current, or from the migrations directory (see bundle.load_history).
+    """
+    return load_history(config.migrations_dir, config.migrations_bundle)
+
+
+def _get_profile_options(args) -> dict:
+    """
+    Get the options of profiling.profile from the arguments of a command.
+    """
+    if not args:
+        return {"cpu": False, "memory": False}
+    return {
+        "directory": args.profile_dir or profiling.DEFAULT_DIRECTORY,
+        "cpu": bool(args.profile),
+        "memory": bool(args.profile_memory),
+    }
+
+
+def _run_migration(
+    db: Database,
+    migration_ledger: ledger.Ledger,
+    migration,
+    direction: str,
+    reporter: progress.ProgressReporter = None,
+    profile_options: dict = None,
+    isolate: bool = False,
+):
+    """
+    Run the upgrade or downgrade of a migration and record it in the ledger,
+    with the commands it sent. The migration reports its progress to the reporter
+    through its context, and is profiled with the given options of
+    profiling.profile (if any).
+    If isolate is set, the migration runs in a new process (see
+    isolation.run_in_subprocess).
+    Raises:
+        Exception: If the migration fails. The failure is recorded too.
+    """
+    results = ops.track_results()
+    started_at = ledger.now()
+    error = commands = None
+    try:
+        with instrumentation.collect() as commands:
+            if isolate:
+                isolation.run_in_subprocess(
+                    db, migration, direction, commands, reporter, profile_options
+                )
+            else:
+                isolation.execute_migration(
+                    db, migration, direction, reporter, profile_options
+                )
+    except Exception as err:
+        error = f"{type(err).__name__}: {err}"
+        raise
+    finally:
+        ops.stop_tracking()
+        if commands and (commands.round_trips or commands.batch_sizes):
+            print(commands.format_report())
+        try:
+            migration_ledger.record(
+                migration,
+                direction,
+                started_at,
+                ledger.now(),
+                results,
+                error,
+                commands.to_dict() if commands else None,
+            )
+        except Exception as err:
+            print(f"[!] Error recording the migration in the ledger: {err}")
+
+
+def _load_valid_history(config: Config) -> Optional[MigrationHistory]:
+    """
+    Load the migration history and check that it is linear
+    (see bundle.load_valid_history).
+    Returns:
+        The migration history, or None if it cannot be loaded or is not valid.
+    """
+    try:
+        return load_valid_history(config.migrations_dir, config.migrations_bundle)
+    except EmptyHistoryError:
+        print("[F] No migrations found.")
+        print("[F] Run 'mongo-migrator create <title>' to create a new migration.")
+    except InvalidHistoryError:
+        print("[F] Migration history is not valid.")
+        print("[F] Please fix the migration files before upgrading the database.")
+    except Exception as err:
+        print(f"[F] Error loading the migration history: {err}")
+    return None
+
+
+def _get_pending_upgrades(
+    config: Config, current_version: str, to_version: str = None
+) -> Optional[List[MigrationNode]]:
+    """
+    Load the migration history and get the migrations an upgrade has to run.
+    Args:
+        config: The configuration.
+        current_version: The current version of the database.
+        to_version: The last version to apply. The latest one if None.
+    Returns:
+        The migrations to run, or None if they cannot be determined.
+    """
+    migration_history = _load_valid_history(config)
+    if migration_history is None:
+        return None
+
+    print(f"[+] Current version: {current_version}")
+
+    # Retrieve the migrations to run
+    # These migrations start with the first one found (if no current_version is set)
+    # and end with the specified version (if requested) or the latest one found.
+    migrations = migration_history.get_migrations(current_version, to_version)
+    # Avoid upgrading the current version since it is already up to date
+    to_upgrade = [mig for mig in migrations if mig.version != current_version]
+
+    if to_version:
+        # Check the requested migration is included in the retrieved migrations
+        for mig in to_upgrade:
+            if mig.version == to_version:
+                break
+        else:
+            print(f"[F] Migration {to_version} not found in the peniding migrations.")
+            return None
+
+    return to_upgrade
+
+
+def _upgrade_databases(config: Config, args):
+    """
+    Private function to upgrade several databases (see multi_database) with one
+    client, pinged once. Exits with an error if any database fails.
+    """
+    if args.dry_run or args.estimate or args.profile or args.profile_memory:
+        print(
+            "[F] --dry-run, --estimate and the profiling options cannot be combined "
+            "with --databases or --database-pattern."
+        )
+        return
+    try:
+        client = _connect(config).client
+        client.admin.command("ping")
+    except Exception as err:
+        print(f"[F] Error connecting to the database: {err}")
+        return
+    try:
+        db_names = multi_database.get_target_databases(
+            client, args.databases, args.database_pattern
+        )
+    except Exception as err:
+        print(f"[F] Error listing the databases: {err}")
+        return
+    if not db_names:
+        print("[+] No databases to upgrade.")
+        return
+
+    migration_history = _load_valid_history(config)
+    if migration_history is None:
+        return
+
+    to_version = args.version or None
+    workers = max(1, args.workers or multi_database.DEFAULT_WORKERS)
+    ops.configure(config.mm_collection, config.throttle_options)
+    print(
+        f"[*] Upgrading {len(db_names)} databases to version: "
+        f"{to_version if to_version else 'latest'} with {workers} workers..."
+    )
+    run_migration = functools.partial(
+        _run_migration,
+        direction=ledger.UPGRADE,
+        reporter=progress.ProgressReporter(json_lines=bool(args.progress_json)),
+        profile_options=_get_profile_options(None),
+        isolate=bool(args.isolate),
+    )
+    start = time.perf_counter()
+    results = multi_database.upgrade_databases(
+        client,
+        db_names,
+        config.mm_collection,
+        migration_history,
+        run_migration,
+        to_version,
+        workers,
+    )
+    multi_database.print_report(results, time.perf_counter() - start)
+    if any(result.error for result in results):
+        sys.exit(1)
 
 
 def init(args):
@@ -34,13 +310,7 @@ def init(args):
 
     print("[*] Generating migration collection in the database...")
     try:
-        db = get_db(
-            config.db_host,
-            config.db_port,
-            config.db_name,
-            config.db_user,
-            config.db_password,
-        )
+        db = _connect(config)
         create_version_collection(db, config.mm_collection)
     except Exception as err:
         print(f"[F] Error connecting to the database: {err}")
@@ -79,9 +349,10 @@ def create(args):
         print("[!] Run 'mongo-migrator create <title>' to create a new migration.")
         return
 
+    template = args.template if args.template else "default"
     date = datetime.now()
     version = date.strftime("%Y%m%d%H%M%S%f")
-    file_name = f"{version}_{title}.py"
+    file_name = f"{version}_{title}{MigrationTemplate.get_extension(template)}"
     migration_path = os.path.join(config.migrations_dir, file_name)
 
     try:
@@ -96,10 +367,17 @@ def create(args):
     last_version = migration_history.get_last_version()
 
     MigrationTemplate.create_migration_file(
-        migration_path, raw_title, version, last_version
+        migration_path, raw_title, version, last_version, template
     )
 
     print(f"[+] Migration file created at: {migration_path}")
+    # Rebuilt so the new migration is not shadowed by the bundle
+    if _has_bundle(config):
+        try:
+            count = rebuild_bundle(config.migrations_dir, config.migrations_bundle)
+            print(f"[+] {count} migrations bundled at: {config.migrations_bundle}")
+        except Exception as err:
+            print(f"[!] Error bundling the migrations, removed the bundle: {err}")
 
 
 def upgrade(args):
@@ -110,77 +388,78 @@ def upgrade(args):
     config = Config()
 
     # Check if the migrations directory exists
-    if not os.path.exists(config.migrations_dir):
+    if not _uses_bundle(config) and not os.path.exists(config.migrations_dir):
         print("[!] Migration directory not found.")
         print("[!] Run 'mongo-migrator init' to initialize the migrations.")
         print("[!] Run 'mongo-migrator create <title>' to create a new migration.")
         return
 
+    # Upgrade several databases (e.g. one per tenant) instead of the configured one
+    if args and (args.databases or args.database_pattern):
+        _upgrade_databases(config, args)
+        return
+
     # Get current version
     try:
-        db = get_db(
-            config.db_host,
-            config.db_port,
-            config.db_name,
-            config.db_user,
-            config.db_password,
-        )
+        db = _connect(config)
         current_version = get_current_version(db, config.mm_collection)
         new_current_version = current_version
     except Exception as err:
         print(f"[F] Error connecting to the database: {err}")
         return
 
-    try:
-        migration_history = MigrationHistory(config.migrations_dir)
-    except Exception as err:
-        print(f"[F] Error loading the migration history: {err}")
-        return
-    # Validate the migration history. Must be a linear tree
-    if migration_history.is_empty():
-        print("[F] No migrations found.")
-        print("[F] Run 'mongo-migrator create <title>' to create a new migration.")
-        return
-    if not migration_history.validate():
-        print("[F] Migration history is not valid.")
-        print("[F] Please fix the migration files before upgrading the database.")
-        return
-
     # If requested, upgrade to the specified version, else upgrade to the latest
     to_version = args.version if args and args.version else None
-    print(f"[+] Current version: {current_version}")
+
+    # Fast path: if the cached last version is already applied, there is nothing
+    # to run and the migration history does not need to be loaded
+    if not to_version and current_version is not None:
+        if current_version == _get_cached_last_version(config):
+            print(f"[+] Current version: {current_version}")
+            print("[+] No migrations to run.")
+            return
+
+    to_upgrade = _get_pending_upgrades(config, current_version, to_version)
+    if to_upgrade is None:
+        return
     print(
         f"[*] Upgrading the database to version: {to_version if to_version else 'latest'}"
     )
 
-    # Retrieve the migrations to run
-    # These migrations start with the first one found (if no current_version is set)
-    # and end with the specified version (if requested) or the latest one found.
-    migrations = migration_history.get_migrations(current_version, to_version)
-    # Avoid upgrading the current version since it is already up to date
-    to_upgrade = [mig for mig in migrations if mig.version != current_version]
-
-    if args.version:
-        # Check the requested migration is included in the retrieved migrations
-        for mig in to_upgrade:
-            if mig.version == args.version:
-                break
-        else:
-            print(f"[F] Migration {args.version} not found in the peniding migrations.")
-            return
-
     # If there are no migrations to run, exit
     if not to_upgrade:
         print("[+] No migrations to run.")
         return
 
+    if args and args.estimate:
+        migration_ledger = ledger.Ledger(db, config.mm_collection)
+        planner.print_plan(planner.plan(db, to_upgrade, migration_ledger))
+
+    ops.configure(config.mm_collection, config.throttle_options)
+    if args and args.dry_run:
+        preflight_checks.dry_run(db, to_upgrade)
+        return
+
     # Run the migrations
+    migration_ledger = ledger.Ledger(db, config.mm_collection)
+    json_lines = bool(args.progress_json) if args else False
+    reporter = progress.ProgressReporter(json_lines=json_lines)
+    profile_options = _get_profile_options(args)
+    isolate = bool(args.isolate) if args else False
     print(f"[*] Running {len(to_upgrade)} migrations...")
     success = 0
     try:
         for migration in to_upgrade:
             print(f"[*] Running migration: {migration}")
-            migration.upgrade(db)
+            _run_migration(
+                db,
+                migration_ledger,
+                migration,
+                ledger.UPGRADE,
+                reporter,
+                profile_options,
+                isolate,
+            )
             new_current_version = migration.version
             success += 1
     except Exception as err:
@@ -195,6 +474,75 @@ def upgrade(args):
             print(f"[+] Current version set to: {new_current_version}")
 
 
+def plan(args):
+    """
+    Estimates the runtime of the pending migrations of an upgrade, based on the
+    runs recorded in the ledger and the current size of the collections.
+    """
+    # May exit if cant be loaded
+    config = Config()
+
+    if not _uses_bundle(config) and not os.path.exists(config.migrations_dir):
+        print("[!] Migration directory not found.")
+        print("[!] Run 'mongo-migrator init' to initialize the migrations.")
+        return
+
+    try:
+        db = _connect(config)
+        current_version = get_current_version(db, config.mm_collection)
+    except Exception as err:
+        print(f"[F] Error connecting to the database: {err}")
+        return
+
+    to_version = args.version if args and args.version else None
+    to_upgrade = _get_pending_upgrades(config, current_version, to_version)
+    if to_upgrade is None:
+        return
+    if not to_upgrade:
+        print("[+] No migrations to run.")
+        return
+
+    migration_ledger = ledger.Ledger(db, config.mm_collection)
+    planner.print_plan(planner.plan(db, to_upgrade, migration_ledger))
+
+
+def preflight(args):
+    """
+    Runs the pending migrations against a recording proxy of the database (nothing
+    is written) and explains the filters they use, to flag collection scans and
+    missing indexes before the upgrade. Exits with an error if a filter would scan
+    a whole collection.
+    """
+    # May exit if cant be loaded
+    config = Config()
+
+    if not _uses_bundle(config) and not os.path.exists(config.migrations_dir):
+        print("[!] Migration directory not found.")
+        print("[!] Run 'mongo-migrator init' to initialize the migrations.")
+        return
+
+    try:
+        db = _connect(config)
+        current_version = get_current_version(db, config.mm_collection)
+    except Exception as err:
+        print(f"[F] Error connecting to the database: {err}")
+        return
+
+    to_version = args.version if args and args.version else None
+    to_upgrade = _get_pending_upgrades(config, current_version, to_version)
+    if to_upgrade is None:
+        return
+    if not to_upgrade:
+        print("[+] No migrations to run.")
+        return
+
+    blocking = preflight_checks.print_reports(db, to_upgrade, args.execution_stats)
+    if blocking:
+        print(f"[F] {blocking} filters would scan a whole collection.")
+        sys.exit(1)
+    print("[+] No collection scans on filtered operations.")
+
+
 def downgrade(args):
     """
     Downgrades the database to the previous version by default.
@@ -202,7 +550,7 @@ def downgrade(args):
     # May exit if cant be loaded
     config = Config()
 
-    if not os.path.exists(config.migrations_dir):
+    if not _uses_bundle(config) and not os.path.exists(config.migrations_dir):
         print("[!] Migration directory not found.")
         print("[!] Run 'mongo-migrator init' to initialize the migrations.")
         print("[!] Run 'mongo-migrator create <title>' to create a new migration.")
@@ -210,32 +558,15 @@ def downgrade(args):
 
     # Get current version
     try:
-        db = get_db(
-            config.db_host,
-            config.db_port,
-            config.db_name,
-            config.db_user,
-            config.db_password,
-        )
+        db = _connect(config)
         current_version = get_current_version(db, config.mm_collection)
         new_current_version = current_version
     except Exception as err:
         print(f"[F] Error connecting to the database: {err}")
         return
 
-    try:
-        migration_history = MigrationHistory(config.migrations_dir)
-    except Exception as err:
-        print(f"[F] Error loading the migration history: {err}")
-        return
-    # Validate the migration history. Must be a linear tree
-    if migration_history.is_empty():
-        print("[F] No migrations found.")
-        print("[F] Run 'mongo-migrator create <title>' to create a new migration.")
-        return
-    if not migration_history.validate():
-        print("[F] Migration history is not valid.")
-        print("[F] Please fix the migration files before upgrading the database.")
+    migration_history = _load_valid_history(config)
+    if migration_history is None:
         return
     if current_version is None:
         print("[F] No migrations have been run yet.")
@@ -287,12 +618,26 @@ def downgrade(args):
         return
 
     # Run the migrations
+    ops.configure(config.mm_collection, config.throttle_options)
+    migration_ledger = ledger.Ledger(db, config.mm_collection)
+    json_lines = bool(args.progress_json) if args else False
+    reporter = progress.ProgressReporter(json_lines=json_lines)
+    profile_options = _get_profile_options(args)
+    isolate = bool(args.isolate) if args else False
     print(f"[*] Running {len(to_downgrade)} migrations...")
     success = 0
     try:
         for migration in to_downgrade:
             print(f"[*] Running migration: {migration}")
-            migration.downgrade(db)
+            _run_migration(
+                db,
+                migration_ledger,
+                migration,
+                ledger.DOWNGRADE,
+                reporter,
+                profile_options,
+                isolate,
+            )
             new_current_version = migration.last_version
             success += 1
     except Exception as err:
@@ -308,25 +653,19 @@ def downgrade(args):
 
 
 def history(args):
-    """Shows the migration history."""
+    """Shows the migration history, and the runs recorded in the ledger with --ledger."""
     # May exit if cant be loaded
     config = Config()
 
     # Check if the migrations directory exists
-    if not os.path.exists(config.migrations_dir):
+    if not _uses_bundle(config) and not os.path.exists(config.migrations_dir):
         print("[!] Migration directory not found.")
         print("[!] Run 'mongo-migrator init' to initialize the migrations.")
         return
 
     # Get the current version
     try:
-        db = get_db(
-            config.db_host,
-            config.db_port,
-            config.db_name,
-            config.db_user,
-            config.db_password,
-        )
+        db = _connect(config)
         current_version = get_current_version(db, config.mm_collection)
     except Exception as err:
         print(f"[F] Error connecting to the database: {err}")
@@ -334,13 +673,109 @@ def history(args):
 
     # Load the migration history
     try:
-        migration_history = MigrationHistory(config.migrations_dir)
+        migration_history = _load_history(config)
         print("[+] Migration history:")
         migration_history.print_history(current_version)
     except Exception as err:
         print(f"[F] Error loading the migration history: {err}")
         return
 
+    if args and args.ledger:
+        entries = ledger.Ledger(db, config.mm_collection).get_entries()
+        print("[+] Migration ledger:")
+        if not entries:
+            print("No migrations recorded yet.")
+        for entry in entries:
+            print(ledger.Ledger.format_entry(entry))
+
+
+def bundle(args):
+    """
+    Compiles every migration into a single bundle file.
+    When the bundle is set in the configuration file and exists, it is loaded
+    instead of the migrations directory.
+    """
+    print("[*] Bundling migrations...")
+
+    # May exit if cant be loaded
+    config = Config()
+
+    # Check if the migrations directory exists
+    if not os.path.exists(config.migrations_dir):
+        print("[!] Migration directory not found.")
+        print("[!] Run 'mongo-migrator init' to initialize the migrations.")
+        return
+
+    bundle_path = args.output if args and args.output else config.migrations_bundle
+    if not bundle_path:
+        print("[F] Missing bundle path.")
+        print("[F] Use --output or set 'bundle' in the [migrations] section.")
+        return
+
+    try:
+        count = create_bundle(config.migrations_dir, bundle_path)
+    except Exception as err:
+        print(f"[F] Error bundling the migrations: {err}")
+        return
+
+    print(f"[+] {count} migrations bundled at: {bundle_path}")
+
+
+def worker(args):
+    """
+    Claims and runs the partitions of distributed updates (see work_queue).
+    Runs until interrupted, or until there is no work left with --once.
+    """
+    # May exit if cant be loaded
+    config = Config()
+
+    if not _uses_bundle(config) and not os.path.exists(config.migrations_dir):
+        print("[!] Migration directory not found.")
+        print("[!] Run 'mongo-migrator init' to initialize the migrations.")
+        return
+
+    try:
+        db = _connect(config)
+    except Exception as err:
+        print(f"[F] Error connecting to the database: {err}")
+        return
+
+    ops.configure(config.mm_collection, config.throttle_options)
+    queue = work_queue.WorkQueue(db)
+    migrations = {}
+
+    def resolve(item):
+        """Load the transform of an item from the local migrations."""
+        if item["migration"] not in migrations:
+            # Reloaded to find the migrations created after the worker started
+            history = _load_history(config)
+            for node in history.migrations.values():
+                migrations[os.path.basename(node.file_path)] = node
+        node = migrations.get(item["migration"])
+        if node is None:
+            raise ValueError(f"Migration {item['migration']} not found.")
+        return ops.load_function(node.file_path, item["function"], node.code)
+
+    once = bool(args.once) if args else False
+    lease = args.lease if args and args.lease else work_queue.DEFAULT_LEASE_SECONDS
+    poll_interval = args.poll_interval if args and args.poll_interval else 1.0
+
+    worker_id = work_queue.get_worker_id()
+    print(f"[*] Worker {worker_id} waiting for partitions...")
+    try:
+        count = work_queue.work(
+            queue,
+            resolve,
+            worker_id,
+            lease_seconds=lease,
+            poll_interval=poll_interval,
+            once=once,
+        )
+    except KeyboardInterrupt:
+        print("[!] Worker interrupted.")
+        return
+    print(f"[+] {count} partitions run.")
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -366,6 +801,13 @@ def main():
     parser_create = subparsers.add_parser("create", help="create a new migration file.")
     parser_create.description = create.__doc__
     parser_create.add_argument("title", help="title of the migration")
+    parser_create.add_argument(
+        "--template",
+        choices=list(MigrationTemplate.TEMPLATES),
+        default="default",
+        help="template of the migration file. 'bulk' uses ops.bulk_update, "
+        "'declarative' creates a JSON migration.",
+    )
     parser_create.set_defaults(func=create)
 
     # Subcommand: upgrade
@@ -379,8 +821,83 @@ def main():
     parser_upgrade.add_argument(
         "--version", help="upgrade to the specified version using the timestamp."
     )
+    parser_upgrade.add_argument(
+        "--estimate",
+        action="store_true",
+        help="print the estimated runtime of the migrations before running them.",
+    )
+    parser_upgrade.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="report the documents and bytes each migration would write, without "
+        "writing them.",
+    )
+    parser_upgrade.add_argument(
+        "--progress-json",
+        action="store_true",
+        help="report the progress of the migrations as JSON lines.",
+    )
+    parser_upgrade.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile each migration with cProfile (.pstats files).",
+    )
+    parser_upgrade.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="report the peak memory and top allocations of each migration.",
+    )
+    parser_upgrade.add_argument(
+        "--profile-dir",
+        help="directory of the profiles. Defaults to 'profiles'.",
+    )
+    parser_upgrade.add_argument(
+        "--databases",
+        help="comma separated databases to upgrade instead of the configured one.",
+    )
+    parser_upgrade.add_argument(
+        "--database-pattern",
+        help="upgrade every database whose name matches this regular expression.",
+    )
+    parser_upgrade.add_argument(
+        "--workers",
+        type=int,
+        default=multi_database.DEFAULT_WORKERS,
+        help="databases upgraded concurrently with --databases or "
+        f"--database-pattern. Defaults to {multi_database.DEFAULT_WORKERS}.",
+    )
+    parser_upgrade.add_argument(
+        "--isolate",
+        action="store_true",
+        help="run each migration in a new process, releasing the modules it imports.",
+    )
     parser_upgrade.set_defaults(func=upgrade)
 
+    # Subcommand: plan
+    parser_plan = subparsers.add_parser(
+        "plan", help="estimate the runtime of the pending migrations."
+    )
+    parser_plan.description = plan.__doc__
+    parser_plan.add_argument(
+        "--version", help="plan the upgrade to the specified version."
+    )
+    parser_plan.set_defaults(func=plan)
+
+    # Subcommand: preflight
+    parser_preflight = subparsers.add_parser(
+        "preflight", help="flag collection scans in the pending migrations."
+    )
+    parser_preflight.description = preflight.__doc__
+    parser_preflight.add_argument(
+        "--version", help="check the upgrade to the specified version."
+    )
+    parser_preflight.add_argument(
+        "--execution-stats",
+        action="store_true",
+        help="run the explained queries to report the exact documents examined.",
+    )
+    parser_preflight.set_defaults(func=preflight)
+
     # Subcommand: downgrade
     parser_downgrade = subparsers.add_parser(
         "downgrade", help="downgrade the database by running the migrations."
@@ -398,6 +915,30 @@ def main():
     parser_downgrade.add_argument(
         "--version", help="downgrade to the specified version using the timestamp."
     )
+    parser_downgrade.add_argument(
+        "--progress-json",
+        action="store_true",
+        help="report the progress of the migrations as JSON lines.",
+    )
+    parser_downgrade.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile each migration with cProfile (.pstats files).",
+    )
+    parser_downgrade.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="report the peak memory and top allocations of each migration.",
+    )
+    parser_downgrade.add_argument(
+        "--profile-dir",
+        help="directory of the profiles. Defaults to 'profiles'.",
+    )
+    parser_downgrade.add_argument(
+        "--isolate",
+        action="store_true",
+        help="run each migration in a new process, releasing the modules it imports.",
+    )
     parser_downgrade.set_defaults(func=downgrade)
 
     # Subcommand: history
@@ -405,8 +946,43 @@ def main():
         "history", help="show the migration history."
     )
     parser_history.description = history.__doc__
+    parser_history.add_argument(
+        "--ledger",
+        action="store_true",
+        help="show every recorded run of the migrations, from newest to oldest.",
+    )
     parser_history.set_defaults(func=history)
 
+    # Subcommand: bundle
+    parser_bundle = subparsers.add_parser(
+        "bundle", help="compile the migrations into a single bundle file."
+    )
+    parser_bundle.description = bundle.__doc__
+    parser_bundle.add_argument(
+        "--output", help="path of the bundle file. Defaults to the configured one."
+    )
+    parser_bundle.set_defaults(func=bundle)
+
+    # Subcommand: worker
+    parser_worker = subparsers.add_parser(
+        "worker", help="run the partitions of distributed updates."
+    )
+    parser_worker.description = worker.__doc__
+    parser_worker.add_argument(
+        "--once", action="store_true", help="exit when there is no work left."
+    )
+    parser_worker.add_argument(
+        "--lease",
+        type=float,
+        help="seconds each partition is leased to the worker. Defaults to 60.",
+    )
+    parser_worker.add_argument(
+        "--poll-interval",
+        type=float,
+        help="seconds to wait for new partitions when there is no work. Defaults to 1.",
+    )
+    parser_worker.set_defaults(func=worker)
+
     # Parse arguments
     args = parser.parse_args()
 
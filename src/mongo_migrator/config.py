@@ -16,6 +16,31 @@ Available variables in the Config class implementation
 import configparser
 import os
 
+from typing import Any, Dict
+
+from mongo_migrator.throttle import Throttle
+
+
+def _parse_option(value: str) -> Any:
+    """
+    Parse the value of a driver or throttle option into None, a bool, int, float
+    or string.
+    Args:
+        value: The raw value of the option.
+    Returns:
+        The parsed value. None for 'None' (e.g. to ignore a throttle metric).
+    """
+    if value.lower() == "none":
+        return None
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
 
 class Config:
     """Class to handle the configuration file"""
@@ -43,14 +68,21 @@ class Config:
 
             self.config.read(self.CONFIG_FILE)
             # Database configuration
-            self.db_host = self.config.get("database", "host")
-            self.db_port = self.config.getint("database", "port")
+            # With a connection URI, the host and port are optional
+            self.db_uri = self.config.get("database", "uri", raw=True, fallback=None)
+            if self.db_uri:
+                self.db_host = self.config.get("database", "host", fallback=None)
+                self.db_port = self.config.getint("database", "port", fallback=None)
+            else:
+                self.db_host = self.config.get("database", "host")
+                self.db_port = self.config.getint("database", "port")
             self.db_name = self.config.get("database", "name")
             self.db_user = None
             self.db_password = None
             # Migrations configuration
             self.migrations_dir = self.config.get("migrations", "directory")
             self.mm_collection = self.config.get("migrations", "collection")
+            self.migrations_bundle = None
         except FileNotFoundError:
             print("[F] Configuration file not found.")
             print(
@@ -73,3 +105,24 @@ class Config:
             self.db_password = self.config.get("database", "password")
         except configparser.NoOptionError:
             self.db_password = None
+
+        try:
+            self.migrations_bundle = self.config.get("migrations", "bundle")
+        except configparser.NoOptionError:
+            self.migrations_bundle = None
+
+        # Driver options, passed through to MongoClient (e.g. compressors = zstd)
+        self.driver_options: Dict[str, Any] = {}
+        if self.config.has_section("driver"):
+            for option, value in self.config.items("driver", raw=True):
+                self.driver_options[option] = _parse_option(value)
+
+        # Throttle of the data migrations (e.g. max_lag = 10). Disabled if missing
+        self.throttle_options: Dict[str, Any] = {}
+        if self.config.has_section("throttle"):
+            for option, value in self.config.items("throttle", raw=True):
+                if option not in Throttle.OPTIONS:
+                    print(f"[F] Unknown option in the throttle section: {option}")
+                    print("[F] Exiting...")
+                    exit(1)
+                self.throttle_options[option] = _parse_option(value)
@@ -1,8 +1,187 @@
-"""Module for database operations."""
+"""
+Module for database operations.
 
-from pymongo import MongoClient
+Clients are pooled: one MongoClient is created per connection and process, and
+reused by every get_db call (and therefore by every migration) in that process.
+Their commands are reported to the instrumentation listener.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+
+from typing import Any, Dict, Optional
+
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.asynchronous.database import AsyncDatabase
 from pymongo.database import Database
 
+from mongo_migrator import instrumentation
+
+DEFAULT_TIMEOUT_MS = 5000
+
+_clients: Dict[tuple, MongoClient] = {}
+# Arguments of get_client for each pooled client, by id of the client
+_client_params: Dict[int, Dict[str, Any]] = {}
+_clients_lock = threading.Lock()
+
+
+def _ping(client: MongoClient):
+    """
+    Private function to check that the server is alive with a cheap round trip.
+    Raises:
+        Exception: If the server cannot be reached.
+    """
+    client.admin.command("ping")
+
+
+def _backoff_delay(retry: int, backoff: float, max_backoff: float) -> float:
+    """
+    Private function to compute the delay before a retry.
+    Uses exponential backoff with full jitter.
+    Args:
+        retry: The number of the retry, starting at 0.
+        backoff: The base delay in seconds.
+        max_backoff: The maximum delay in seconds.
+    Returns:
+        The delay in seconds.
+    """
+    return random.uniform(0, min(max_backoff, backoff * 2**retry))
+
+
+def _get_client_options(
+    db_user: Optional[str],
+    db_pass: Optional[str],
+    max_pool_size: int,
+    min_pool_size: int,
+    max_idle_time_ms: Optional[int],
+    driver_options: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """
+    Private function to get the options of a client, with the driver options
+    taking precedence. The options are case insensitive, so they are merged in
+    lower case.
+    """
+    options = {
+        "serverselectiontimeoutms": DEFAULT_TIMEOUT_MS,
+        "sockettimeoutms": DEFAULT_TIMEOUT_MS,
+        "connecttimeoutms": DEFAULT_TIMEOUT_MS,
+        "maxpoolsize": max_pool_size,
+        "minpoolsize": min_pool_size,
+        "maxidletimems": max_idle_time_ms,
+    }
+    for option, value in (driver_options or {}).items():
+        options[option.lower()] = value
+    if db_user is not None:
+        options["username"] = db_user
+    if db_pass is not None:
+        options["password"] = db_pass
+    return options
+
+
+def get_client(
+    db_host: str,
+    db_port: int,
+    db_user: str = None,
+    db_pass: str = None,
+    verbose: bool = False,
+    max_retries: int = 3,
+    max_pool_size: int = 100,
+    min_pool_size: int = 0,
+    max_idle_time_ms: int = None,
+    backoff: float = 0.5,
+    max_backoff: float = 10.0,
+    uri: str = None,
+    driver_options: Dict[str, Any] = None,
+) -> MongoClient:
+    """
+    Get a pooled client using pymongo.
+    The client is cached by connection details and process, so later calls reuse
+    it without any round trip. Its liveness is checked with a ping when it is
+    created, and a cached client is never closed by a later call.
+    Args:
+        db_host: The hostname of the MongoDB server. Ignored if uri is set.
+        db_port: The port number of the MongoDB server. Ignored if uri is set.
+        db_user: The username for the database if needed.
+        db_pass: The password for the database if needed.
+        verbose: Whether to print messages.
+        max_retries: The number of times to try connecting to the database.
+        max_pool_size: The maximum number of connections of the pool.
+        min_pool_size: The minimum number of connections of the pool.
+        max_idle_time_ms: The time a connection can stay idle in the pool.
+        backoff: The base delay in seconds between retries. Doubles on each retry.
+        max_backoff: The maximum delay in seconds between retries.
+        uri: The MongoDB connection URI, used instead of the host and port.
+        driver_options: Options passed through to MongoClient (e.g. compressors,
+            readPreference, w, timeouts). They take precedence over the other arguments.
+    Raises:
+        Exception: If the connection cannot be established.
+    Returns:
+        The client.
+    """
+    options = _get_client_options(
+        db_user, db_pass, max_pool_size, min_pool_size, max_idle_time_ms, driver_options
+    )
+    key = (os.getpid(), uri, db_host, db_port, tuple(sorted(options.items())))
+    params = {
+        "db_host": db_host,
+        "db_port": db_port,
+        "db_user": db_user,
+        "db_pass": db_pass,
+        "max_pool_size": max_pool_size,
+        "min_pool_size": min_pool_size,
+        "max_idle_time_ms": max_idle_time_ms,
+        "uri": uri,
+        "driver_options": driver_options,
+    }
+
+    if verbose:
+        address = "the configured URI" if uri else f"{db_host}:{db_port}"
+        print(f"Connecting to MongoDB at {address}...")
+
+    with _clients_lock:
+        client = _clients.get(key)
+    # The pool of a shared client replaces its dead connections by itself
+    if client is not None:
+        return client
+
+    for retry in range(max_retries):
+        client = None
+        try:
+            # Commands are aggregated per migration (see instrumentation)
+            listeners = [instrumentation.listener]
+            if uri:
+                client = MongoClient(uri, event_listeners=listeners, **options)
+            else:
+                client = MongoClient(
+                    host=db_host, port=db_port, event_listeners=listeners, **options
+                )
+            _ping(client)
+        except Exception as err:
+            print(f"[F] Error connecting to database: {err}")
+            # Only the new client is closed, never a shared one
+            if client is not None:
+                client.close()
+            if retry < max_retries - 1:
+                time.sleep(_backoff_delay(retry, backoff, max_backoff))
+            continue
+
+        with _clients_lock:
+            pooled_client = _clients.setdefault(key, client)
+            _client_params[id(pooled_client)] = params
+        # Another thread may have connected at the same time
+        if pooled_client is not client:
+            client.close()
+        if verbose:
+            print("[+] Connected to database.")
+        return pooled_client
+
+    raise Exception(
+        "Could not connect to database. Please check your connection details."
+    )
+
 
 def get_db(
     db_host: str,
@@ -12,53 +191,144 @@ def get_db(
     db_pass: str = None,
     verbose: bool = False,
     max_retries: int = 3,
+    **pool_options,
 ) -> Database:
     """
-    Get the database connection using pymongo.
+    Get the database connection using the pooled client of get_client.
     Args:
-        db_host: The hostname of the MongoDB server.
-        db_port: The port number of the MongoDB server.
+        db_host: The hostname of the MongoDB server. Ignored if a uri is passed.
+        db_port: The port number of the MongoDB server. Ignored if a uri is passed.
         db_name: The name of the database.
         db_user: The username for the database if needed.
         db_pass: The password for the database if needed.
         verbose: Whether to print messages.
-        max_retries: The number of times to retry connecting to the database.
+        max_retries: The number of times to try connecting to the database.
+        pool_options: Pool sizing, retry, uri and driver options of get_client.
     Raises:
         Exception: If the connection cannot be established.
     Returns:
         The database connection.
     """
-    retries = 0
-    timeout_ms = 5000
+    client = get_client(
+        db_host,
+        db_port,
+        db_user,
+        db_pass,
+        verbose=verbose,
+        max_retries=max_retries,
+        **pool_options,
+    )
+    return client[db_name]
+
 
+async def get_async_client(
+    db_host: str,
+    db_port: int,
+    db_user: str = None,
+    db_pass: str = None,
+    verbose: bool = False,
+    max_retries: int = 3,
+    max_pool_size: int = 100,
+    min_pool_size: int = 0,
+    max_idle_time_ms: int = None,
+    backoff: float = 0.5,
+    max_backoff: float = 10.0,
+    uri: str = None,
+    driver_options: Dict[str, Any] = None,
+) -> AsyncMongoClient:
+    """
+    Get an asyncio client using pymongo, with the same arguments as get_client.
+    Async clients are bound to the event loop they are used in, so they are not
+    pooled: close the client when it is no longer needed.
+    Raises:
+        Exception: If the connection cannot be established.
+    Returns:
+        The client.
+    """
+    options = _get_client_options(
+        db_user, db_pass, max_pool_size, min_pool_size, max_idle_time_ms, driver_options
+    )
     if verbose:
-        print(f"Connecting to MongoDB at {db_host}:{db_port}...")
+        address = "the configured URI" if uri else f"{db_host}:{db_port}"
+        print(f"Connecting to MongoDB at {address}...")
 
-    while retries < max_retries:
-        try:
-            client = MongoClient(
-                host=db_host,
-                port=db_port,
-                username=db_user,
-                password=db_pass,
-                serverSelectionTimeoutMS=timeout_ms,
-                socketTimeoutMS=timeout_ms,
-                connectTimeoutMS=timeout_ms,
+    for retry in range(max_retries):
+        # Commands are aggregated per migration (see instrumentation)
+        listeners = [instrumentation.listener]
+        if uri:
+            client = AsyncMongoClient(uri, event_listeners=listeners, **options)
+        else:
+            client = AsyncMongoClient(
+                host=db_host, port=db_port, event_listeners=listeners, **options
             )
-            db = client[db_name]
-            db.list_collection_names()
+        try:
+            await client.admin.command("ping")
             if verbose:
                 print("[+] Connected to database.")
-            return db
+            return client
         except Exception as err:
             print(f"[F] Error connecting to database: {err}")
-            retries += 1
+            await client.close()
+            if retry < max_retries - 1:
+                await asyncio.sleep(_backoff_delay(retry, backoff, max_backoff))
 
     raise Exception(
         "Could not connect to database. Please check your connection details."
     )
 
 
+def get_connection_params(client: MongoClient) -> Optional[Dict[str, Any]]:
+    """
+    Get the arguments get_client was called with to create a pooled client.
+    They allow other processes (e.g. parallel workers) to open their own client
+    with the same connection details.
+    Args:
+        client: The pooled client.
+    Returns:
+        The arguments of get_client, or None if the client is not pooled.
+    """
+    with _clients_lock:
+        params = _client_params.get(id(client))
+    return dict(params) if params is not None else None
+
+
+def get_db_without_socket_timeout(db: Database) -> Database:
+    """
+    Get a database on a pooled client without socket timeout, for the commands
+    that may run for longer than it (e.g. an update_many of a whole collection).
+    The client has the connection details of the client of db, and is pooled like
+    the others.
+    Args:
+        db: The database.
+    Returns:
+        The database on the client without socket timeout, or db itself if it was
+        not connected with get_db (e.g. a dry run proxy).
+    """
+    params = get_connection_params(getattr(db, "client", None))
+    if params is None:
+        return db
+    driver_options = {
+        option: value
+        for option, value in (params["driver_options"] or {}).items()
+        if option.lower() != "sockettimeoutms"
+    }
+    driver_options["socketTimeoutMS"] = None
+    params["driver_options"] = driver_options
+    return get_client(**params)[db.name]
+
+
+def close_clients() -> None:
+    """
+    Close every pooled client of the current process.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _client_params.clear()
+    for client in clients:
+        client.close()
+
+
 def create_version_collection(db: Database, collection_name: str) -> None:
     """
     Create the version collection in the database.
@@ -102,3 +372,30 @@ def get_current_version(db: Database, collection_name: str) -> str:
     version = db[collection_name].find_one()
     if version:
         return version.get("current_version")
+
+
+async def set_current_version_async(
+    db: AsyncDatabase, collection_name: str, version: str
+) -> None:
+    """
+    Set the current version with an asyncio database (see set_current_version).
+    Args:
+        db: The database connection.
+        collection_name: The name of the version collection.
+        version: The current version.
+    """
+    await db[collection_name].update_one({}, {"$set": {"current_version": version}})
+
+
+async def get_current_version_async(db: AsyncDatabase, collection_name: str) -> str:
+    """
+    Get the current version with an asyncio database (see get_current_version).
+    Args:
+        db: The database connection.
+        collection_name: The name of the version collection.
+    Returns:
+        The current version.
+    """
+    version = await db[collection_name].find_one()
+    if version:
+        return version.get("current_version")
@@ -0,0 +1,364 @@
+"""
+Declarative migrations, written as JSON files next to the Python migrations. Their
+file names end with .migration.json, so the other JSON files of the migrations
+directory (e.g. fixtures) are not loaded as migrations.
+
+Each operation renames, sets a default, unsets or converts the type of fields of a
+collection. It is compiled to a single update_many with an aggregation pipeline,
+so the documents are updated by the server in one command instead of a client
+side loop:
+```
+{
+    "title": "Normalize users",
+    "version": "20250101120000000000",
+    "last_version": null,
+    "operations": [
+        {"collection": "users", "rename": {"name": "full_name"}},
+        {"collection": "users", "set_default": {"active": true}},
+        {"collection": "users", "convert": {"age": {"to": "int", "from": "string"}}},
+        {"collection": "users", "unset": ["legacy"], "filter": {"legacy": null}}
+    ]
+}
+```
+
+The downgrade runs the inverse operations in reverse order, when every operation
+is reversible: renames, and conversions that declare the type they convert from.
+Otherwise, the downgrade operations can be declared with a "downgrade" key.
+"""
+
+import json
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from mongo_migrator import ops
+from mongo_migrator.db_utils import get_db_without_socket_timeout
+
+ACTIONS = ("rename", "set_default", "unset", "convert")
+# Types supported by $convert, with the same aliases as the $type query operator
+CONVERT_TYPES = (
+    "double",
+    "string",
+    "objectId",
+    "bool",
+    "date",
+    "int",
+    "long",
+    "decimal",
+)
+FILE_EXTENSION = ".migration.json"
+
+# Source executed to load a declarative migration (see to_source)
+SOURCE_TEMPLATE = '''"""
+title: {title}
+version: {version}
+last_version: {last_version}
+"""
+from mongo_migrator import declarative
+
+SPEC = {spec!r}
+
+upgrade, downgrade = declarative.get_functions(SPEC)
+'''
+
+
+def is_declarative(file_path: Optional[str]) -> bool:
+    """
+    Check if a migration file is a declarative migration.
+    Args:
+        file_path: The path to the migration file.
+    Returns:
+        True if it is a declarative migration, False otherwise.
+    """
+    return bool(file_path) and file_path.endswith(FILE_EXTENSION)
+
+
+def _get_action(operation: Dict[str, Any]) -> str:
+    """
+    Private function to get the action of an operation.
+    Raises:
+        ValueError: If the operation has no action or more than one.
+    """
+    actions = [action for action in ACTIONS if action in operation]
+    if len(actions) != 1:
+        raise ValueError(
+            f"Each operation must have one of {', '.join(ACTIONS)}: {operation}"
+        )
+    return actions[0]
+
+
+def _validate_operation(operation: Any):
+    """
+    Private function to validate an operation.
+    Raises:
+        ValueError: If the operation is invalid.
+    """
+    if not isinstance(operation, dict) or not isinstance(
+        operation.get("collection"), str
+    ):
+        raise ValueError(f"Each operation must have a collection: {operation}")
+    if not isinstance(operation.get("filter", {}), dict):
+        raise ValueError(f"The filter must be an object: {operation}")
+    action = _get_action(operation)
+    fields = operation[action]
+    if action == "unset":
+        if isinstance(fields, str):
+            fields = [fields]
+        if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+            raise ValueError(f"unset must be a field or a list of fields: {operation}")
+    elif not isinstance(fields, dict) or not fields:
+        raise ValueError(f"{action} must be an object by field: {operation}")
+    elif action == "rename":
+        if not all(isinstance(new, str) for new in fields.values()):
+            raise ValueError(f"rename must map fields to new names: {operation}")
+    elif action == "convert":
+        for target in fields.values():
+            if isinstance(target, str):
+                target = {"to": target}
+            if not isinstance(target, dict) or any(
+                target.get(key, "string") not in CONVERT_TYPES for key in ("to", "from")
+            ):
+                raise ValueError(
+                    f"convert types must be one of {', '.join(CONVERT_TYPES)}: "
+                    f"{operation}"
+                )
+
+
+def validate(spec: Any, file_path: str = None) -> Dict[str, Any]:
+    """
+    Validate a declarative migration.
+    Args:
+        spec: The parsed migration.
+        file_path: The path to the migration file, for the errors.
+    Raises:
+        ValueError: If the migration is invalid.
+    Returns:
+        The migration.
+    """
+    try:
+        if not isinstance(spec, dict):
+            raise ValueError("The migration must be an object.")
+        for key in ("title", "version"):
+            if not isinstance(spec.get(key), str) or not spec[key]:
+                raise ValueError(f"Missing {key}.")
+        if not spec["version"].isdigit():
+            raise ValueError("The version must be a timestamp.")
+        last_version = spec.get("last_version")
+        if last_version is not None and not (
+            isinstance(last_version, str) and last_version.isdigit()
+        ):
+            raise ValueError("The last_version must be a timestamp or null.")
+        for key in ("operations", "downgrade"):
+            operations = spec.get(key, [])
+            if not isinstance(operations, list):
+                raise ValueError(f"The {key} must be a list of operations.")
+            for operation in operations:
+                _validate_operation(operation)
+    except ValueError as err:
+        raise ValueError(f"Invalid declarative migration on {file_path}: {err}")
+    return spec
+
+
+def read_spec(file_path: str) -> Dict[str, Any]:
+    """
+    Read a declarative migration file.
+    Args:
+        file_path: The path to the migration file.
+    Raises:
+        FileNotFoundError: If the file is not found.
+        ValueError: If the file is not valid JSON or not a valid migration.
+    Returns:
+        The migration.
+    """
+    with open(file_path, "r") as f:
+        try:
+            spec = json.load(f)
+        except ValueError as err:
+            raise ValueError(f"Invalid declarative migration on {file_path}: {err}")
+    return validate(spec, file_path)
+
+
+def to_source(file_path: str) -> str:
+    """
+    Get the Python source that loads a declarative migration, so it is imported,
+    bundled and inspected like the other migrations.
+    Args:
+        file_path: The path to the migration file.
+    Raises:
+        FileNotFoundError: If the file is not found.
+        ValueError: If the file is not a valid migration.
+    Returns:
+        The source of the migration module.
+    """
+    spec = read_spec(file_path)
+    return SOURCE_TEMPLATE.format(
+        title=spec["title"],
+        version=spec["version"],
+        last_version=spec.get("last_version"),
+        spec=spec,
+    )
+
+
+def _any_field(fields: List[str], condition: Any) -> dict:
+    """Private function to match the documents where any field meets a condition."""
+    filters = [{field: condition} for field in fields]
+    return filters[0] if len(filters) == 1 else {"$or": filters}
+
+
+def compile_operation(operation: Dict[str, Any]) -> Tuple[str, dict, List[dict]]:
+    """
+    Compile an operation to an update_many with an aggregation pipeline.
+    Only the documents the operation changes are matched.
+    Args:
+        operation: The operation.
+    Raises:
+        ValueError: If the operation is invalid.
+    Returns:
+        The collection, the filter and the pipeline of the update.
+    """
+    _validate_operation(operation)
+    action = _get_action(operation)
+    fields = operation[action]
+
+    if action == "rename":
+        filter = _any_field(list(fields), {"$exists": True})
+        # A missing field keeps the value of the new one, if any
+        values = {
+            new: {
+                "$cond": [
+                    {"$eq": [{"$type": f"${old}"}, "missing"]},
+                    f"${new}",
+                    f"${old}",
+                ]
+            }
+            for old, new in fields.items()
+        }
+        pipeline = [{"$set": values}, {"$unset": list(fields)}]
+    elif action == "set_default":
+        # Matches the missing and null fields
+        filter = _any_field(list(fields), None)
+        values = {
+            field: {"$ifNull": [f"${field}", {"$literal": value}]}
+            for field, value in fields.items()
+        }
+        pipeline = [{"$set": values}]
+    elif action == "unset":
+        fields = [fields] if isinstance(fields, str) else fields
+        filter = _any_field(fields, {"$exists": True})
+        pipeline = [{"$unset": fields}]
+    else:
+        targets = {
+            field: target["to"] if isinstance(target, dict) else target
+            for field, target in fields.items()
+        }
+        filters = [
+            {field: {"$exists": True, "$ne": None, "$not": {"$type": to}}}
+            for field, to in targets.items()
+        ]
+        filter = filters[0] if len(filters) == 1 else {"$or": filters}
+        # Values that cannot be converted are kept
+        values = {
+            field: {
+                "$convert": {
+                    "input": f"${field}",
+                    "to": to,
+                    "onError": f"${field}",
+                    "onNull": f"${field}",
+                }
+            }
+            for field, to in targets.items()
+        }
+        pipeline = [{"$set": values}]
+
+    if operation.get("filter"):
+        filter = {"$and": [operation["filter"], filter]}
+    return operation["collection"], filter, pipeline
+
+
+def reverse_operation(operation: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the inverse of an operation.
+    Args:
+        operation: The operation.
+    Raises:
+        ValueError: If the operation is not reversible.
+    Returns:
+        The inverse operation.
+    """
+    action = _get_action(operation)
+    fields = operation[action]
+    reverse: Optional[Dict[str, Any]] = None
+    if action == "rename":
+        reverse = {"rename": {new: old for old, new in fields.items()}}
+    elif action == "convert" and all(
+        isinstance(target, dict) and "from" in target for target in fields.values()
+    ):
+        reverse = {
+            "convert": {
+                field: {"to": target["from"], "from": target["to"]}
+                for field, target in fields.items()
+            }
+        }
+    if reverse is None:
+        raise ValueError(f"The {action} operation is not reversible: {operation}")
+
+    reverse["collection"] = operation["collection"]
+    if operation.get("filter"):
+        reverse["filter"] = operation["filter"]
+    return reverse
+
+
+def run_operations(db, operations: List[Dict[str, Any]]):
+    """
+    Run the operations of a declarative migration, one update_many each.
+    The updates may run for longer than the socket timeout of the pooled clients,
+    so they are sent without it (see get_db_without_socket_timeout).
+    Args:
+        db: The database.
+        operations: The operations.
+    """
+    db = get_db_without_socket_timeout(db)
+    for operation in operations:
+        collection, filter, pipeline = compile_operation(operation)
+        result = ops.BulkResult(collection)
+        update = db[collection].update_many(filter, pipeline)
+        result.processed = result.matched = update.matched_count
+        result.modified = update.modified_count
+        result.batches = 1
+        result.finish()
+        ops.track(result)
+        print(f"[*] {_get_action(operation)} {result}")
+
+
+def get_functions(spec: Dict[str, Any]) -> Tuple[Callable, Callable]:
+    """
+    Get the upgrade and downgrade functions of a declarative migration.
+    Args:
+        spec: The migration.
+    Returns:
+        The upgrade and downgrade functions. The downgrade raises ValueError if
+        the migration is not reversible and declares no downgrade.
+    """
+    operations = spec.get("operations", [])
+
+    def upgrade(db):
+        run_operations(db, operations)
+
+    if "downgrade" in spec:
+        downgrade_operations = spec["downgrade"]
+    else:
+        try:
+            downgrade_operations = [
+                reverse_operation(operation) for operation in reversed(operations)
+            ]
+        except ValueError as err:
+            error = str(err)
+
+            def downgrade(db):
+                raise ValueError(f"{error}. Declare the downgrade operations.")
+
+            return upgrade, downgrade
+
+    def downgrade(db):
+        run_operations(db, downgrade_operations)
+
+    return upgrade, downgrade
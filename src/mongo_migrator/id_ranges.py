@@ -0,0 +1,159 @@
+"""
+Ranges of the _id space of a collection, updated concurrently by parallel_update
+and by the workers of a distributed update.
+
+The _ids of a collection may have several BSON types (e.g. ObjectIds and strings).
+The boundaries are sorted by the server in BSON order, and the filter of a range
+whose bounds have different types also matches the types between them, since
+query comparisons ($gt, $gte, $lt) only match values of the same type. Resumable
+iterations continue after their last _id with the later types too (see after_filter).
+"""
+
+import datetime
+import uuid
+
+from typing import Any, List, Optional, Tuple
+
+from bson import Binary, Decimal128, Int64, ObjectId, Timestamp
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from pymongo.collection import Collection
+
+# $type aliases of the types an _id can have (not arrays, regexes or undefined) in
+# BSON comparison order, with the Python types of each one
+BSON_TYPE_ORDER = (
+    ("minKey", (MinKey,)),
+    ("null", (type(None),)),
+    ("number", (int, float, Int64, Decimal128)),
+    ("string", (str,)),
+    ("object", (dict,)),
+    ("binData", (bytes, Binary, uuid.UUID)),
+    ("objectId", (ObjectId,)),
+    ("bool", (bool,)),
+    ("date", (datetime.datetime,)),
+    ("timestamp", (Timestamp,)),
+    ("maxKey", (MaxKey,)),
+)
+
+
+def get_type_order(value: Any) -> int:
+    """
+    Get the position of the BSON type of a value in the BSON comparison order.
+    Args:
+        value: The value (e.g. an _id).
+    Raises:
+        TypeError: If the value is not of a BSON type an _id can have.
+    Returns:
+        The index of its type in BSON_TYPE_ORDER.
+    """
+    for order, (alias, types) in enumerate(BSON_TYPE_ORDER):
+        # bool is a subclass of int, but it is not a number in BSON
+        if isinstance(value, types) and not (
+            alias == "number" and isinstance(value, bool)
+        ):
+            return order
+    raise TypeError(f"{type(value).__name__} is not a valid _id type.")
+
+
+def partition(
+    collection: Collection, partitions: int, samples_per_partition: int = 20
+) -> List[Tuple[Any, Any]]:
+    """
+    Split the _id space of a collection into ranges with a similar number of
+    documents, using the _ids of a random sample of documents as boundaries.
+    Args:
+        collection: The collection to split.
+        partitions: The number of ranges.
+        samples_per_partition: The number of sampled documents per range.
+    Returns:
+        The (lower, upper) ranges sorted by _id. The lower bound is inclusive and the
+        upper bound exclusive. The first lower and last upper bounds are None
+        (unbounded), so every document belongs to exactly one range (see
+        range_filter). There may be fewer ranges than requested if the collection
+        has few documents.
+    """
+    if partitions <= 1:
+        return [(None, None)]
+
+    # Sorted by the server, which compares _ids of different types too
+    pipeline = [
+        {"$sample": {"size": partitions * samples_per_partition}},
+        {"$project": {"_id": 1}},
+        {"$sort": {"_id": 1}},
+    ]
+    ids = []
+    for doc in collection.aggregate(pipeline):
+        if not ids or not _is_same_id(doc["_id"], ids[-1]):
+            ids.append(doc["_id"])
+
+    bounds = []
+    for i in range(1, partitions):
+        if not ids:
+            break
+        bound = ids[i * len(ids) // partitions]
+        if not bounds or not _is_same_id(bound, bounds[-1]):
+            bounds.append(bound)
+
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def _is_same_id(first: Any, second: Any) -> bool:
+    """Private function to compare two _ids, which are equal only with the same type."""
+    return get_type_order(first) == get_type_order(second) and first == second
+
+
+def after_filter(filter: Optional[dict], last_id: Any) -> dict:
+    """
+    Restrict a filter to the documents after an _id, in BSON order. Used to resume
+    an iteration sorted by _id after its last batch.
+    Args:
+        filter: The filter of the documents. None for every document.
+        last_id: The exclusive lower bound. None if unbounded.
+    Returns:
+        The filter of the documents after last_id, including those whose _id has
+        a later type.
+    """
+    if last_id is None:
+        return filter or {}
+    # $gt only matches the type of last_id, so the later types are added
+    clauses = [{"_id": {"$gt": last_id}}] + [
+        {"_id": {"$type": BSON_TYPE_ORDER[order][0]}}
+        for order in range(get_type_order(last_id) + 1, len(BSON_TYPE_ORDER))
+    ]
+    id_filter = {"$or": clauses}
+    if not filter:
+        return id_filter
+    return {"$and": [filter, id_filter]}
+
+
+def range_filter(filter: Optional[dict], lower: Any, upper: Any) -> dict:
+    """
+    Restrict a filter to an _id range returned by partition.
+    Args:
+        filter: The filter of the documents. None for every document.
+        lower: The inclusive lower bound. None if unbounded.
+        upper: The exclusive upper bound. None if unbounded.
+    Returns:
+        The filter of the documents of the range.
+    """
+    first = get_type_order(lower) if lower is not None else -1
+    last = get_type_order(upper) if upper is not None else len(BSON_TYPE_ORDER)
+    if first == last:
+        id_filter = {"_id": {"$gte": lower, "$lt": upper}}
+    else:
+        # The rest of the type of each bound, and every type between them
+        clauses = [
+            {"_id": {"$type": BSON_TYPE_ORDER[order][0]}}
+            for order in range(first + 1, last)
+        ]
+        if lower is not None:
+            clauses.insert(0, {"_id": {"$gte": lower}})
+        if upper is not None:
+            clauses.append({"_id": {"$lt": upper}})
+        id_filter = {"$or": clauses} if lower is not None or upper is not None else {}
+
+    if not id_filter:
+        return filter or {}
+    if not filter:
+        return id_filter
+    return {"$and": [filter, id_filter]}
@@ -0,0 +1,536 @@
+"""
+Command-level instrumentation of the migrations.
+
+Every pooled client is created with a pymongo CommandListener (see db_utils). While
+a migration runs inside collect(), the commands it sends are aggregated per command
+name: count, bytes sent and received, total, p50 and p99 latency, plus the slowest
+commands with their filters. The documents matched and modified by the replies of
+the update commands are counted per collection, so the writes of plain pymongo
+calls are counted as well as those of the ops helpers. Commands sent outside
+collect() are ignored.
+
+The command events of the driver do not carry their size, and encoding every
+command and reply again would cost as much as sending it. Only one command of each
+name out of BYTES_SAMPLE_INTERVAL (and its reply) is measured, and the bytes are
+extrapolated to the other commands. Likewise, the latencies are kept in a bounded
+random sample (see Reservoir), so the p50 and p99 are estimated once a command name
+is sent more than RESERVOIR_SIZE times.
+
+The sizes chosen by the adaptive batches of the ops helpers are collected too
+(see record_batch_size), to tune their target latency.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+import bson
+from bson import json_util
+from pymongo import monitoring
+
+DEFAULT_TOP_N = 5
+# One command of each name out of this number is measured (see the module docstring)
+BYTES_SAMPLE_INTERVAL = 16
+# Number of latencies kept for each command name
+RESERVOIR_SIZE = 1024
+# Maximum length of the filters kept for the slowest commands
+MAX_FILTER_LENGTH = 200
+
+# Collector of the migration running in the current context
+_current_collector: ContextVar[Optional["CommandCollector"]] = ContextVar(
+    "current_collector", default=None
+)
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    """
+    Private function to get a percentile of sorted values (nearest rank).
+    """
+    if not values:
+        return 0.0
+    index = max(0, int(round(percentile / 100 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _bson_size(document: Any) -> int:
+    """Private function to get the size of a document sent or received."""
+    try:
+        return len(bson.encode(document))
+    except Exception:
+        return 0
+
+
+def get_command_filter(command_name: str, command: dict) -> Optional[dict]:
+    """
+    Get the filter of a command.
+    Args:
+        command_name: The name of the command.
+        command: The command document.
+    Returns:
+        The filter of the command, or None if it has no filter.
+    """
+    if command_name in ("find", "count", "distinct", "findAndModify"):
+        return command.get("filter", command.get("query"))
+    if command_name == "update" and command.get("updates"):
+        return command["updates"][0].get("q")
+    if command_name == "delete" and command.get("deletes"):
+        return command["deletes"][0].get("q")
+    if command_name == "aggregate":
+        for stage in command.get("pipeline", []):
+            if "$match" in stage:
+                return stage["$match"]
+    return None
+
+
+class Reservoir:
+    """
+    Uniform random sample of a bounded size of the values added to it (Algorithm R).
+    """
+
+    def __init__(self, size: int = RESERVOIR_SIZE):
+        """
+        Create the reservoir.
+        Args:
+            size: The maximum number of values kept.
+        """
+        self.size = size
+        self.seen = 0
+        self.values: List[float] = []
+
+    def add(self, value: float):
+        """
+        Add a value, which replaces a kept one at random once the reservoir is full.
+        Args:
+            value: The value.
+        """
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+            return
+        index = random.randrange(self.seen)
+        if index < self.size:
+            self.values[index] = value
+
+    def merge(self, other: "Reservoir"):
+        """
+        Add the values of another reservoir, each kept value weighted by the number
+        of values it stands for (weighted sampling of Efraimidis and Spirakis).
+        Args:
+            other: The reservoir to add.
+        """
+        if len(self.values) + len(other.values) <= self.size:
+            self.values.extend(other.values)
+        else:
+            keyed = [
+                (random.random() ** (len(reservoir.values) / reservoir.seen), value)
+                for reservoir in (self, other)
+                for value in reservoir.values
+            ]
+            self.values = [value for _, value in heapq.nlargest(self.size, keyed)]
+        self.seen += other.seen
+
+
+class CommandStats:
+    """Aggregated stats of a command name"""
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        # Number of commands whose size was measured, and their measured bytes
+        self.sampled = 0
+        self.sampled_bytes_sent = 0
+        self.sampled_bytes_received = 0
+        self.total_ms = 0.0
+        self.durations_ms = Reservoir()
+
+    def _extrapolate(self, sampled_bytes: int) -> int:
+        """Private method to estimate the bytes of every command from the sample."""
+        if not self.sampled:
+            return 0
+        return round(sampled_bytes * self.count / self.sampled)
+
+    @property
+    def bytes_sent(self) -> int:
+        """The estimated size of the commands."""
+        return self._extrapolate(self.sampled_bytes_sent)
+
+    @property
+    def bytes_received(self) -> int:
+        """The estimated size of the replies."""
+        return self._extrapolate(self.sampled_bytes_received)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Summarize the stats.
+        Returns:
+            The count, failures, bytes and latencies of the commands.
+        """
+        durations = sorted(self.durations_ms.values)
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "total_ms": round(self.total_ms, 3),
+            "p50_ms": round(_percentile(durations, 50), 3),
+            "p99_ms": round(_percentile(durations, 99), 3),
+        }
+
+
+class CommandCollector:
+    """
+    Aggregates the commands sent while a migration runs.
+    """
+
+    def __init__(self, top_n: int = DEFAULT_TOP_N):
+        """
+        Create the collector.
+        Args:
+            top_n: The number of slowest commands to keep.
+        """
+        self.top_n = top_n
+        self.stats: Dict[str, CommandStats] = {}
+        self.batch_sizes: List[int] = []
+        # Documents matched and modified by the update commands, by collection
+        self.writes: Dict[str, Dict[str, int]] = {}
+        self._slowest: List[tuple] = []
+        self._counter = itertools.count()
+        # Number of started commands of each name, to sample their sizes
+        self._started: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def should_measure(self, command_name: str) -> bool:
+        """
+        Count a started command and tell whether its size should be measured.
+        Args:
+            command_name: The name of the command.
+        Returns:
+            True for the first command of each name out of BYTES_SAMPLE_INTERVAL.
+        """
+        with self._lock:
+            started = self._started.get(command_name, 0)
+            self._started[command_name] = started + 1
+        return started % BYTES_SAMPLE_INTERVAL == 0
+
+    def add(
+        self,
+        command_name: str,
+        duration_ms: float,
+        bytes_sent: int = None,
+        bytes_received: int = None,
+        collection: str = None,
+        filter: dict = None,
+        failed: bool = False,
+    ):
+        """
+        Add a finished command.
+        Args:
+            command_name: The name of the command.
+            duration_ms: The latency of the command in milliseconds.
+            bytes_sent: The size of the command. None if it was not measured.
+            bytes_received: The size of the reply. None if it was not measured.
+            collection: The collection of the command, if any.
+            filter: The filter of the command, if any.
+            failed: Whether the command failed.
+        """
+        with self._lock:
+            stats = self.stats.setdefault(command_name, CommandStats())
+            stats.count += 1
+            stats.failures += int(failed)
+            if bytes_sent is not None:
+                stats.sampled += 1
+                stats.sampled_bytes_sent += bytes_sent
+                stats.sampled_bytes_received += bytes_received or 0
+            stats.total_ms += duration_ms
+            stats.durations_ms.add(duration_ms)
+
+            self._add_slowest(duration_ms, command_name, collection, filter)
+
+    def add_writes(self, collection: str, matched: int, modified: int):
+        """
+        Add the documents matched and modified by an update command.
+        Args:
+            collection: The collection of the command.
+            matched: The documents matched ('n' of the reply).
+            modified: The documents modified ('nModified' of the reply).
+        """
+        with self._lock:
+            self._add_writes(collection, matched, modified)
+
+    def _add_writes(self, collection: str, matched: int, modified: int):
+        """
+        Private method to add the documents written to a collection.
+        Must be called with the lock held.
+        """
+        writes = self.writes.setdefault(collection, {"matched": 0, "modified": 0})
+        writes["matched"] += matched
+        writes["modified"] += modified
+
+    def _add_slowest(
+        self, duration_ms: float, command_name: str, collection: str, filter: dict
+    ):
+        """
+        Private method to keep a command if it is one of the slowest.
+        Must be called with the lock held.
+        """
+        slow = (duration_ms, next(self._counter), command_name, collection, filter)
+        if len(self._slowest) < self.top_n:
+            heapq.heappush(self._slowest, slow)
+        elif duration_ms > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, slow)
+
+    def merge(self, other: "CommandCollector"):
+        """
+        Add the commands of another collector (e.g. of a migration run in a
+        subprocess).
+        Args:
+            other: The collector to add.
+        """
+        with self._lock:
+            for command_name, other_stats in other.stats.items():
+                stats = self.stats.setdefault(command_name, CommandStats())
+                stats.count += other_stats.count
+                stats.failures += other_stats.failures
+                stats.sampled += other_stats.sampled
+                stats.sampled_bytes_sent += other_stats.sampled_bytes_sent
+                stats.sampled_bytes_received += other_stats.sampled_bytes_received
+                stats.total_ms += other_stats.total_ms
+                stats.durations_ms.merge(other_stats.durations_ms)
+            self.batch_sizes.extend(other.batch_sizes)
+            for collection, writes in other.writes.items():
+                self._add_writes(collection, writes["matched"], writes["modified"])
+            for duration_ms, _, command_name, collection, filter in other._slowest:
+                self._add_slowest(duration_ms, command_name, collection, filter)
+
+    def __getstate__(self) -> dict:
+        """Pickle the collector without its lock and counter."""
+        state = self.__dict__.copy()
+        del state["_lock"], state["_counter"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._counter = itertools.count(
+            max((s[1] for s in self._slowest), default=0) + 1
+        )
+        self._lock = threading.Lock()
+
+    def add_batch_size(self, size: int):
+        """
+        Add the size of a batch chosen by an adaptive helper.
+        Args:
+            size: The number of requests of the batch.
+        """
+        with self._lock:
+            self.batch_sizes.append(size)
+
+    def get_batch_sizes(self) -> Optional[Dict[str, Any]]:
+        """
+        Summarize the sizes of the adaptive batches.
+        Returns:
+            The number of batches, the min, p50, max and last sizes, or None if no
+            adaptive batch was sent.
+        """
+        if not self.batch_sizes:
+            return None
+        sizes = sorted(self.batch_sizes)
+        return {
+            "batches": len(sizes),
+            "min": sizes[0],
+            "p50": _percentile(sizes, 50),
+            "max": sizes[-1],
+            "last": self.batch_sizes[-1],
+        }
+
+    @property
+    def round_trips(self) -> int:
+        """The number of commands sent."""
+        return sum(stats.count for stats in self.stats.values())
+
+    def get_slowest(self) -> List[Dict[str, Any]]:
+        """
+        Get the slowest commands.
+        Returns:
+            The slowest commands, from slowest to fastest.
+        """
+        slowest = []
+        for duration_ms, _, command_name, collection, filter in sorted(
+            self._slowest, reverse=True
+        ):
+            if filter is not None:
+                filter = json_util.dumps(filter)[:MAX_FILTER_LENGTH]
+            slowest.append(
+                {
+                    "command": command_name,
+                    "collection": collection,
+                    "duration_ms": round(duration_ms, 3),
+                    "filter": filter,
+                }
+            )
+        return slowest
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Summarize the commands, to be stored in the ledger.
+        Returns:
+            The totals, the stats of each command name, the slowest commands and
+            the documents written to each collection.
+        """
+        return {
+            "round_trips": self.round_trips,
+            "bytes_sent": sum(stats.bytes_sent for stats in self.stats.values()),
+            "bytes_received": sum(
+                stats.bytes_received for stats in self.stats.values()
+            ),
+            "total_ms": round(sum(stats.total_ms for stats in self.stats.values()), 3),
+            "by_command": {
+                name: stats.to_dict() for name, stats in sorted(self.stats.items())
+            },
+            "slowest": self.get_slowest(),
+            "batch_sizes": self.get_batch_sizes(),
+            "writes": {
+                collection: dict(writes)
+                for collection, writes in sorted(self.writes.items())
+            },
+        }
+
+    def format_report(self) -> str:
+        """
+        Format the summary of the commands for humans.
+        Returns:
+            The report, one line per command name and per slow command.
+        """
+        summary = self.to_dict()
+        lines = [
+            f"[+] Commands: {summary['round_trips']} round trips, "
+            f"~{summary['bytes_sent']} bytes sent, "
+            f"~{summary['bytes_received']} bytes received, "
+            f"{summary['total_ms']:.1f}ms"
+        ]
+        by_count = sorted(
+            summary["by_command"].items(), key=lambda item: -item[1]["count"]
+        )
+        for name, stats in by_count:
+            failures = f" ({stats['failures']} failed)" if stats["failures"] else ""
+            lines.append(
+                f"    {name:<15} {stats['count']:>8} calls{failures} | "
+                f"p50 {stats['p50_ms']:.1f}ms | p99 {stats['p99_ms']:.1f}ms | "
+                f"total {stats['total_ms']:.1f}ms"
+            )
+        batch_sizes = summary["batch_sizes"]
+        if batch_sizes:
+            lines.append(
+                f"    Adaptive batches: {batch_sizes['batches']} | "
+                f"min {batch_sizes['min']} | p50 {batch_sizes['p50']} | "
+                f"max {batch_sizes['max']} | last {batch_sizes['last']}"
+            )
+        if summary["slowest"]:
+            lines.append("    Slowest commands:")
+        for command in summary["slowest"]:
+            target = f" {command['collection']}" if command["collection"] else ""
+            filter = f" {command['filter']}" if command["filter"] else ""
+            lines.append(
+                f"    {command['duration_ms']:>10.1f}ms "
+                f"{command['command']}{target}{filter}"
+            )
+        return "\n".join(lines)
+
+
+class CommandInstrumentation(monitoring.CommandListener):
+    """
+    Listener of the commands of the pooled clients.
+    Commands are added to the collector of the context that sent them, if any.
+    """
+
+    def __init__(self):
+        # Started commands by request and connection, until they finish
+        self._started: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(event) -> tuple:
+        return (event.request_id, event.connection_id, event.operation_id)
+
+    def started(self, event):
+        collector = _current_collector.get()
+        if collector is None:
+            return
+        command = event.command
+        target = command.get(event.command_name)
+        collection = target if isinstance(target, str) else None
+        measured = collector.should_measure(event.command_name)
+        with self._lock:
+            self._started[self._key(event)] = (
+                collector,
+                _bson_size(command) if measured else None,
+                collection,
+                get_command_filter(event.command_name, command),
+            )
+
+    def _finish(self, event, reply: Any = None, failed: bool = False):
+        with self._lock:
+            started = self._started.pop(self._key(event), None)
+        if started is None:
+            return
+        collector, bytes_sent, collection, filter = started
+        if event.command_name == "update" and reply and collection and not failed:
+            collector.add_writes(
+                collection, reply.get("n", 0), reply.get("nModified", 0)
+            )
+        # The reply is measured along with its command
+        bytes_received = None
+        if bytes_sent is not None:
+            bytes_received = _bson_size(reply) if reply is not None else 0
+        collector.add(
+            event.command_name,
+            event.duration_micros / 1000,
+            bytes_sent,
+            bytes_received,
+            collection,
+            filter,
+            failed,
+        )
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+# Listener registered in every pooled client
+listener = CommandInstrumentation()
+
+
+def record_batch_size(size: int):
+    """
+    Record the size of an adaptive batch in the collector of the current context,
+    if any.
+    Args:
+        size: The number of requests of the batch.
+    """
+    collector = _current_collector.get()
+    if collector is not None:
+        collector.add_batch_size(size)
+
+
+@contextmanager
+def collect(top_n: int = DEFAULT_TOP_N) -> Iterator[CommandCollector]:
+    """
+    Collect the commands sent in the current context by the pooled clients.
+    Args:
+        top_n: The number of slowest commands to keep.
+    Yields:
+        The collector.
+    """
+    collector = CommandCollector(top_n)
+    token = _current_collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _current_collector.reset(token)
@@ -0,0 +1,225 @@
+"""
+Disposable namespaces of the executed migrations.
+
+Each migration is executed in a new module with a unique name, registered in
+sys.modules only while it is loaded, so the classes and functions it defines can
+be pickled or inspected like those of any module. Once the migration returns, the
+module is removed from sys.modules and its globals are cleared, releasing what the
+migration defined.
+
+The modules imported by a migration (e.g. pandas) stay imported, since unloading
+them is not safe. Run each migration in a subprocess to release them too (see
+run_in_subprocess and the --isolate option of the upgrade and downgrade commands).
+"""
+
+import contextlib
+import importlib.util
+import itertools
+import marshal
+import multiprocessing
+import os
+import re
+import sys
+import types
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+from pymongo.database import Database
+
+from mongo_migrator import instrumentation, ops, profiling, progress
+from mongo_migrator.db_utils import get_client, get_connection_params
+
+MODULE_PREFIX = "mongo_migrator_migration_"
+NON_IDENTIFIER = re.compile(r"\W")
+
+_counter = itertools.count()
+
+
+def get_module_name(file_path: str = None) -> str:
+    """
+    Get a unique module name for a migration.
+    Args:
+        file_path: The migration file.
+    Returns:
+        The prefix, the name of the file as an identifier and a counter
+        (e.g. 'mongo_migrator_migration_1_add_users_0').
+    """
+    base = os.path.splitext(os.path.basename(file_path or "migration"))[0]
+    return f"{MODULE_PREFIX}{NON_IDENTIFIER.sub('_', base)}_{next(_counter)}"
+
+
+def load_module(
+    file_path: str = None, code: bytes = None, source: str = None
+) -> types.ModuleType:
+    """
+    Execute a migration in a new module, registered in sys.modules.
+    Args:
+        file_path: The migration file.
+        code: The marshalled code of the migration (see bundle.py). If set, it is
+            executed instead of the file.
+        source: The source of the migration (e.g. of a declarative migration). If
+            set, it is executed instead of the file.
+    Raises:
+        Exception: Any error raised by the migration module. The module is released.
+    Returns:
+        The module. Release it with release_module.
+    """
+    name = get_module_name(file_path)
+    spec = None
+    if code is None and source is None:
+        spec = importlib.util.spec_from_file_location(name, file_path)
+        module = importlib.util.module_from_spec(spec)
+    else:
+        module = types.ModuleType(name)
+        module.__file__ = file_path
+        if code is not None:
+            # Allows worker processes to load the migration too (see ops)
+            module.__migration_code__ = code
+
+    # Registered before it is executed, like an imported module
+    sys.modules[name] = module
+    try:
+        if spec is not None:
+            spec.loader.exec_module(module)
+        elif code is not None:
+            exec(marshal.loads(code), module.__dict__)
+        else:
+            exec(compile(source, file_path or "<migration>", "exec"), module.__dict__)
+    except BaseException:
+        release_module(module)
+        raise
+    return module
+
+
+def release_module(module: types.ModuleType):
+    """
+    Remove a migration module from sys.modules and clear its globals.
+    Clearing them breaks the cycles between the functions and the module, so what
+    the migration defined is released without waiting for the garbage collector.
+    Args:
+        module: The module returned by load_module.
+    """
+    if sys.modules.get(module.__name__) is module:
+        del sys.modules[module.__name__]
+    module.__dict__.clear()
+
+
+@contextlib.contextmanager
+def loaded_module(
+    file_path: str = None, code: bytes = None, source: str = None
+) -> Iterator[types.ModuleType]:
+    """
+    Load a migration module (see load_module) and release it on exit.
+    Args:
+        file_path: The migration file.
+        code: The marshalled code of the migration.
+        source: The source of the migration.
+    Yields:
+        The module.
+    """
+    module = load_module(file_path, code, source)
+    try:
+        yield module
+    finally:
+        release_module(module)
+
+
+def execute_migration(
+    db: Database,
+    migration,
+    direction: str,
+    reporter: progress.ProgressReporter = None,
+    profile_options: dict = None,
+):
+    """
+    Run the upgrade or downgrade of a migration with its context, profiled with the
+    given options of profiling.profile (if any).
+    Args:
+        db: The database.
+        migration: The migration node.
+        direction: 'upgrade' or 'downgrade'.
+        reporter: The reporter of the progress of the migration.
+        profile_options: The options of profiling.profile.
+    Raises:
+        Exception: If the migration fails.
+    """
+    ctx = progress.MigrationContext(migration, direction, reporter)
+    profile = profiling.profile(
+        f"{migration.version}_{direction}", **(profile_options or {})
+    )
+    with ctx, profile:
+        if direction == "upgrade":
+            migration.upgrade(db, ctx)
+        else:
+            migration.downgrade(db, ctx)
+
+
+def _run_isolated_migration(task: dict) -> tuple:
+    """
+    Private function to run a migration in the subprocess of run_in_subprocess.
+    It opens its own pooled client with the connection details of the parent.
+    Returns:
+        The results tracked by the ops helpers and the collected commands.
+    """
+    ops.configure(**task["ops"])
+    db = get_client(**task["connection"])[task["db_name"]]
+    reporter = progress.ProgressReporter(json_lines=task["json_lines"])
+    results = ops.track_results()
+    try:
+        with instrumentation.collect() as commands:
+            execute_migration(
+                db,
+                task["migration"],
+                task["direction"],
+                reporter,
+                task["profile_options"],
+            )
+    finally:
+        ops.stop_tracking()
+    return results, commands
+
+
+def run_in_subprocess(
+    db: Database,
+    migration,
+    direction: str,
+    commands: instrumentation.CommandCollector,
+    reporter: progress.ProgressReporter = None,
+    profile_options: dict = None,
+):
+    """
+    Run a migration in a new process (see execute_migration), so the modules it
+    imports are released when it finishes. Its ops results and its commands are
+    added to those of the current process.
+    Args:
+        db: The database, connected with get_db.
+        migration: The migration node.
+        direction: 'upgrade' or 'downgrade'.
+        commands: The collector the commands of the migration are added to.
+        reporter: The reporter of the progress of the migration.
+        profile_options: The options of profiling.profile.
+    Raises:
+        ValueError: If the database was not connected with get_db.
+        Exception: If the migration fails.
+    """
+    connection = get_connection_params(db.client)
+    if connection is None:
+        raise ValueError("Isolated migrations need a database connected with get_db.")
+    task = {
+        "migration": migration,
+        "direction": direction,
+        "connection": connection,
+        "db_name": db.name,
+        "ops": ops.get_configuration(),
+        "json_lines": bool(reporter and reporter.json_lines),
+        "profile_options": profile_options,
+    }
+    sys.stdout.flush()
+    # Spawned, so the process starts without the modules of previous migrations
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        results, collected = pool.submit(_run_isolated_migration, task).result()
+    for result in results:
+        ops.track(result)
+    commands.merge(collected)
@@ -0,0 +1,209 @@
+"""
+Ledger of the migrations run on a database.
+
+Each upgrade or downgrade of a migration is recorded in a collection named after
+the version collection ('<collection>_ledger'), with its timings, the documents
+it touched, the host and the outcome.
+
+The documents matched and modified are taken from the replies of the update
+commands the migration sent (see instrumentation), so plain pymongo writes are
+counted too. Without them (e.g. a client without the command listener), they are
+taken from the results of the ops helpers, or left as None if no helper ran.
+"""
+
+import socket
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.database import Database
+
+from mongo_migrator import ops
+from mongo_migrator.migration_history import MigrationNode
+
+UPGRADE = "upgrade"
+DOWNGRADE = "downgrade"
+
+APPLIED = "applied"
+REVERTED = "reverted"
+FAILED = "failed"
+
+# Indexes of the ledger collection
+INDEXES = (
+    [("version", ASCENDING), ("started_at", DESCENDING)],
+    [("started_at", DESCENDING)],
+)
+
+
+def get_collection_name(mm_collection: str) -> str:
+    """
+    Get the name of the ledger collection.
+    Args:
+        mm_collection: The name of the version collection.
+    Returns:
+        The name of the ledger collection.
+    """
+    return f"{mm_collection}_ledger"
+
+
+def build_entry(
+    migration: MigrationNode,
+    direction: str,
+    started_at: datetime,
+    ended_at: datetime,
+    results: List[ops.BulkResult] = None,
+    error: str = None,
+    commands: Dict[str, Any] = None,
+) -> Dict[str, Any]:
+    """
+    Build the entry of a run of a migration (see Ledger.record).
+    Returns:
+        The entry.
+    """
+    results = results or []
+    # The checkpoints of the resumable helpers are not documents of the migration
+    writes = {
+        collection: counts
+        for collection, counts in ((commands or {}).get("writes") or {}).items()
+        if collection != ops.get_progress_collection_name()
+    }
+    if writes:
+        docs_matched = sum(counts["matched"] for counts in writes.values())
+        docs_modified = sum(counts["modified"] for counts in writes.values())
+    elif results:
+        docs_matched = sum(result.matched for result in results)
+        docs_modified = sum(result.modified for result in results)
+    else:
+        docs_matched = docs_modified = None
+    if error:
+        outcome = FAILED
+    else:
+        outcome = APPLIED if direction == UPGRADE else REVERTED
+    return {
+        "version": migration.version,
+        "title": migration.title,
+        "direction": direction,
+        "outcome": outcome,
+        "started_at": started_at,
+        "ended_at": ended_at,
+        "duration": (ended_at - started_at).total_seconds(),
+        "collections": sorted(
+            {result.collection_name for result in results} | set(writes)
+        ),
+        "docs_processed": sum(result.processed for result in results),
+        "docs_matched": docs_matched,
+        "docs_modified": docs_modified,
+        "host": socket.gethostname(),
+        "error": error,
+        "commands": commands,
+    }
+
+
+class Ledger:
+    """
+    Records of the migrations run on a database.
+    """
+
+    def __init__(self, db: Database, mm_collection: str):
+        """
+        Create the ledger.
+        Args:
+            db: The database where the ledger is stored.
+            mm_collection: The name of the version collection.
+        """
+        self.collection = db[get_collection_name(mm_collection)]
+        self._indexed = False
+
+    def _ensure_indexes(self):
+        """Private method to create the indexes of the ledger once."""
+        if self._indexed:
+            return
+        for keys in INDEXES:
+            self.collection.create_index(keys)
+        self._indexed = True
+
+    def record(
+        self,
+        migration: MigrationNode,
+        direction: str,
+        started_at: datetime,
+        ended_at: datetime,
+        results: List[ops.BulkResult] = None,
+        error: str = None,
+        commands: Dict[str, Any] = None,
+    ) -> Dict[str, Any]:
+        """
+        Record a run of a migration.
+        Args:
+            migration: The migration.
+            direction: UPGRADE or DOWNGRADE.
+            started_at: When the run started.
+            ended_at: When the run ended.
+            results: The results of the ops helpers run by the migration.
+            error: The error that stopped the migration, if it failed.
+            commands: The summary of the commands sent by the migration
+                (see instrumentation.CommandCollector.to_dict).
+        Returns:
+            The recorded entry.
+        """
+        self._ensure_indexes()
+        entry = build_entry(
+            migration, direction, started_at, ended_at, results, error, commands
+        )
+        self.collection.insert_one(entry)
+        return entry
+
+    def get_entries(self, version: str = None, limit: int = None) -> List[Dict]:
+        """
+        Get the recorded runs, from newest to oldest.
+        Args:
+            version: If set, only the runs of this migration.
+            limit: The maximum number of runs. All by default.
+        Returns:
+            The entries of the ledger.
+        """
+        query = {"version": version} if version else {}
+        # Runs started in the same millisecond are sorted by insertion
+        cursor = self.collection.find(query).sort(
+            [("started_at", DESCENDING), ("_id", DESCENDING)]
+        )
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    @staticmethod
+    def format_entry(entry: Dict[str, Any]) -> str:
+        """
+        Format an entry of the ledger in one line.
+        Args:
+            entry: The entry.
+        Returns:
+            The formatted entry.
+        """
+        started_at = entry["started_at"].strftime("%Y-%m-%d %H:%M:%S")
+        line = (
+            f"{started_at} {entry['direction'].upper():<9} "
+            f"{entry['version']} - {entry['title']} | "
+            f"{entry['outcome'].upper()} in {entry['duration']:.1f}s | "
+            f"{_format_count(entry['docs_matched'])} matched, "
+            f"{_format_count(entry['docs_modified'])} modified | "
+            f"{entry['host']}"
+        )
+        if entry.get("error"):
+            line += f" | {entry['error']}"
+        return line
+
+
+def _format_count(count: Optional[int]) -> str:
+    """Private function to format a counter of the ledger, which may be unknown."""
+    return "?" if count is None else str(count)
+
+
+def now() -> datetime:
+    """
+    Get the current time to record in the ledger.
+    Returns:
+        The current time in UTC.
+    """
+    return datetime.now(timezone.utc)
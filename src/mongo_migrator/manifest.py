@@ -0,0 +1,169 @@
+"""
+This module handles the manifest cache of a migrations directory.
+
+The manifest stores the parsed header of every migration file, keyed by the
+file name, its modification time and its size. While a file does not change,
+its header is taken from the manifest instead of reading and parsing the file.
+
+It also stores the last version of the history, so it can be known without
+loading the history while no migration file is added, removed, renamed or changed.
+"""
+
+import json
+import os
+
+from typing import Dict, Iterable, Optional
+
+
+class Manifest:
+    """Class to handle the manifest cache file of a migrations directory"""
+
+    FILE_NAME = ".mongo-migrator.manifest"
+    FORMAT_VERSION = 1
+
+    def __init__(self, migrations_dir: str):
+        """
+        Load the manifest of a migrations directory.
+        A missing, unreadable or outdated manifest is treated as an empty one.
+        Args:
+            migrations_dir: The directory where the migrations are stored.
+        Attributes:
+            path: The path to the manifest file.
+            entries: The cached headers by file name.
+            last_version: The last version of the history. None if it is not valid.
+            changed: Whether the entries differ from the ones in the file.
+        """
+        self.path = os.path.join(migrations_dir, self.FILE_NAME)
+        self.entries: Dict[str, dict] = {}
+        self.last_version: Optional[str] = None
+        self.changed = False
+        self._load()
+
+    def _load(self):
+        """
+        Private method to read the manifest file.
+        """
+        try:
+            with open(self.path, "r") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(content, dict):
+            return
+        if content.get("format") != self.FORMAT_VERSION:
+            return
+        self.entries = content.get("entries", {})
+        self.last_version = content.get("last_version")
+
+    def is_current(self, file_names: Iterable[str]) -> bool:
+        """
+        Check if the manifest covers exactly the given migration files, unchanged
+        since they were cached (see get). Each file is stat'ed, but not read.
+        Args:
+            file_names: The names of the existing migration files.
+        Raises:
+            OSError: If a migration file cannot be stat'ed.
+        Returns:
+            True if the manifest has a current entry for each file and no other,
+            False otherwise.
+        """
+        file_names = set(file_names)
+        if not self.entries or file_names != set(self.entries):
+            return False
+        migrations_dir = os.path.dirname(self.path)
+        return all(
+            self.get(file_name, os.stat(os.path.join(migrations_dir, file_name)))
+            is not None
+            for file_name in file_names
+        )
+
+    def get(self, file_name: str, stat: os.stat_result) -> Optional[dict]:
+        """
+        Get the cached header of a migration file.
+        Args:
+            file_name: The name of the migration file.
+            stat: The current stat of the migration file.
+        Returns:
+            The cached header (title, version and last_version), or None if the
+            file is not cached or has changed since it was cached.
+        """
+        entry = self.entries.get(file_name)
+        if entry is None:
+            return None
+        if entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            return None
+        return entry
+
+    def set(
+        self,
+        file_name: str,
+        stat: os.stat_result,
+        title: str,
+        version: str,
+        last_version: str = None,
+    ):
+        """
+        Cache the header of a migration file.
+        Args:
+            file_name: The name of the migration file.
+            stat: The stat of the migration file when it was parsed.
+            title: The title of the migration.
+            version: The version of the migration.
+            last_version: The last version of the migration.
+        """
+        self.entries[file_name] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "title": title,
+            "version": version,
+            "last_version": last_version,
+        }
+        self.changed = True
+
+    def prune(self, file_names: Iterable[str]):
+        """
+        Remove the entries of the files that no longer exist.
+        Args:
+            file_names: The names of the existing migration files.
+        """
+        existing = set(file_names)
+        for file_name in list(self.entries):
+            if file_name not in existing:
+                del self.entries[file_name]
+                self.changed = True
+
+    def set_last_version(self, last_version: Optional[str]):
+        """
+        Set the last version of the history.
+        Args:
+            last_version: The last version. None if the history is not valid.
+        """
+        if last_version != self.last_version:
+            self.last_version = last_version
+            self.changed = True
+
+    def save(self):
+        """
+        Write the manifest file if any entry changed.
+        The file is replaced atomically. Errors writing it (e.g. a read-only
+        directory) are ignored, since the manifest is only a cache.
+        """
+        if not self.changed:
+            return
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                content = {
+                    "format": self.FORMAT_VERSION,
+                    "last_version": self.last_version,
+                    "entries": self.entries,
+                }
+                json.dump(content, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.changed = False
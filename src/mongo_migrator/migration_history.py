@@ -1,21 +1,75 @@
 """
 This module handles the history of migrations. It detects bifurcations.
 Also comes with functionality to validate the tree.
+
+Migrations are Python files, or declarative JSON files (see declarative.py).
 """
 
-import importlib.util
+import asyncio
+import inspect
 import os
 import re
-import importlib
+import sys
+import types
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo.database import Database
+
+from mongo_migrator import declarative, isolation
+from mongo_migrator.db_utils import get_async_client, get_connection_params
+from mongo_migrator.manifest import Manifest
 
-from typing import Dict, List
+HEADER_PATTERN = re.compile(
+    r"""
+    title:\s*(?P<title>.+)\n
+    version:\s*(?P<version>\d+)\n
+    last_version:\s*(?P<last_version>\d+|None)
+""",
+    re.VERBOSE,
+)
+HEADER_DELIMITER = '"""'
+MIGRATION_FILE_EXTENSIONS = (".py", declarative.FILE_EXTENSION)
+
+
+def is_migration_file(file_name: str) -> bool:
+    """
+    Check if a file of the migrations directory is a migration.
+    Args:
+        file_name: The name of the file.
+    Returns:
+        True if it is a Python or a declarative migration, False otherwise.
+    """
+    return file_name.endswith(MIGRATION_FILE_EXTENSIONS)
+
+
+class EmptyHistoryError(ValueError):
+    """The migration history has no migrations"""
+
+
+class InvalidHistoryError(ValueError):
+    """The migration history is not a linear tree"""
 
 
 class MigrationNode:
     """
     Represents a migration node in the migration history tree.
+    Nodes are slotted and only keep the header of the migration and a reference
+    to its file (or bundled code). The upgrade and downgrade functions are
+    resolved each time the migration runs, and the module is released after it.
     """
 
+    __slots__ = (
+        "title",
+        "version",
+        "last_version",
+        "children",
+        "file_path",
+        "code",
+        "_upgrade",
+        "_downgrade",
+    )
+
     def __init__(
         self,
         title: str,
@@ -23,6 +77,8 @@ class MigrationNode:
         last_version: str = None,
         upgrade: str = None,
         downgrade: str = None,
+        file_path: str = None,
+        code: bytes = None,
     ):
         """
         Create a new migration node.
@@ -32,11 +88,20 @@ class MigrationNode:
             last_version: The last version of the migration. None if it is the first migration.
             upgrade: The upgrade function of the migration.
             downgrade: The downgrade function of the migration.
+            file_path: The migration file. If set, the upgrade and downgrade functions
+                are imported from it when the migration runs.
+            code: The marshalled code of the migration file (see bundle.py). If set,
+                it is executed instead of importing the file.
         """
         self.title = title
-        self.version = version
-        self.last_version = last_version
-        self.children: List[MigrationNode] = []
+        # Interned, so the version of a node and the last_version of its child
+        # share the same string
+        self.version = sys.intern(version)
+        self.last_version = None if last_version is None else sys.intern(last_version)
+        # Shared empty tuple until the node gets a child
+        self.children: Tuple[MigrationNode, ...] = ()
+        self.file_path = file_path
+        self.code = code
         self._upgrade = upgrade
         self._downgrade = downgrade
 
@@ -46,30 +111,218 @@ class MigrationNode:
         Args:
             child_node: The child node to add.
         """
-        self.children.append(child_node)
+        self.children += (child_node,)
 
-    def upgrade(self, db):
+    def _load_module(self) -> types.ModuleType:
+        """
+        Private method to execute the migration in a new module (see isolation).
+        The module is not cached: it is loaded again each time the migration runs.
+        Returns:
+            The migration module. Release it with isolation.release_module.
+        """
+        source = None
+        if self.code is None and declarative.is_declarative(self.file_path):
+            source = declarative.to_source(self.file_path)
+        return isolation.load_module(self.file_path, self.code, source)
+
+    def _resolve(
+        self, name: str
+    ) -> Tuple[Optional[Callable], Optional[types.ModuleType]]:
+        """
+        Private method to resolve a migration function.
+        The functions given to the node are returned directly. Otherwise the module
+        is loaded, and must be released once the function returns.
+        Returns:
+            The function (None if the migration does not define it) and the loaded
+            module (None if no module was loaded).
+        """
+        function = self._upgrade if name == "upgrade" else self._downgrade
+        if function is None and (self.file_path is not None or self.code is not None):
+            module = self._load_module()
+            return getattr(module, name, None), module
+        return function, None
+
+    def _run(self, name: str, db, ctx=None):
+        """
+        Private method to resolve a migration function and call it.
+        Async functions run in a new event loop (see _call_with_async_client).
+        """
+        function, module = self._resolve(name)
+        try:
+            if inspect.iscoroutinefunction(function):
+                asyncio.run(self._call_with_async_client(function, db, ctx))
+            elif function is not None:
+                self._call(function, db, ctx)
+        finally:
+            if module is not None:
+                isolation.release_module(module)
+
+    async def _run_async(
+        self, name: str, db, ctx=None, get_sync_db: Callable[[], Database] = None
+    ):
+        """
+        Private method to resolve a migration function and run it without blocking
+        the event loop. Async functions are awaited with the asyncio database, the
+        others run in a worker thread with the database returned by get_sync_db.
+        """
+        function, module = self._resolve(name)
+        try:
+            if inspect.iscoroutinefunction(function):
+                await self._call(function, db, ctx)
+            elif function is not None:
+                if get_sync_db is None:
+                    raise ValueError(
+                        f"The {name} of {self} is synchronous and needs a database."
+                    )
+                await asyncio.to_thread(
+                    lambda: self._call(function, get_sync_db(), ctx)
+                )
+        finally:
+            if module is not None:
+                isolation.release_module(module)
+
+    @classmethod
+    async def _call_with_async_client(cls, function, db, ctx=None):
+        """
+        Private method to call an async migration function from synchronous code,
+        with an asyncio client connected like the client of the database.
+        Raises:
+            ValueError: If the database was not connected with get_db.
+        """
+        client = getattr(db, "client", None)
+        params = get_connection_params(client) if client is not None else None
+        if params is None:
+            raise ValueError("Async migrations need a database connected with get_db.")
+        async_client = await get_async_client(**params)
+        try:
+            await cls._call(function, async_client[db.name], ctx)
+        finally:
+            await async_client.close()
+
+    def __getstate__(self) -> dict:
+        """
+        Pickle the migration without its children (e.g. to run it in a subprocess),
+        so the history after it is not copied.
+        """
+        return {
+            name: getattr(self, name) for name in self.__slots__ if name != "children"
+        }
+
+    def __setstate__(self, state: dict):
+        self.children = ()
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @staticmethod
+    def _call(function, db, ctx=None):
+        """
+        Private method to call a migration function.
+        The context is only passed to functions that declare a ctx parameter, or a
+        second positional parameter without a default (e.g. not batch_size=1000).
+        Returns:
+            The result of the function (a coroutine for async functions).
+        """
+        try:
+            parameters = list(inspect.signature(function).parameters.values())
+        except (TypeError, ValueError):
+            parameters = []
+        kinds = inspect.Parameter
+        for parameter in parameters[1:]:
+            named = parameter.kind in (kinds.POSITIONAL_OR_KEYWORD, kinds.KEYWORD_ONLY)
+            if parameter.name == "ctx" and named:
+                return function(db, ctx=ctx)
+        positional = [
+            parameter
+            for parameter in parameters
+            if parameter.kind in (kinds.POSITIONAL_ONLY, kinds.POSITIONAL_OR_KEYWORD)
+        ]
+        if len(positional) >= 2 and positional[1].default is kinds.empty:
+            return function(db, ctx)
+        return function(db)
+
+    def upgrade(self, db, ctx=None):
         """
         Apply the upgrade function of the migration.
+        Async upgrade functions are run in a new event loop, with an asyncio client
+        connected like the client of the database.
         Args:
             db: The database to upgrade.
+            ctx: The context of the run (see progress.MigrationContext). Passed to
+                the upgrade function if it accepts it (see _call).
         """
-        if self._upgrade is not None:
-            self._upgrade(db)
+        self._run("upgrade", db, ctx)
 
-    def downgrade(self, db):
+    def downgrade(self, db, ctx=None):
         """
         Apply the downgrade function of the migration.
+        Async downgrade functions are run in a new event loop, with an asyncio
+        client connected like the client of the database.
         Args:
             db: The database to downgrade.
+            ctx: The context of the run (see progress.MigrationContext). Passed to
+                the downgrade function if it accepts it (see _call).
+        """
+        self._run("downgrade", db, ctx)
+
+    async def upgrade_async(
+        self, db, ctx=None, get_sync_db: Callable[[], Database] = None
+    ):
+        """
+        Apply the upgrade function of the migration without blocking the event loop.
+        Args:
+            db: The asyncio database (AsyncDatabase) to upgrade. Passed to async
+                upgrade functions.
+            ctx: The context of the run (see progress.MigrationContext). Passed to
+                the upgrade function if it accepts it (see _call).
+            get_sync_db: Returns the synchronous database passed to synchronous
+                upgrade functions, which run in a worker thread.
+        """
+        await self._run_async("upgrade", db, ctx, get_sync_db)
+
+    async def downgrade_async(
+        self, db, ctx=None, get_sync_db: Callable[[], Database] = None
+    ):
+        """
+        Apply the downgrade function of the migration without blocking the event
+        loop.
+        Args:
+            db: The asyncio database (AsyncDatabase) to downgrade. Passed to async
+                downgrade functions.
+            ctx: The context of the run (see progress.MigrationContext). Passed to
+                the downgrade function if it accepts it (see _call).
+            get_sync_db: Returns the synchronous database passed to synchronous
+                downgrade functions, which run in a worker thread.
         """
-        if self._downgrade is not None:
-            self._downgrade(db)
+        await self._run_async("downgrade", db, ctx, get_sync_db)
+
+    @staticmethod
+    def read_header(file_path: str) -> str:
+        """
+        Read the docstring header of a migration file.
+        Reading stops as soon as the docstring is closed, so the body of the
+        migration is neither read nor imported.
+        Args:
+            file_path: The path to the migration file.
+        Raises:
+            FileNotFoundError: If the file is not found.
+        Returns:
+            The header of the file (the whole file if no docstring is closed).
+        """
+        lines = []
+        delimiters = 0
+        with open(file_path, "r") as f:
+            for line in f:
+                lines.append(line)
+                delimiters += line.count(HEADER_DELIMITER)
+                if delimiters >= 2:
+                    break
+        return "".join(lines)
 
     @classmethod
     def from_file(cls, file_path: str) -> "MigrationNode":
         """
-        Parse a migration file and return the migration node.
+        Parse the header of a migration file and return the migration node.
+        The file is not imported until the migration is run.
         Args:
             file_path: The path to the migration file.
         Raises:
@@ -78,34 +331,27 @@ class MigrationNode:
         Returns:
             The migration node parsed from the file.
         """
-        pattern = re.compile(
-            r"""
-            title:\s*(?P<title>.+)\n
-            version:\s*(?P<version>\d+)\n
-            last_version:\s*(?P<last_version>\d+|None)
-        """,
-            re.VERBOSE,
-        )
+        if declarative.is_declarative(file_path):
+            # May raise FileNotFoundError or ValueError
+            spec = declarative.read_spec(file_path)
+            return cls(
+                spec["title"],
+                spec["version"],
+                spec.get("last_version"),
+                file_path=file_path,
+            )
 
         # May raise FileNotFoundError
-        with open(file_path, "r") as f:
-            content = f.read()
-            match = pattern.search(content)
-            if match is None:
-                raise ValueError(f"Invalid migration file format on {file_path}.")
-            title = match.group("title")
-            version = match.group("version")
-            last_version = match.group("last_version")
-            last_version = None if last_version == "None" else last_version
+        header = cls.read_header(file_path)
+        match = HEADER_PATTERN.search(header)
+        if match is None:
+            raise ValueError(f"Invalid migration file format on {file_path}.")
+        title = match.group("title")
+        version = match.group("version")
+        last_version = match.group("last_version")
+        last_version = None if last_version == "None" else last_version
 
-            spec = importlib.util.spec_from_file_location("migration_module", file_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-
-            upgrade = getattr(module, "upgrade", None)
-            downgrade = getattr(module, "downgrade", None)
-
-            return cls(title, version, last_version, upgrade, downgrade)
+        return cls(title, version, last_version, file_path=file_path)
 
     def __repr__(self):
         return (
@@ -119,11 +365,18 @@ class MigrationNode:
 
 class MigrationHistory:
 
-    def __init__(self, migrations_dir: str):
+    def __init__(self, migrations_dir: str, use_manifest: bool = True):
         """
         Class for managing the migration history.
+        The history is kept as a chain: the list of migrations from the first one,
+        following the first child of each, with the position of each version. It is
+        built with the tree, and rebuilt after the roots or the migrations are
+        reassigned or invalidate_chain is called.
         Args:
             migrations_dir: The directory where the migrations are stored.
+                If None, the history starts empty (see from_nodes).
+            use_manifest: Whether to use the manifest cache of the directory, so
+                only the migration files that changed since the last load are parsed.
         Attributes:
             migrations_dir: The directory where the migrations are stored.
             roots: The root nodes of the migration history.
@@ -135,36 +388,187 @@ class MigrationHistory:
         self.migrations_dir = migrations_dir
         self.roots: List[MigrationNode] = []
         self.migrations: Dict[str, MigrationNode] = {}
-        self._load_migrations()
+        if migrations_dir is not None:
+            self._load_migrations(use_manifest)
+
+    @property
+    def roots(self) -> List[MigrationNode]:
+        return self._roots
+
+    @roots.setter
+    def roots(self, roots: List[MigrationNode]):
+        self._roots = roots
+        self.invalidate_chain()
+
+    @property
+    def migrations(self) -> Dict[str, MigrationNode]:
+        return self._migrations
+
+    @migrations.setter
+    def migrations(self, migrations: Dict[str, MigrationNode]):
+        self._migrations = migrations
+        self.invalidate_chain()
+
+    def invalidate_chain(self):
+        """
+        Drop the chain of the history, so it is rebuilt when it is next used.
+        Must be called after changing the roots, the migrations or the children of
+        a node in place.
+        """
+        self._chain = None
+
+    def _build_chain(self):
+        """
+        Private method to build the chain of the history, without recursion.
+        The chain starts at the first root and follows the first child of each
+        migration. The history is valid if it has one root, no migration has
+        several children and every migration is in the chain.
+        """
+        chain: List[MigrationNode] = []
+        positions: Dict[str, int] = {}
+        valid = len(self._roots) == 1
+        node = self._roots[0] if self._roots else None
+        while node is not None and node.version not in positions:
+            positions[node.version] = len(chain)
+            chain.append(node)
+            if len(node.children) > 1:
+                valid = False
+            node = node.children[0] if node.children else None
+        if node is not None:
+            # A cycle of migrations
+            valid = False
+
+        self._chain = chain
+        self._positions = positions
+        self._valid = valid and bool(chain)
+
+    def _get_chain(self) -> List[MigrationNode]:
+        """
+        Private method to get the chain of the history, rebuilt if it was
+        invalidated.
+        Returns:
+            The migrations from the first one, following the first child of each.
+        """
+        if self._chain is None:
+            self._build_chain()
+        return self._chain
+
+    def get_position(self, version: str) -> Optional[int]:
+        """
+        Get the position of a version in the history.
+        Args:
+            version: The version.
+        Returns:
+            The position from the first migration (0), or None if the version is
+            not in the history.
+        """
+        self._get_chain()
+        return self._positions.get(version)
+
+    @classmethod
+    def from_nodes(cls, nodes: List[MigrationNode]) -> "MigrationHistory":
+        """
+        Build a migration history from already loaded migration nodes.
+        Args:
+            nodes: The migration nodes.
+        Returns:
+            The migration history.
+        """
+        history = cls(None)
+        for node in nodes:
+            history.migrations[node.version] = node
+        history._build_tree()
+        return history
 
-    def _load_migrations(self):
+    def _load_migrations(self, use_manifest: bool = True):
         """
         Private method to load all migrations from the migrations directory.
-        Migrations without a last version or without a found last_version are considered as roots.
+        Files cached in the manifest are not read unless they changed.
 
+        Args:
+            use_manifest: Whether to use the manifest cache of the directory.
         Raises:
             FileNotFoundError: If a migration file is not found.
             ValueError: If a migration file format is invalid.
         """
-        migration_files = [
-            f for f in os.listdir(self.migrations_dir) if f.endswith(".py")
-        ]
+        manifest = Manifest(self.migrations_dir) if use_manifest else None
+        migration_files = []
 
         # Load all migration files
-        for migration_file in migration_files:
-            file_path = os.path.join(self.migrations_dir, migration_file)
-            # May raise FileNotFoundError or ValueError
-            node = MigrationNode.from_file(file_path)
-            self.migrations[node.version] = node
-            if node:
+        with os.scandir(self.migrations_dir) as entries:
+            for entry in entries:
+                if not is_migration_file(entry.name):
+                    continue
+                migration_files.append(entry.name)
+                if manifest is None:
+                    # May raise FileNotFoundError or ValueError
+                    node = MigrationNode.from_file(entry.path)
+                else:
+                    node = self._load_cached_node(manifest, entry)
                 self.migrations[node.version] = node
 
-        # Build the tree
+        self._build_tree()
+
+        if manifest is not None:
+            manifest.prune(migration_files)
+            manifest.set_last_version(self._get_linear_last_version())
+            manifest.save()
+
+    def _get_linear_last_version(self) -> str:
+        """
+        Private method to get the last version only if the history is valid.
+        Returns:
+            The last version, or None if the history is empty or has bifurcations.
+        """
+        if len(self.roots) != 1:
+            return None
+
+        # Follows the chain up to the first bifurcation
+        for node in self._get_chain():
+            if len(node.children) != 1:
+                return None if node.children else node.version
+        return None
+
+    @staticmethod
+    def _load_cached_node(manifest: Manifest, entry: os.DirEntry) -> MigrationNode:
+        """
+        Private method to load a migration node using the manifest cache.
+        The file is parsed (and cached) only if it is not cached or has changed.
+        Args:
+            manifest: The manifest of the migrations directory.
+            entry: The directory entry of the migration file.
+        Raises:
+            FileNotFoundError: If the migration file is not found.
+            ValueError: If the migration file format is invalid.
+        Returns:
+            The migration node.
+        """
+        stat = entry.stat()
+        cached = manifest.get(entry.name, stat)
+        if cached is not None:
+            return MigrationNode(
+                cached["title"],
+                cached["version"],
+                cached["last_version"],
+                file_path=entry.path,
+            )
+
+        # May raise FileNotFoundError or ValueError
+        node = MigrationNode.from_file(entry.path)
+        manifest.set(entry.name, stat, node.title, node.version, node.last_version)
+        return node
+
+    def _build_tree(self):
+        """
+        Private method to link the loaded migrations into a tree, and build its chain.
+        Migrations without a last version or without a found last_version are considered as roots.
+        """
         for node in self.migrations.values():
             if all([node.last_version, node.last_version in self.migrations]):
                 self.migrations[node.last_version].add_child(node)
             else:
                 self.roots.append(node)
+        self._build_chain()
 
     def is_empty(self) -> bool:
         """
@@ -187,17 +591,18 @@ class MigrationHistory:
             return False
 
         if node is None:
-            # More than one root migration
-            if len(self.roots) > 1:
+            self._get_chain()
+            # One root, without bifurcations
+            return self._valid
+
+        seen = set()
+        while node is not None and node.version not in seen:
+            # More than one child for a migration
+            if len(node.children) > 1:
                 return False
-            node = self.roots[0]
-
-        # More than one child for a migration
-        if len(node.children) > 1:
-            return False
-
-        # Recursive check
-        return self.validate(node.children[0]) if node.children else True
+            seen.add(node.version)
+            node = node.children[0] if node.children else None
+        return node is None
 
     def get_first_version(self) -> str:
         """
@@ -233,10 +638,7 @@ class MigrationHistory:
         if self.is_empty():
             return None
 
-        current_node = self.roots[0]
-        while current_node.children:
-            current_node = current_node.children[0]
-        return current_node.version
+        return self._get_chain()[-1].version
 
     def get_last_node(self) -> MigrationNode:
         """
@@ -248,10 +650,7 @@ class MigrationHistory:
         if self.is_empty():
             return None
 
-        current_node = self.roots[0]
-        while current_node.children:
-            current_node = current_node.children[0]
-        return current_node
+        return self._get_chain()[-1]
 
     def _print_linear_tree(
         self,
@@ -261,35 +660,35 @@ class MigrationHistory:
         is_applied: bool = True,
     ):
         """
-        Print a linear tree of the migration history.
+        Print a linear tree of the migration history, from a node to the end of
+        its chain. Lines are written at once, without recursion.
         Args:
-            node: The node to print.
-            level: The level of the node in the tree.
-        """
-        is_current = current_version == node.version
-        current_found = True if is_current else current_found
-
-        # If this is the current version, it is applied
-        # Also, every following migration is not applied
-        connection = "└──" if not node.children else "├──"
-        if is_current:
-            state = "(CURRENT) "
-            connection += ">"
-        else:
-            state = " (APPLIED) " if is_applied else " (PENDING) "
-
-        print(f"{connection}{state}{node}")
+            node: The node to print from.
+            current_version: The current version of the database.
+            current_found: Whether the current version comes before the node.
+            is_applied: Whether the node is applied, if it is not the current one.
+        """
+        lines = []
+        while node is not None:
+            is_current = current_version == node.version
+            current_found = True if is_current else current_found
+
+            # If this is the current version, it is applied
+            # Also, every following migration is not applied
+            connection = "└──" if not node.children else "├──"
+            if is_current:
+                state = "(CURRENT) "
+                connection += ">"
+            else:
+                state = " (APPLIED) " if is_applied else " (PENDING) "
+            lines.append(f"{connection}{state}{node}")
 
-        if node.children:
             # All migrations before the current version are applied
-            if not current_found:
-                self._print_linear_tree(
-                    node.children[0], current_version, current_found, is_applied
-                )
-            else:
-                self._print_linear_tree(
-                    node.children[0], current_version, current_found, False
-                )
+            if current_found:
+                is_applied = False
+            node = node.children[0] if node.children else None
+
+        print("\n".join(lines))
 
     def print_history(self, current_version: str = None):
         """
@@ -320,32 +719,21 @@ class MigrationHistory:
         self, start_version: str = None, to_version: str = None
     ) -> List[MigrationNode]:
         """
-        Get a list of migrations.
+        Get a list of migrations, as a slice of the chain of the history.
         Assumes that the migration history is valid.
         Args:
             start_version: The version to start from. If None, the first version is used.
             to_version: The last version of the migration list. If None, the last version is used.
+        Raises:
+            KeyError: If the start version is not in the history.
         Returns:
             A list of migrations.
         """
-        start_version = self.roots[0].version if not start_version else start_version
-        to_version = self.get_last_version() if not to_version else to_version
-
-        migrations = []
-        version = start_version
-
-        while version != to_version:
-            # If the current version is not the target version, add the migration
-            current_node = self.migrations[version]
-            migrations.append(current_node)
-            # If the current version has a child, update the current version
-            if current_node.children:
-                child = current_node.children[0]
-                version = child.version
-            else:
-                break
-
-        if version == to_version:
-            migrations.append(self.migrations[to_version])
-
-        return migrations
+        chain = self._get_chain()
+        start = self._positions[start_version] if start_version else 0
+        end = self._positions.get(to_version) if to_version else len(chain) - 1
+        if end is None or end < start:
+            # The target is not after the start, every following migration is used
+            end = len(chain) - 1
+        stop = end + 1
+        return chain[start:stop]
@@ -3,8 +3,15 @@ This class handles the creation of migration files.
 
 The create_migration_file method creates a new migration file with a template.
 This template includes the title, version, and current version of the migration.
+
+Available templates:
+- default: Empty upgrade and downgrade functions.
+- bulk: Upgrade that transforms the documents of a collection with ops.bulk_update.
+- declarative: JSON migration with server-side field operations (see declarative.py).
 """
 
+import json
+
 
 class MigrationTemplate:
 
@@ -26,9 +33,73 @@ class MigrationTemplate:
         ""
     )
 
+    BULK_TEMPLATE = (
+        '"""\n'
+        "title: {title}\n"
+        "version: {version}\n"
+        "last_version: {last_version}\n"
+        '"""\n'
+        "from pymongo.database import Database\n"
+        "\n"
+        "from mongo_migrator import ops\n"
+        "\n"
+        "COLLECTION = 'collection_name'\n"
+        "\n"
+        "def transform(doc: dict):\n"
+        "    # Return the update to apply to the document or None to skip it\n"
+        "    # e.g. return {{'$set': {{'new_field': doc['old_field']}}}}\n"
+        "    return None\n"
+        "\n"
+        "def upgrade(db: Database):\n"
+        "    # Adjust the filter, projection and batch size of the bulk update\n"
+        "    ops.bulk_update(\n"
+        "        db[COLLECTION], transform, filter={{}}, projection=None, batch_size=1000\n"
+        "    )\n"
+        "\n"
+        "def downgrade(db: Database):\n"
+        "    # Implement this method in the generated migration file\n"
+        "    pass\n"
+        ""
+    )
+
+    DECLARATIVE_TEMPLATE = (
+        "{{\n"
+        '    "title": {title},\n'
+        '    "version": {version},\n'
+        '    "last_version": {last_version},\n'
+        '    "operations": [\n'
+        '        {{"collection": "collection_name", "rename": {{"old_field": "new_field"}}}}\n'
+        "    ]\n"
+        "}}\n"
+    )
+
+    TEMPLATES = {
+        "default": TEMPLATE,
+        "bulk": BULK_TEMPLATE,
+        "declarative": DECLARATIVE_TEMPLATE,
+    }
+    # Extension of the migration files of each template. .py by default
+    EXTENSIONS = {"declarative": ".migration.json"}
+
+    @classmethod
+    def get_extension(cls, template: str = "default") -> str:
+        """
+        Get the extension of the migration files of a template.
+        Args:
+            template: The name of the template.
+        Returns:
+            The extension, with the dot.
+        """
+        return cls.EXTENSIONS.get(template, ".py")
+
     @classmethod
     def create_migration_file(
-        cls, file_path: str, title: str, version: int, last_version: int
+        cls,
+        file_path: str,
+        title: str,
+        version: int,
+        last_version: int,
+        template: str = "default",
     ):
         """
         Create a new migration file.
@@ -37,10 +108,22 @@ class MigrationTemplate:
             title: The title of the migration.
             version: The version of the migration.
             last_version: The oldest version of the migrations.
+            template: The name of the template to use (see TEMPLATES).
+        Raises:
+            ValueError: If the template does not exist.
         """
+        if template not in cls.TEMPLATES:
+            raise ValueError(f"Unknown migration template: {template}.")
+
+        if template in cls.EXTENSIONS:
+            # JSON values
+            title = json.dumps(title)
+            version = json.dumps(str(version))
+            last_version = json.dumps(last_version)
+
         with open(file_path, "w") as file:
             file.write(
-                cls.TEMPLATE.format(
+                cls.TEMPLATES[template].format(
                     title=title, version=version, last_version=last_version
                 )
             )
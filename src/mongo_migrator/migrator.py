@@ -0,0 +1,296 @@
+"""
+Asyncio API to run the migrations in-process, e.g. when an asyncio service starts.
+
+Usage:
+```
+from mongo_migrator.config import Config
+from mongo_migrator.migrator import Migrator
+
+async def main():
+    async with Migrator(Config()) as migrator:
+        await migrator.upgrade()
+```
+
+The database is accessed with pymongo's AsyncMongoClient. Migrations may declare
+async upgrade and downgrade functions, which are awaited with an AsyncDatabase and
+can overlap the I/O of several collections with asyncio.gather:
+```
+import asyncio
+
+async def upgrade(db):
+    await asyncio.gather(
+        db["users"].update_many({}, {"$set": {"active": True}}),
+        db["orders"].create_index("user_id"),
+    )
+```
+
+Synchronous migrations (and the ops helpers they use) run in a worker thread with
+the pooled client of get_db, so they do not block the event loop either. As with
+the upgrade and downgrade commands, each run is recorded in the ledger.
+"""
+
+import asyncio
+
+from typing import Any, Dict, List, Optional
+
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.database import Database
+
+from mongo_migrator import instrumentation, ledger, ops, progress
+from mongo_migrator.bundle import load_valid_history
+from mongo_migrator.config import Config
+from mongo_migrator.db_utils import (
+    get_async_client,
+    get_current_version_async,
+    get_db,
+    set_current_version_async,
+)
+from mongo_migrator.migration_history import MigrationHistory, MigrationNode
+
+
+class Migrator:
+    """
+    Runs the migrations of a configuration from asyncio code.
+    """
+
+    def __init__(self, config: Config, reporter: progress.ProgressReporter = None):
+        """
+        Create the migrator. The database is connected the first time it is needed.
+        Args:
+            config: The configuration (see config.Config).
+            reporter: Where the migrations report their progress. Text on stdout
+                by default.
+        """
+        self.config = config
+        self.reporter = reporter or progress.ProgressReporter()
+        self._client: Optional[AsyncMongoClient] = None
+        self._ledger_indexed = False
+
+    async def __aenter__(self) -> "Migrator":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_connection_options(self) -> Dict[str, Any]:
+        """Private method to get the connection arguments of the configuration."""
+        return {
+            "db_host": self.config.db_host,
+            "db_port": self.config.db_port,
+            "db_user": self.config.db_user,
+            "db_pass": self.config.db_password,
+            "uri": self.config.db_uri,
+            "driver_options": self.config.driver_options,
+        }
+
+    async def get_db(self) -> AsyncDatabase:
+        """
+        Get the asyncio database, connecting to it the first time.
+        Raises:
+            Exception: If the connection cannot be established.
+        Returns:
+            The database.
+        """
+        if self._client is None:
+            self._client = await get_async_client(**self._get_connection_options())
+        return self._client[self.config.db_name]
+
+    def get_sync_db(self) -> Database:
+        """
+        Get the synchronous database of the pooled client (see db_utils.get_db),
+        passed to the synchronous migrations. Blocks: only call it from a thread.
+        Raises:
+            Exception: If the connection cannot be established.
+        Returns:
+            The database.
+        """
+        options = self._get_connection_options()
+        return get_db(
+            options.pop("db_host"),
+            options.pop("db_port"),
+            self.config.db_name,
+            options.pop("db_user"),
+            options.pop("db_pass"),
+            **options,
+        )
+
+    async def close(self):
+        """
+        Close the asyncio client. The pooled client is kept for other callers.
+        """
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def load_history(self) -> MigrationHistory:
+        """
+        Load the migration history from the bundle if it is configured, built and
+        current, or from the migrations directory (see bundle.load_valid_history).
+        Blocks: reads the migration files.
+        Raises:
+            ValueError: If the history is empty or not valid.
+        Returns:
+            The migration history.
+        """
+        return load_valid_history(
+            self.config.migrations_dir, self.config.migrations_bundle
+        )
+
+    async def get_current_version(self) -> Optional[str]:
+        """
+        Get the current version of the database.
+        Returns:
+            The current version. None if no migration has been applied.
+        """
+        db = await self.get_db()
+        return await get_current_version_async(db, self.config.mm_collection)
+
+    async def upgrade(self, version: str = None) -> List[MigrationNode]:
+        """
+        Upgrade the database, like the upgrade command.
+        Args:
+            version: The last version to apply. The latest one by default.
+        Raises:
+            ValueError: If the history is not valid or the version is not pending.
+            Exception: If a migration fails. The current version is set to the last
+                migration applied before the error is raised.
+        Returns:
+            The migrations applied.
+        """
+        current_version = await self.get_current_version()
+        history = await asyncio.to_thread(self.load_history)
+        migrations = history.get_migrations(current_version, version)
+        to_upgrade = [mig for mig in migrations if mig.version != current_version]
+        if version and version not in [mig.version for mig in to_upgrade]:
+            raise ValueError(
+                f"Migration {version} not found in the pending migrations."
+            )
+        return await self._run_migrations(to_upgrade, ledger.UPGRADE, current_version)
+
+    async def downgrade(
+        self, version: str = None, full: bool = False
+    ) -> List[MigrationNode]:
+        """
+        Downgrade the database, like the downgrade command.
+        Args:
+            version: The version to downgrade to. Its downgrade is not applied.
+                The previous version by default.
+            full: Whether to downgrade every migration.
+        Raises:
+            ValueError: If the history is not valid, no migration has been applied,
+                or the version is not applied.
+            Exception: If a migration fails. The current version is set to the last
+                migration reverted before the error is raised.
+        Returns:
+            The migrations reverted.
+        """
+        current_version = await self.get_current_version()
+        history = await asyncio.to_thread(self.load_history)
+        if current_version is None:
+            raise ValueError("No migrations have been run yet.")
+
+        migrations = history.get_migrations(None, current_version)[::-1]
+        if full:
+            to_downgrade = migrations
+        elif version:
+            versions = [mig.version for mig in migrations]
+            if version not in versions:
+                raise ValueError(
+                    f"Migration {version} not found in the parent migrations."
+                )
+            to_downgrade = migrations[: versions.index(version)]
+        else:
+            to_downgrade = [migrations[0]] if len(migrations) > 1 else []
+        return await self._run_migrations(
+            to_downgrade, ledger.DOWNGRADE, current_version
+        )
+
+    async def _run_migrations(
+        self, migrations: List[MigrationNode], direction: str, current_version: str
+    ) -> List[MigrationNode]:
+        """
+        Private method to run migrations in order and set the new current version,
+        also when one of them fails.
+        Returns:
+            The migrations run.
+        """
+        if not migrations:
+            print("[+] No migrations to run.")
+            return []
+
+        ops.configure(self.config.mm_collection, self.config.throttle_options)
+        db = await self.get_db()
+        run = []
+        new_current_version = current_version
+        print(f"[*] Running {len(migrations)} migrations...")
+        try:
+            for migration in migrations:
+                print(f"[*] Running migration: {migration}")
+                await self._run_migration(db, migration, direction)
+                if direction == ledger.UPGRADE:
+                    new_current_version = migration.version
+                else:
+                    new_current_version = migration.last_version
+                run.append(migration)
+        finally:
+            print(f"[+] {len(run)}/{len(migrations)} migrations run successfully.")
+            if new_current_version != current_version:
+                await set_current_version_async(
+                    db, self.config.mm_collection, new_current_version
+                )
+                print(f"[+] Current version set to: {new_current_version}")
+        return run
+
+    async def _run_migration(
+        self, db: AsyncDatabase, migration: MigrationNode, direction: str
+    ):
+        """
+        Private method to run a migration and record it in the ledger, with the
+        commands it sent (see cli._run_migration).
+        Raises:
+            Exception: If the migration fails. The failure is recorded too.
+        """
+        results = ops.track_results()
+        started_at = ledger.now()
+        error = commands = None
+        try:
+            with instrumentation.collect() as commands:
+                with progress.MigrationContext(
+                    migration, direction, self.reporter
+                ) as ctx:
+                    if direction == ledger.UPGRADE:
+                        await migration.upgrade_async(db, ctx, self.get_sync_db)
+                    else:
+                        await migration.downgrade_async(db, ctx, self.get_sync_db)
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            ops.stop_tracking()
+            if commands and (commands.round_trips or commands.batch_sizes):
+                print(commands.format_report())
+            entry = ledger.build_entry(
+                migration,
+                direction,
+                started_at,
+                ledger.now(),
+                results,
+                error,
+                commands.to_dict() if commands else None,
+            )
+            try:
+                await self._record(db, entry)
+            except Exception as err:
+                print(f"[!] Error recording the migration in the ledger: {err}")
+
+    async def _record(self, db: AsyncDatabase, entry: Dict[str, Any]):
+        """
+        Private method to insert an entry in the ledger, indexing it the first time.
+        """
+        collection = db[ledger.get_collection_name(self.config.mm_collection)]
+        if not self._ledger_indexed:
+            for keys in ledger.INDEXES:
+                await collection.create_index(keys)
+            self._ledger_indexed = True
+        await collection.insert_one(entry)
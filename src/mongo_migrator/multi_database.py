@@ -0,0 +1,216 @@
+"""
+Upgrades of several databases of a cluster (e.g. one per tenant) in one run.
+
+The migration history is loaded once and every database is upgraded with the
+same client, whose liveness is checked once by the caller. Each database keeps its
+own current version, so it only runs its pending migrations. The databases are
+upgraded concurrently by a pool of threads, and the failure of one of them does
+not stop the others: it is reported in its DatabaseUpgrade.
+"""
+
+import re
+import statistics
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional
+
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from mongo_migrator import ledger
+from mongo_migrator.db_utils import get_current_version, set_current_version
+from mongo_migrator.migration_history import MigrationHistory, MigrationNode
+
+# Databases upgraded at the same time by a multi-database upgrade
+DEFAULT_WORKERS = 4
+
+
+class DatabaseUpgrade:
+    """Outcome of the upgrade of one database of a multi-database upgrade"""
+
+    def __init__(self, db_name: str):
+        """
+        Args:
+            db_name: The name of the database.
+        Attributes:
+            from_version: The version of the database before the upgrade.
+            to_version: The version of the database after the upgrade.
+            pending: The number of migrations the upgrade had to run.
+            applied: The number of migrations applied.
+            duration: The seconds the upgrade took.
+            error: The error that stopped the upgrade. None if it succeeded.
+        """
+        self.db_name = db_name
+        self.from_version: Optional[str] = None
+        self.to_version: Optional[str] = None
+        self.pending = 0
+        self.applied = 0
+        self.duration = 0.0
+        self.error: Optional[str] = None
+
+    def __str__(self):
+        versions = f"{self.from_version} -> {self.to_version}"
+        if self.error:
+            return (
+                f"{self.db_name}: FAILED after {self.applied}/{self.pending} "
+                f"migrations ({versions}) in {self.duration:.1f}s: {self.error}"
+            )
+        return (
+            f"{self.db_name}: {self.applied} migrations applied ({versions}) "
+            f"in {self.duration:.1f}s"
+        )
+
+
+def get_target_databases(
+    client: MongoClient, databases: str = None, pattern: str = None
+) -> List[str]:
+    """
+    Get the databases of a multi-database upgrade: the listed ones, then those
+    of the cluster whose whole name matches the pattern.
+    Args:
+        client: The client of the cluster.
+        databases: The comma separated names of the databases.
+        pattern: The regular expression the names of the databases must match.
+    Raises:
+        Exception: If the databases of the cluster cannot be listed.
+        re.error: If the pattern is invalid.
+    Returns:
+        The names of the databases, without duplicates.
+    """
+    names = []
+    if databases:
+        names = [name.strip() for name in databases.split(",") if name.strip()]
+    if pattern:
+        regex = re.compile(pattern)
+        for name in sorted(client.list_database_names()):
+            if regex.fullmatch(name) and name not in names:
+                names.append(name)
+    return list(dict.fromkeys(names))
+
+
+def upgrade_database(
+    db: Database,
+    mm_collection: str,
+    migration_history: MigrationHistory,
+    run_migration: Callable[[Database, ledger.Ledger, MigrationNode], None],
+    to_version: str = None,
+) -> DatabaseUpgrade:
+    """
+    Upgrade one database with the shared migration history. Errors are reported
+    in the result instead of raised.
+    Args:
+        db: The database.
+        mm_collection: The name of the version collection.
+        migration_history: The migration history.
+        run_migration: Runs the upgrade of a migration on the database and records
+            it in the ledger.
+        to_version: The last version to apply. The latest one if None.
+    Returns:
+        The outcome of the upgrade.
+    """
+    result = DatabaseUpgrade(db.name)
+    start = time.perf_counter()
+    try:
+        if db[mm_collection].find_one() is None:
+            raise ValueError("Version collection not found. Run 'mongo-migrator init'.")
+        current_version = get_current_version(db, mm_collection)
+        result.from_version = result.to_version = current_version
+
+        migrations = migration_history.get_migrations(current_version, to_version)
+        to_upgrade = [mig for mig in migrations if mig.version != current_version]
+        if to_version and to_version not in [mig.version for mig in to_upgrade]:
+            raise ValueError(
+                f"Migration {to_version} not found in the pending migrations."
+            )
+        result.pending = len(to_upgrade)
+
+        migration_ledger = ledger.Ledger(db, mm_collection)
+        try:
+            for migration in to_upgrade:
+                print(f"[*] {db.name}: running migration: {migration}")
+                run_migration(db, migration_ledger, migration)
+                result.to_version = migration.version
+                result.applied += 1
+        finally:
+            if result.to_version != current_version:
+                set_current_version(db, mm_collection, result.to_version)
+    except Exception as err:
+        result.error = f"{type(err).__name__}: {err}"
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def upgrade_databases(
+    client: MongoClient,
+    db_names: List[str],
+    mm_collection: str,
+    migration_history: MigrationHistory,
+    run_migration: Callable[[Database, ledger.Ledger, MigrationNode], None],
+    to_version: str = None,
+    workers: int = DEFAULT_WORKERS,
+) -> List[DatabaseUpgrade]:
+    """
+    Upgrade several databases concurrently (see upgrade_database), printing the
+    outcome of each one as it finishes.
+    Args:
+        client: The client of the cluster, shared by every database.
+        db_names: The names of the databases.
+        mm_collection: The name of the version collection.
+        migration_history: The migration history.
+        run_migration: Runs the upgrade of a migration on a database and records
+            it in the ledger. Called from the threads of the pool.
+        to_version: The last version to apply. The latest one if None.
+        workers: The number of databases upgraded at the same time.
+    Returns:
+        The outcome of each database, in the order of db_names.
+    """
+    positions = {db_name: i for i, db_name in enumerate(db_names)}
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [
+            pool.submit(
+                upgrade_database,
+                client[db_name],
+                mm_collection,
+                migration_history,
+                run_migration,
+                to_version,
+            )
+            for db_name in db_names
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result.applied or result.error:
+                print(f"[{'F' if result.error else '+'}] {result}")
+
+    results.sort(key=lambda result: positions[result.db_name])
+    return results
+
+
+def print_report(results: List[DatabaseUpgrade], duration: float):
+    """
+    Print the report of a multi-database upgrade: the failed databases, the totals
+    and the timings per database.
+    Args:
+        results: The outcome of each database.
+        duration: The seconds the whole upgrade took.
+    """
+    failed = [result for result in results if result.error]
+    upgraded = [result for result in results if result.applied and not result.error]
+    for result in failed:
+        print(f"[F] {result}")
+    durations = sorted(result.duration for result in results)
+    print(
+        f"[+] {len(results)} databases in {duration:.1f}s: "
+        f"{len(results) - len(failed)} succeeded ({len(upgraded)} upgraded, "
+        f"{len(results) - len(failed) - len(upgraded)} up to date), "
+        f"{len(failed)} failed. "
+        f"{sum(result.applied for result in results)} migrations applied."
+    )
+    if durations:
+        print(
+            f"[+] Per database: p50 {statistics.median(durations):.1f}s, "
+            f"max {durations[-1]:.1f}s"
+        )
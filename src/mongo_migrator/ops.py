@@ -0,0 +1,976 @@
+"""
+Helpers for writing data migrations.
+
+Usage in a migration file:
+```
+from mongo_migrator import ops
+
+def transform(doc):
+    return {"$set": {"full_name": f"{doc['name']} {doc['surname']}"}}
+
+def upgrade(db):
+    ops.bulk_update(db["users"], transform, projection=["name", "surname"])
+```
+
+The documents are streamed from a cursor and the writes are sent in unordered
+bulk_write batches, instead of one round trip per document.
+
+Resumable helpers store their progress in a collection named after the version
+collection ('<collection>_progress'), so a failed migration continues from the
+last processed document when it is run again.
+
+parallel_update splits a collection into _id ranges (see id_ranges) that are
+updated concurrently by worker processes.
+
+bulk_write sends a stream of write requests in batches whose size adapts to a
+target latency per batch (see BatchSizer). bulk_update does the same with the
+target_latency_ms option.
+
+When a throttle is configured (see throttle), the helpers check the replication lag
+and the load of the cluster between batches, and shrink the batches or sleep while
+it is overloaded.
+"""
+
+import functools
+import multiprocessing
+import os
+import threading
+import time
+
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.collection import Collection
+
+from mongo_migrator import instrumentation, isolation, progress
+from mongo_migrator.db_utils import get_client, get_connection_params
+from mongo_migrator.id_ranges import after_filter, partition, range_filter
+from mongo_migrator.throttle import Throttle
+
+WRITE_MODELS = (DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne)
+DEFAULT_TARGET_LATENCY_MS = 200.0
+# Maximum number of operations of a write batch accepted by the server
+MAX_WRITE_BATCH_SIZE = 100000
+
+# Version collection the helpers store their state next to. Set by the CLI.
+_mm_collection = "mongo-migrator"
+# Throttle of the helpers, and its options to configure the worker processes
+_throttle: Optional[Throttle] = None
+_throttle_options: Dict[str, Any] = {}
+
+
+def configure(mm_collection: str, throttle_options: Dict[str, Any] = None):
+    """
+    Set the version collection the helpers store their state next to.
+    Args:
+        mm_collection: The name of the version collection.
+        throttle_options: The options of the throttle (see throttle.Throttle).
+            The helpers are not throttled if None or empty.
+    Raises:
+        ValueError: If a throttle option is unknown.
+    """
+    global _mm_collection, _throttle, _throttle_options
+    _mm_collection = mm_collection
+    _throttle_options = dict(throttle_options or {})
+    _throttle = Throttle.from_options(_throttle_options) if _throttle_options else None
+
+
+def get_configuration() -> Dict[str, Any]:
+    """
+    Get the arguments of the last call to configure.
+    They allow other processes (e.g. isolated migrations) to configure their helpers
+    the same way.
+    Returns:
+        The keyword arguments of configure.
+    """
+    return {
+        "mm_collection": _mm_collection,
+        "throttle_options": dict(_throttle_options),
+    }
+
+
+def get_throttle() -> Optional[Throttle]:
+    """
+    Get the throttle of the helpers.
+    Returns:
+        The throttle, or None if the helpers are not throttled.
+    """
+    return _throttle
+
+
+def _get_batch_size(batch_size: int, sizer: "BatchSizer" = None) -> int:
+    """
+    Private function to get the size of the next batch, from the adaptive
+    controller if any, scaled by the throttle if any.
+    """
+    if sizer is not None:
+        batch_size = sizer.size
+    return _throttle.batch_size(batch_size) if _throttle else batch_size
+
+
+def _wait_for_cluster(collection: Collection, verbose: bool = True):
+    """
+    Private function to wait between batches while the cluster of a collection is
+    overloaded, if a throttle is configured.
+    """
+    client = getattr(collection.database, "client", None)
+    if _throttle is not None and client is not None:
+        _throttle.wait(client, verbose)
+
+
+def get_progress_collection_name() -> str:
+    """
+    Get the name of the collection where resumable helpers store their progress.
+    Returns:
+        The name of the progress collection.
+    """
+    return f"{_mm_collection}_progress"
+
+
+def get_partitions_collection_name() -> str:
+    """
+    Get the name of the collection where distributed updates store their
+    partitions as work items (see work_queue).
+    Returns:
+        The name of the partitions collection.
+    """
+    return f"{_mm_collection}_partitions"
+
+
+# Results of the helpers run by the current migration (see track_results)
+_tracked_results: ContextVar[Optional[List["BulkResult"]]] = ContextVar(
+    "tracked_results", default=None
+)
+
+
+def track_results() -> List["BulkResult"]:
+    """
+    Start collecting the results of the helpers run in the current context.
+    Used by the CLI to record the documents touched by each migration.
+    Returns:
+        The list where the results are collected until stop_tracking is called.
+    """
+    results: List[BulkResult] = []
+    _tracked_results.set(results)
+    return results
+
+
+def stop_tracking():
+    """Stop collecting the results of the helpers."""
+    _tracked_results.set(None)
+
+
+def track(result: "BulkResult"):
+    """
+    Collect the result of a helper if tracking is enabled (see track_results).
+    Args:
+        result: The counters of the helper.
+    """
+    results = _tracked_results.get()
+    if results is not None:
+        results.append(result)
+
+
+class BulkResult:
+    """Counters of a bulk operation over a collection"""
+
+    def __init__(self, collection_name: str):
+        """
+        Create the counters of a bulk operation.
+        Args:
+            collection_name: The name of the collection.
+        Attributes:
+            collection_name: The name of the collection.
+            processed: The number of documents read from the cursor.
+            matched: The number of documents matched by the writes.
+            modified: The number of documents modified by the writes.
+            inserted: The number of documents inserted by the writes.
+            deleted: The number of documents deleted by the writes.
+            batches: The number of bulk_write batches sent.
+        """
+        self.collection_name = collection_name
+        self.processed = 0
+        self.matched = 0
+        self.modified = 0
+        self.inserted = 0
+        self.deleted = 0
+        self.batches = 0
+        self._started = time.perf_counter()
+        self._elapsed = None
+
+    def finish(self):
+        """Stop counting the elapsed time of the operation."""
+        self._elapsed = time.perf_counter() - self._started
+
+    @property
+    def elapsed(self) -> float:
+        """The seconds the operation took, or since it started if not finished."""
+        if self._elapsed is not None:
+            return self._elapsed
+        return time.perf_counter() - self._started
+
+    @property
+    def rate(self) -> float:
+        """The number of processed documents per second."""
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.collection_name}: {self.processed} docs processed, "
+            f"{self.modified} modified, {self.deleted} deleted, "
+            f"{self.inserted} inserted ({self.rate:.0f} docs/s)"
+        )
+
+
+class BatchSizer:
+    """
+    Adjusts the size of write batches toward a target latency per batch, with an
+    additive increase / multiplicative decrease (AIMD) controller.
+    """
+
+    def __init__(
+        self,
+        target_latency_ms: float = DEFAULT_TARGET_LATENCY_MS,
+        initial: int = 1000,
+        min_size: int = 1,
+        max_size: int = MAX_WRITE_BATCH_SIZE,
+        step: int = None,
+        decrease: float = 0.5,
+    ):
+        """
+        Create the controller.
+        Args:
+            target_latency_ms: The target latency of a batch in milliseconds.
+            initial: The size of the first batch.
+            min_size: The minimum size of a batch.
+            max_size: The maximum size of a batch.
+            step: The size added after a batch faster than the target. 10% of the
+                initial size by default.
+            decrease: The factor applied after a batch slower than the target.
+        Attributes:
+            size: The size of the next batch.
+            sizes: The size of every batch observed, in order.
+        """
+        self.target_latency_ms = target_latency_ms
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.step = step or max(1, initial // 10)
+        self.decrease = decrease
+        self.size = min(max(initial, self.min_size), self.max_size)
+        self.sizes: List[int] = []
+
+    def observe(self, size: int, latency_ms: float):
+        """
+        Adjust the size of the next batch to the latency of a batch.
+        Args:
+            size: The size of the batch.
+            latency_ms: The latency of the batch in milliseconds.
+        """
+        self.sizes.append(size)
+        if latency_ms > self.target_latency_ms:
+            self.size = max(self.min_size, int(self.size * self.decrease))
+        elif size >= self.size:
+            # Only full batches show that the current size is fast enough
+            self.size = min(self.max_size, self.size + self.step)
+
+
+class UpdateCancelled(Exception):
+    """Raised when an update is cancelled between two batches"""
+
+
+def _check_cancelled(cancelled: Optional[threading.Event]):
+    """
+    Private function to stop an update before its next batch once cancelled.
+    Raises:
+        UpdateCancelled: If the event is set.
+    """
+    if cancelled is not None and cancelled.is_set():
+        raise UpdateCancelled("Cancelled before writing the next batch.")
+
+
+def _to_request(doc: dict, update: Any) -> Optional[Any]:
+    """
+    Private function to turn the output of a transform into a write request.
+    Args:
+        doc: The transformed document.
+        update: The output of the transform. None to skip the document, a pymongo
+            write model (UpdateOne, DeleteOne...), or an update document or pipeline
+            to apply to the document by its _id.
+    Raises:
+        TypeError: If the output of the transform is not supported.
+    Returns:
+        The write request, or None if there is nothing to write.
+    """
+    if update is None:
+        return None
+    if isinstance(update, WRITE_MODELS):
+        return update
+    if isinstance(update, (dict, list)):
+        return UpdateOne({"_id": doc["_id"]}, update)
+    raise TypeError(f"Unsupported transform output: {type(update).__name__}.")
+
+
+def _flush(
+    collection: Collection,
+    requests: List[Any],
+    result: BulkResult,
+    sizer: BatchSizer = None,
+):
+    """
+    Private function to send a batch of write requests and count the results.
+    Args:
+        collection: The collection to write.
+        requests: The write requests.
+        result: The counters to update.
+        sizer: The controller of the batch size, if adaptive. The latency of the
+            batch is reported to it and to the instrumentation.
+    """
+    started = time.perf_counter()
+    bulk_result = collection.bulk_write(requests, ordered=False)
+    if sizer is not None:
+        sizer.observe(len(requests), (time.perf_counter() - started) * 1000)
+        instrumentation.record_batch_size(len(requests))
+    result.matched += bulk_result.matched_count
+    result.modified += bulk_result.modified_count
+    result.inserted += bulk_result.inserted_count
+    result.deleted += bulk_result.deleted_count
+    result.batches += 1
+
+
+def iterate_resumable_batches(
+    collection: Collection,
+    name: str,
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    verbose: bool = True,
+) -> Iterator[List[dict]]:
+    """
+    Iterate over the documents of a collection in _id order, in batches.
+    The last _id of a batch is stored in the progress collection when the next batch
+    is requested, so the writes of a batch must be done before iterating further.
+    If the iteration is interrupted, the next iteration with the same name resumes
+    after the last stored _id. The progress is removed when the iteration completes.
+    Args:
+        collection: The collection to iterate.
+        name: The unique name of the iteration (e.g. the migration version).
+        filter: The filter of the documents to iterate. All documents by default.
+        projection: The fields to read from each document. All fields by default.
+            The _id must not be excluded.
+        batch_size: The number of documents per batch.
+        verbose: Whether to print a message when the iteration is resumed.
+    Yields:
+        Lists of documents sorted by _id.
+    """
+    return _iterate_resumable_batches(
+        collection, name, filter, projection, lambda: batch_size, verbose
+    )
+
+
+def _iterate_resumable_batches(
+    collection: Collection,
+    name: str,
+    filter: dict = None,
+    projection: Any = None,
+    get_batch_size: Callable[[], int] = lambda: 1000,
+    verbose: bool = True,
+) -> Iterator[List[dict]]:
+    """
+    Private function with the implementation of iterate_resumable_batches.
+    get_batch_size is called before each batch, so the batches can be resized.
+    """
+    progress = collection.database[get_progress_collection_name()]
+    checkpoint = progress.find_one({"_id": name})
+    last_id = checkpoint["last_id"] if checkpoint else None
+    processed = checkpoint["processed"] if checkpoint else 0
+    if checkpoint and verbose:
+        print(f"[*] Resuming {name} after {processed} documents (_id: {last_id})")
+
+    while True:
+        query = after_filter(filter, last_id)
+        batch_size = get_batch_size()
+        batch = list(
+            collection.find(query, projection, sort=[("_id", 1)], limit=batch_size)
+        )
+        if not batch:
+            break
+
+        yield batch
+
+        # A short batch is the last one
+        if len(batch) < batch_size:
+            break
+        last_id = batch[-1]["_id"]
+        processed += len(batch)
+        progress.update_one(
+            {"_id": name},
+            {
+                "$set": {
+                    "collection": collection.name,
+                    "last_id": last_id,
+                    "processed": processed,
+                    "updated_at": datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+
+    progress.delete_one({"_id": name})
+
+
+def iterate_resumable(
+    collection: Collection,
+    name: str,
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    verbose: bool = True,
+) -> Iterator[dict]:
+    """
+    Iterate over the documents of a collection in _id order, resuming after the
+    last processed document of a previous interrupted iteration with the same name.
+    See iterate_resumable_batches.
+    Args:
+        collection: The collection to iterate.
+        name: The unique name of the iteration (e.g. the migration version).
+        filter: The filter of the documents to iterate. All documents by default.
+        projection: The fields to read from each document. All fields by default.
+        batch_size: The number of documents per batch (and per stored checkpoint).
+        verbose: Whether to print a message when the iteration is resumed.
+    Yields:
+        The documents sorted by _id.
+    """
+    for batch in iterate_resumable_batches(
+        collection, name, filter, projection, batch_size, verbose
+    ):
+        yield from batch
+
+
+def bulk_update(
+    collection: Collection,
+    transform: Callable[[dict], Any],
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    verbose: bool = True,
+    resumable: str = None,
+    target_latency_ms: float = None,
+    total: int = None,
+) -> BulkResult:
+    """
+    Apply a transform to every document of a collection with batched writes.
+    Args:
+        collection: The collection to update.
+        transform: Function called with each document. Returns None to skip it, an
+            update document or pipeline to apply to it, or any pymongo write model.
+        filter: The filter of the documents to transform. All documents by default.
+        projection: The fields to read from each document. All fields by default.
+        batch_size: The number of documents per cursor batch and of requests per
+            bulk_write.
+        verbose: Whether to print the progress after each batch.
+        resumable: If set, the unique name used to store the progress of the update,
+            which resumes from the last written batch if it is interrupted
+            (see iterate_resumable_batches).
+        target_latency_ms: If set, the batch size adapts toward this latency of
+            each bulk_write, starting from batch_size (see BatchSizer).
+        total: The number of documents to process, reported with the progress of
+            the running migration. Without a filter, the estimated count of the
+            collection by default. With a filter, unknown by default, since counting
+            the matching documents may scan the whole collection.
+    Raises:
+        TypeError: If the transform returns an unsupported value.
+    Returns:
+        The counters of the operation.
+    """
+    result = BulkResult(collection.name)
+    track(result)
+    sizer = None
+    if target_latency_ms is not None:
+        sizer = BatchSizer(target_latency_ms, initial=batch_size)
+    _bulk_update(
+        collection,
+        transform,
+        result,
+        filter,
+        projection,
+        batch_size,
+        verbose,
+        resumable,
+        _get_progress_callback(collection, filter, total),
+        sizer,
+    )
+    return result
+
+
+def bulk_write(
+    collection: Collection,
+    requests: Iterable[Any],
+    batch_size: int = 1000,
+    target_latency_ms: float = DEFAULT_TARGET_LATENCY_MS,
+    verbose: bool = True,
+) -> BulkResult:
+    """
+    Send a stream of write requests in unordered bulk_write batches, whose size
+    adapts toward a target latency per batch (see BatchSizer).
+    Args:
+        collection: The collection to write.
+        requests: The pymongo write models (UpdateOne, InsertOne...). Consumed
+            lazily, so it can be a generator.
+        batch_size: The size of the first batch.
+        target_latency_ms: The target latency of each bulk_write in milliseconds.
+        verbose: Whether to print the progress after each batch.
+    Returns:
+        The counters of the operation. processed is the number of requests sent.
+    """
+    result = BulkResult(collection.name)
+    track(result)
+    sizer = BatchSizer(target_latency_ms, initial=batch_size)
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) >= _get_batch_size(batch_size, sizer):
+            result.processed += len(batch)
+            _flush(collection, batch, result, sizer)
+            batch = []
+            if verbose:
+                print(f"[*] {result} | next batch: {sizer.size}")
+            _wait_for_cluster(collection, verbose)
+    if batch:
+        result.processed += len(batch)
+        _flush(collection, batch, result, sizer)
+    result.finish()
+    if verbose:
+        print(f"[+] {result}")
+    return result
+
+
+def _get_progress_callback(
+    collection: Collection, filter: dict = None, total: int = None
+) -> Optional[Callable[[BulkResult], None]]:
+    """
+    Private function to report the progress of a bulk operation to the context of
+    the running migration (see progress.MigrationContext). Without a total, it is
+    estimated from the metadata of the collection if there is no filter.
+    Returns:
+        The function to call after each batch, or None if no migration is running.
+    """
+    ctx = progress.get_current_context()
+    if ctx is None:
+        return None
+
+    if total is None and not filter:
+        total = collection.estimated_document_count()
+
+    def on_batch(result: BulkResult):
+        ctx.progress(total, result.processed)
+
+    return on_batch
+
+
+def _bulk_update(
+    collection: Collection,
+    transform: Callable[[dict], Any],
+    result: BulkResult,
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    verbose: bool = True,
+    resumable: str = None,
+    on_batch: Callable[[BulkResult], None] = None,
+    sizer: BatchSizer = None,
+    cancelled: threading.Event = None,
+):
+    """
+    Private function with the implementation of bulk_update.
+    The counters are updated in the given result, so they are kept if it fails.
+    on_batch is called with the counters after each batch. Once cancelled is set,
+    UpdateCancelled is raised instead of writing the next batch.
+    """
+    if resumable:
+        for batch in _iterate_resumable_batches(
+            collection,
+            resumable,
+            filter,
+            projection,
+            lambda: _get_batch_size(batch_size, sizer),
+            verbose,
+        ):
+            _check_cancelled(cancelled)
+            result.processed += len(batch)
+            requests = [_to_request(doc, transform(doc)) for doc in batch]
+            requests = [request for request in requests if request is not None]
+            # Written before the next batch is requested and the progress stored
+            if requests:
+                _flush(collection, requests, result, sizer)
+                _wait_for_cluster(collection, verbose)
+            if on_batch is not None:
+                on_batch(result)
+            if verbose:
+                print(f"[*] {result}")
+        result.finish()
+        if verbose:
+            print(f"[+] {result}")
+        return
+
+    requests = []
+    cursor = collection.find(filter or {}, projection, batch_size=batch_size)
+    for doc in cursor:
+        result.processed += 1
+        request = _to_request(doc, transform(doc))
+        if request is not None:
+            requests.append(request)
+        if len(requests) >= _get_batch_size(batch_size, sizer):
+            _check_cancelled(cancelled)
+            _flush(collection, requests, result, sizer)
+            requests = []
+            _wait_for_cluster(collection, verbose)
+            if on_batch is not None:
+                on_batch(result)
+            if verbose:
+                print(f"[*] {result}")
+
+    if requests:
+        _check_cancelled(cancelled)
+        _flush(collection, requests, result, sizer)
+    if on_batch is not None:
+        on_batch(result)
+    result.finish()
+    if verbose:
+        print(f"[+] {result}")
+
+
+class PartitionResult(BulkResult):
+    """Counters of a bulk operation over an _id range of a collection"""
+
+    def __init__(self, collection_name: str, index: int, lower: Any, upper: Any):
+        """
+        Create the counters of a partition.
+        Args:
+            collection_name: The name of the collection.
+            index: The index of the partition.
+            lower: The lowest _id of the partition (inclusive). None if unbounded.
+            upper: The highest _id of the partition (exclusive). None if unbounded.
+        Attributes:
+            error: The error that stopped the partition. None if it completed.
+        """
+        super().__init__(collection_name)
+        self.index = index
+        self.lower = lower
+        self.upper = upper
+        self.error: Optional[str] = None
+
+    def __str__(self):
+        state = f"FAILED ({self.error})" if self.error else "done"
+        return (
+            f"partition {self.index} [{self.lower}, {self.upper}) {state}. "
+            f"{super().__str__()}"
+        )
+
+
+class PartitionError(Exception):
+    """Raised when some partitions of a parallel update fail"""
+
+    def __init__(self, results: List[PartitionResult]):
+        """
+        Args:
+            results: The results of every partition, failed or not.
+        """
+        self.results = results
+        failed = [result for result in results if result.error]
+        details = ", ".join(f"{result.index}: {result.error}" for result in failed)
+        super().__init__(f"{len(failed)}/{len(results)} partitions failed ({details})")
+
+
+def update_partition(
+    collection: Collection,
+    transform: Callable[[dict], Any],
+    index: int,
+    lower: Any,
+    upper: Any,
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    resumable: str = None,
+    cancelled: threading.Event = None,
+) -> PartitionResult:
+    """
+    Apply a transform to the documents of an _id range (see bulk_update).
+    Used by parallel_update and the workers of a distributed update.
+    Args:
+        collection: The collection to update.
+        transform: Function called with each document.
+        index: The index of the range.
+        lower: The inclusive lower bound of the range. None if unbounded.
+        upper: The exclusive upper bound of the range. None if unbounded.
+        filter: The filter of the documents to transform. All documents by default.
+        projection: The fields to read from each document. All fields by default.
+        batch_size: The number of documents per cursor batch and per bulk_write.
+        resumable: If set, the name of the update. The progress of the range is
+            stored under it, so it resumes from the last written batch.
+        cancelled: If set (e.g. when the lease of a work item is lost), the update
+            stops before its next batch, with an UpdateCancelled error.
+    Returns:
+        The counters of the range. Errors are reported in it instead of raised.
+    """
+    result = PartitionResult(collection.name, index, lower, upper)
+    try:
+        _bulk_update(
+            collection,
+            transform,
+            result,
+            range_filter(filter, lower, upper),
+            projection,
+            batch_size,
+            verbose=False,
+            resumable=f"{resumable}:{index}" if resumable else None,
+            cancelled=cancelled,
+        )
+    except Exception as err:
+        result.error = f"{type(err).__name__}: {err}"
+        result.finish()
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def load_function(file_path: str, function_name: str, code: bytes = None) -> Callable:
+    """
+    Load a function of a migration in a worker process.
+    The migration is executed from its marshalled code if given (bundles), or
+    imported from its file otherwise, in its own module (see isolation). Cached,
+    so each worker loads it once.
+    Args:
+        file_path: The migration file.
+        function_name: The name of the function.
+        code: The marshalled code of the migration, if it comes from a bundle.
+    Raises:
+        Exception: Any error raised by the migration module.
+        AttributeError: If the function is not defined.
+    Returns:
+        The function.
+    """
+    module = isolation.load_module(file_path, code)
+    return getattr(module, function_name)
+
+
+def get_function_reference(function: Callable) -> Dict[str, Any]:
+    """
+    Get how a worker process can load a function (see load_function).
+    Args:
+        function: A function defined at the top level of a migration file.
+    Raises:
+        ValueError: If the function is not defined at the top level of a file.
+    Returns:
+        The file path, the function name and the marshalled code of the migration
+        if it was loaded from a bundle.
+    """
+    name = getattr(function, "__qualname__", "")
+    module_globals = getattr(function, "__globals__", {})
+    file_path = module_globals.get("__file__")
+    if not name or "<" in name or "." in name or file_path is None:
+        raise ValueError(
+            "Parallel transforms must be functions defined at the top level of "
+            "the migration file."
+        )
+    return {
+        "file_path": file_path,
+        "function_name": name,
+        "code": module_globals.get("__migration_code__"),
+    }
+
+
+def _run_partition(task: Dict[str, Any]) -> PartitionResult:
+    """
+    Private function to update a partition in a worker process.
+    Each worker opens its own pooled client with the connection details of the
+    coordinator.
+    """
+    configure(task["mm_collection"], task["throttle"])
+    client = get_client(**task["connection"])
+    collection = client[task["db_name"]][task["collection_name"]]
+    transform = load_function(task["file_path"], task["function_name"], task["code"])
+    return update_partition(
+        collection,
+        transform,
+        task["index"],
+        task["lower"],
+        task["upper"],
+        task["filter"],
+        task["projection"],
+        task["batch_size"],
+        task["resumable"],
+    )
+
+
+def _get_ranges(
+    collection: Collection, partitions: int, resumable: str = None
+) -> Tuple[List[Tuple[Any, Any]], List[int]]:
+    """
+    Private function to get the ranges of a parallel update.
+    Resumable updates store their ranges and the completed partitions, so a
+    resumed update uses the same ranges and skips the completed ones.
+    Returns:
+        The ranges and the indexes of the completed partitions.
+    """
+    if not resumable:
+        return partition(collection, partitions), []
+
+    progress = collection.database[get_progress_collection_name()]
+    stored = progress.find_one({"_id": f"{resumable}:partitions"})
+    if stored:
+        ranges = [tuple(bounds) for bounds in stored["ranges"]]
+        return ranges, stored.get("done", [])
+
+    ranges = partition(collection, partitions)
+    progress.insert_one(
+        {
+            "_id": f"{resumable}:partitions",
+            "ranges": [list(bounds) for bounds in ranges],
+            "done": [],
+            "updated_at": datetime.now(),
+        }
+    )
+    return ranges, []
+
+
+def _mark_partition_done(collection: Collection, resumable: str, index: int):
+    """
+    Private function to store that a partition of a resumable update completed.
+    """
+    progress = collection.database[get_progress_collection_name()]
+    progress.update_one(
+        {"_id": f"{resumable}:partitions"},
+        {"$addToSet": {"done": index}, "$set": {"updated_at": datetime.now()}},
+    )
+
+
+def parallel_update(
+    collection: Collection,
+    transform: Callable[[dict], Any],
+    partitions: int = None,
+    processes: int = None,
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    verbose: bool = True,
+    resumable: str = None,
+) -> List[PartitionResult]:
+    """
+    Apply a transform to every document of a collection, splitting the collection
+    into _id ranges (see partition) that are updated concurrently by a pool of
+    worker processes. Each worker opens its own client with get_db's pool.
+    Args:
+        collection: The collection to update. Its database must come from get_db.
+        transform: Function called with each document (see bulk_update). It must be
+            defined at the top level of the migration file, since each worker
+            loads it from there.
+        partitions: The number of _id ranges. By default, 4 per process.
+        processes: The number of worker processes. By default, the number of CPUs.
+            With 1, the partitions are updated in the current process.
+        filter: The filter of the documents to transform. All documents by default.
+        projection: The fields to read from each document. All fields by default.
+        batch_size: The number of documents per cursor batch and per bulk_write.
+        verbose: Whether to print each partition when it finishes.
+        resumable: If set, the unique name used to store the ranges and the progress
+            of each partition, so only the pending documents are updated when the
+            update is run again after a failure. Completed partitions are skipped.
+    Raises:
+        ValueError: If the transform or the database cannot be used by the workers.
+        PartitionError: If any partition fails, once every partition has finished.
+    Returns:
+        The results of the partitions run, sorted by _id range.
+    """
+    processes = processes or os.cpu_count() or 1
+    partitions = partitions or processes * 4
+
+    ranges, done = _get_ranges(collection, partitions, resumable)
+    pending = [
+        (index, lower, upper)
+        for index, (lower, upper) in enumerate(ranges)
+        if index not in done
+    ]
+    if verbose:
+        skipped = f" ({len(done)} already done)" if done else ""
+        print(
+            f"[*] Updating {collection.name} in {len(ranges)} partitions{skipped} "
+            f"with {processes} processes..."
+        )
+
+    results = []
+
+    def collect(result: PartitionResult):
+        results.append(result)
+        track(result)
+        if resumable and not result.error:
+            _mark_partition_done(collection, resumable, result.index)
+        if verbose:
+            print(f"[*] {result}")
+
+    if processes == 1:
+        for index, lower, upper in pending:
+            result = update_partition(
+                collection,
+                transform,
+                index,
+                lower,
+                upper,
+                filter,
+                projection,
+                batch_size,
+                resumable,
+            )
+            collect(result)
+    else:
+        connection = get_connection_params(collection.database.client)
+        if connection is None:
+            raise ValueError(
+                "Parallel updates need a database connected with get_db. "
+                "Use processes=1 otherwise."
+            )
+        task = {
+            **get_function_reference(transform),
+            "connection": connection,
+            "mm_collection": _mm_collection,
+            "throttle": _throttle_options,
+            "db_name": collection.database.name,
+            "collection_name": collection.name,
+            "filter": filter,
+            "projection": projection,
+            "batch_size": batch_size,
+            "resumable": resumable,
+        }
+        # Spawned workers, since pymongo clients are not fork-safe
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            futures = {
+                pool.submit(
+                    _run_partition,
+                    {**task, "index": index, "lower": lower, "upper": upper},
+                ): (index, lower, upper)
+                for index, lower, upper in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as err:
+                    # The worker died or the task could not be sent to it
+                    result = PartitionResult(collection.name, *futures[future])
+                    result.error = f"{type(err).__name__}: {err}"
+                    result.finish()
+                collect(result)
+
+    results.sort(key=lambda result: result.index)
+    if any(result.error for result in results):
+        raise PartitionError(results)
+
+    if resumable:
+        progress = collection.database[get_progress_collection_name()]
+        progress.delete_one({"_id": f"{resumable}:partitions"})
+    if verbose:
+        processed = sum(result.processed for result in results)
+        modified = sum(result.modified for result in results)
+        print(f"[+] {collection.name}: {processed} docs processed, {modified} modified")
+    return results
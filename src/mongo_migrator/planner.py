@@ -0,0 +1,224 @@
+"""
+Runtime estimates of the pending migrations, based on the ledger.
+
+The runtime of a migration is estimated, in order of preference, from:
+- Its own past runs (e.g. applied and reverted before), scaled by the current
+  number of documents of the collections it touched.
+- The throughput (docs/s) of the past runs of every migration, applied to the
+  current number of documents of the collections it references.
+- The median runtime of the past runs of every migration.
+"""
+
+import ast
+import marshal
+import os
+import statistics
+import types
+
+from typing import Dict, List, Optional, Set
+
+from pymongo.database import Database
+
+from mongo_migrator import declarative, ledger
+from mongo_migrator.migration_history import MigrationNode
+
+OWN_RUNS = "own runs"
+THROUGHPUT = "throughput"
+MEDIAN = "median"
+
+
+class Estimate:
+    """Estimated runtime of a migration"""
+
+    def __init__(
+        self,
+        migration: MigrationNode,
+        seconds: Optional[float],
+        method: Optional[str],
+        collections: Dict[str, int],
+    ):
+        """
+        Args:
+            migration: The migration.
+            seconds: The estimated runtime, or None if it cannot be estimated.
+            method: How the runtime was estimated (OWN_RUNS, THROUGHPUT or MEDIAN).
+            collections: The number of documents of each collection it references.
+        """
+        self.migration = migration
+        self.seconds = seconds
+        self.method = method
+        self.collections = collections
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    """
+    Format an estimated duration for humans.
+    Args:
+        seconds: The duration in seconds. None if it is unknown.
+    Returns:
+        The formatted duration (e.g. '~1h 2m 3s').
+    """
+    if seconds is None:
+        return "unknown"
+    return "~" + _format_seconds(seconds)
+
+
+def _format_seconds(seconds: float) -> str:
+    """
+    Private function to format seconds as hours, minutes and seconds.
+    """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h {minutes}m {seconds}s"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+
+def _collect_strings(code: types.CodeType, strings: Set[str]):
+    """
+    Private function to collect the string constants of compiled code.
+    """
+    for const in code.co_consts:
+        if isinstance(const, str):
+            strings.add(const)
+        elif isinstance(const, types.CodeType):
+            _collect_strings(const, strings)
+
+
+def get_string_literals(migration: MigrationNode) -> Set[str]:
+    """
+    Get the string literals of a migration, without importing it.
+    Args:
+        migration: The migration.
+    Returns:
+        The string literals of its source file, or of its code if it is bundled.
+    """
+    strings: Set[str] = set()
+    if migration.file_path and os.path.exists(migration.file_path):
+        if declarative.is_declarative(migration.file_path):
+            source = declarative.to_source(migration.file_path)
+        else:
+            with open(migration.file_path, "r") as f:
+                source = f.read()
+        tree = ast.parse(source, migration.file_path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                strings.add(node.value)
+    elif migration.code is not None:
+        _collect_strings(marshal.loads(migration.code), strings)
+    return strings
+
+
+def get_referenced_collections(
+    db: Database, migration: MigrationNode, collection_names: List[str] = None
+) -> Dict[str, int]:
+    """
+    Get the existing collections a migration references, and their size.
+    The references are the string literals of the migration named as a collection.
+    Args:
+        db: The database.
+        migration: The migration.
+        collection_names: The collections of the database, to avoid listing them
+            for every migration.
+    Returns:
+        The estimated number of documents of each referenced collection.
+    """
+    if collection_names is None:
+        collection_names = db.list_collection_names()
+    names = get_string_literals(migration) & set(collection_names)
+    return {name: db[name].estimated_document_count() for name in sorted(names)}
+
+
+def estimate(
+    migration: MigrationNode,
+    collections: Dict[str, int],
+    entries: List[Dict],
+) -> Estimate:
+    """
+    Estimate the runtime of a migration from the runs recorded in the ledger.
+    Args:
+        migration: The migration.
+        collections: The number of documents of the collections it references.
+        entries: The entries of the ledger.
+    Returns:
+        The estimate.
+    """
+    applied = [
+        entry
+        for entry in entries
+        if entry["direction"] == ledger.UPGRADE and entry["outcome"] == ledger.APPLIED
+    ]
+
+    # Past runs of the same migration, scaled by the current size
+    own_runs = [entry for entry in applied if entry["version"] == migration.version]
+    if own_runs:
+        last_run = own_runs[0]
+        seconds = last_run["duration"]
+        current = sum(collections.get(name, 0) for name in last_run["collections"])
+        if last_run["docs_processed"] and current:
+            seconds *= current / last_run["docs_processed"]
+        return Estimate(migration, seconds, OWN_RUNS, collections)
+
+    # Throughput of the past runs that touched documents
+    processed = sum(entry["docs_processed"] for entry in applied)
+    duration = sum(entry["duration"] for entry in applied if entry["docs_processed"])
+    if collections and processed and duration:
+        seconds = sum(collections.values()) / (processed / duration)
+        return Estimate(migration, seconds, THROUGHPUT, collections)
+
+    if applied:
+        seconds = statistics.median(entry["duration"] for entry in applied)
+        return Estimate(migration, seconds, MEDIAN, collections)
+
+    return Estimate(migration, None, None, collections)
+
+
+def plan(
+    db: Database, migrations: List[MigrationNode], migration_ledger: ledger.Ledger
+) -> List[Estimate]:
+    """
+    Estimate the runtime of each migration of an upgrade.
+    Args:
+        db: The database to upgrade.
+        migrations: The migrations to run.
+        migration_ledger: The ledger of the database.
+    Returns:
+        The estimate of each migration.
+    """
+    entries = migration_ledger.get_entries()
+    collection_names = db.list_collection_names()
+    return [
+        estimate(
+            migration,
+            get_referenced_collections(db, migration, collection_names),
+            entries,
+        )
+        for migration in migrations
+    ]
+
+
+def print_plan(estimates: List[Estimate]):
+    """
+    Print the estimate of each migration and the total.
+    Args:
+        estimates: The estimates of the migrations.
+    """
+    print(f"[+] Upgrade plan ({len(estimates)} migrations):")
+    for item in estimates:
+        sizes = ", ".join(
+            f"{name}: {count} docs" for name, count in item.collections.items()
+        )
+        method = f" ({item.method})" if item.method else ""
+        print(
+            f"    {item.migration} | {sizes or 'no known collections'} | "
+            f"{format_duration(item.seconds)}{method}"
+        )
+
+    known = [item.seconds for item in estimates if item.seconds is not None]
+    unknown = len(estimates) - len(known)
+    total = format_duration(sum(known)) if known else "unknown"
+    suffix = f" ({unknown} migrations without estimate)" if known and unknown else ""
+    print(f"[+] Estimated total: {total}{suffix}")
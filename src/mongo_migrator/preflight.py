@@ -0,0 +1,320 @@
+"""
+Explain-based preflight of the pending migrations.
+
+Each migration runs against a RecordingDatabase (see proxies), so its operations
+are captured without writing anything. The filter of every captured operation is
+then explained on the real database, to report collection scans, the indexes
+that would avoid them and the documents each filter would examine.
+
+The dry run of an upgrade runs the migrations against a DryRunDatabase instead,
+to report the documents and bytes each one would write.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import json_util
+from pymongo.database import Database
+
+from mongo_migrator.migration_history import MigrationNode
+from mongo_migrator.profiling import format_size
+from mongo_migrator.progress import MigrationContext
+from mongo_migrator.proxies import (
+    DryRunDatabase,
+    RecordedOperation,
+    RecordingDatabase,
+)
+
+# Operations whose filter is explained
+FILTER_OPERATIONS = {
+    "find",
+    "find_one",
+    "count_documents",
+    "distinct",
+    "aggregate",
+    "update_one",
+    "update_many",
+    "replace_one",
+    "delete_one",
+    "delete_many",
+    "find_one_and_update",
+    "find_one_and_replace",
+    "find_one_and_delete",
+}
+# Maximum length of the filters printed in the report
+MAX_FILTER_LENGTH = 120
+
+
+class FilterReport:
+    """Query plan of a filter captured from a migration"""
+
+    def __init__(self, collection: str, filter: dict, operations: List[str]):
+        """
+        Args:
+            collection: The name of the collection.
+            filter: The filter.
+            operations: The operations that used the filter.
+        Attributes:
+            stages: The stages of the winning plan.
+            indexes: The indexes used by the winning plan.
+            examined: The documents the filter would examine.
+            estimated: Whether examined is an estimate (the collection size) instead
+                of the execution stats.
+            error: The error of the explain, if it failed.
+        """
+        self.collection = collection
+        self.filter = filter
+        self.operations = operations
+        self.stages: List[str] = []
+        self.indexes: List[str] = []
+        self.examined: Optional[int] = None
+        self.estimated = False
+        self.error: Optional[str] = None
+
+    @property
+    def collscan(self) -> bool:
+        """Whether the winning plan scans the whole collection."""
+        return "COLLSCAN" in self.stages
+
+    @property
+    def blocking(self) -> bool:
+        """Whether the filter scans the collection although it filters documents."""
+        return self.collscan and bool(self.filter)
+
+    def __str__(self):
+        filter = json_util.dumps(self.filter)
+        if len(filter) > MAX_FILTER_LENGTH:
+            filter = filter[:MAX_FILTER_LENGTH] + "..."
+        line = f"{'/'.join(self.operations)} {self.collection} {filter} -> "
+        if self.error:
+            return line + f"explain failed: {self.error}"
+        if self.collscan:
+            line += "COLLSCAN"
+        else:
+            line += (
+                f"{' > '.join(self.stages)} ({', '.join(self.indexes) or 'no index'})"
+            )
+        if self.examined is not None:
+            approx = "~" if self.estimated else ""
+            line += f", {approx}{self.examined} docs examined"
+        if self.blocking:
+            fields = ", ".join(get_filter_fields(self.filter))
+            line += f". Missing index on: {fields or 'the filtered fields'}"
+        elif self.collscan:
+            line += " (no filter, whole collection)"
+        return line
+
+
+def get_plan_stages(plan: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    """
+    Get the stages and indexes of a query plan.
+    Args:
+        plan: The winning plan of an explain.
+    Returns:
+        The stages (from the root) and the names of the indexes used.
+    """
+    stages, indexes = [], []
+    pending = [plan]
+    while pending:
+        stage = pending.pop(0)
+        if "queryPlan" in stage:
+            # Slot based execution engine
+            pending.append(stage["queryPlan"])
+            continue
+        if "stage" in stage:
+            stages.append(stage["stage"])
+        if "indexName" in stage:
+            indexes.append(stage["indexName"])
+        if "inputStage" in stage:
+            pending.append(stage["inputStage"])
+        pending.extend(stage.get("inputStages", []))
+    return stages, indexes
+
+
+def get_filter_fields(filter: dict) -> List[str]:
+    """
+    Get the fields a filter matches on, which an index should cover.
+    Args:
+        filter: The filter.
+    Returns:
+        The fields, in order of appearance.
+    """
+    fields: List[str] = []
+    pending = [filter]
+    while pending:
+        current = pending.pop(0)
+        for key, value in current.items():
+            if key in ("$and", "$or", "$nor"):
+                pending.extend(value)
+            elif not key.startswith("$") and key not in fields:
+                fields.append(key)
+    return fields
+
+
+def explain(
+    db: Database, collection: str, filter: dict, execution_stats: bool = False
+) -> Dict[str, Any]:
+    """
+    Explain a filter as a find on a collection.
+    Args:
+        db: The real database.
+        collection: The name of the collection.
+        filter: The filter.
+        execution_stats: Whether to run the query to get the examined documents.
+            Otherwise only the plan is computed.
+    Returns:
+        The output of the explain command.
+    """
+    verbosity = "executionStats" if execution_stats else "queryPlanner"
+    return db.command(
+        "explain", {"find": collection, "filter": filter}, verbosity=verbosity
+    )
+
+
+def analyze(
+    db: Database,
+    operations: List[RecordedOperation],
+    execution_stats: bool = False,
+) -> List[FilterReport]:
+    """
+    Explain the filters of the captured operations.
+    Each distinct filter of a collection is explained once.
+    Args:
+        db: The real database.
+        operations: The captured operations.
+        execution_stats: Whether to run the queries to get the examined documents.
+            Otherwise, collection scans are estimated to examine every document.
+    Returns:
+        The report of each distinct filter.
+    """
+    reports: Dict[Tuple[str, str], FilterReport] = {}
+    for operation in operations:
+        if operation.operation not in FILTER_OPERATIONS or operation.filter is None:
+            continue
+        key = (operation.collection, json_util.dumps(operation.filter, sort_keys=True))
+        if key in reports:
+            if operation.operation not in reports[key].operations:
+                reports[key].operations.append(operation.operation)
+            continue
+        reports[key] = FilterReport(
+            operation.collection, operation.filter, [operation.operation]
+        )
+
+    for report in reports.values():
+        try:
+            output = explain(db, report.collection, report.filter, execution_stats)
+        except Exception as err:
+            report.error = str(err)
+            continue
+        plan = output.get("queryPlanner", {}).get("winningPlan", {})
+        report.stages, report.indexes = get_plan_stages(plan)
+        if "executionStats" in output:
+            report.examined = output["executionStats"].get("totalDocsExamined")
+        elif report.collscan:
+            report.examined = db[report.collection].estimated_document_count()
+            report.estimated = True
+    return list(reports.values())
+
+
+def run_on_proxy(
+    proxy: RecordingDatabase, migration: MigrationNode, direction: str = "upgrade"
+) -> Optional[str]:
+    """
+    Run a migration against a proxy of the database.
+    Migrations that accept a context get one without reporter.
+    Args:
+        proxy: The proxy of the database (e.g. RecordingDatabase).
+        migration: The migration.
+        direction: 'upgrade' or 'downgrade'.
+    Returns:
+        The error raised by the migration, if any.
+    """
+    ctx = MigrationContext(migration, direction)
+    try:
+        with ctx:
+            if direction == "upgrade":
+                migration.upgrade(proxy, ctx)
+            else:
+                migration.downgrade(proxy, ctx)
+    except Exception as err:
+        return f"{type(err).__name__}: {err}"
+    return None
+
+
+def record(
+    db: Database, migration: MigrationNode, direction: str = "upgrade"
+) -> Tuple[List[RecordedOperation], Optional[str]]:
+    """
+    Run a migration against a recording proxy of the database.
+    Args:
+        db: The real database. Nothing is written to it.
+        migration: The migration.
+        direction: 'upgrade' or 'downgrade'.
+    Returns:
+        The captured operations, and the error raised by the migration if any.
+    """
+    proxy = RecordingDatabase(db)
+    error = run_on_proxy(proxy, migration, direction)
+    return proxy.operations, error
+
+
+def print_reports(
+    db: Database, migrations: List[MigrationNode], execution_stats: bool = False
+) -> int:
+    """
+    Record the operations of each migration and print the report of their filters
+    (see record and analyze).
+    Args:
+        db: The real database. Nothing is written to it.
+        migrations: The migrations to check.
+        execution_stats: Whether to run the queries to get the examined documents.
+    Returns:
+        The number of filters that would scan a whole collection.
+    """
+    blocking = 0
+    for migration in migrations:
+        print(f"[*] {migration.version} ({migration.title})")
+        operations, error = record(db, migration)
+        if error:
+            print(f"[!] Raised under the recording proxy: {error}")
+        reports = analyze(db, operations, execution_stats)
+        if not reports:
+            print("    No filters to explain.")
+        for report in reports:
+            prefix = "[F]" if report.blocking else "[!]" if report.collscan else "[+]"
+            print(f"{prefix} {report}")
+            blocking += int(report.blocking)
+    return blocking
+
+
+def dry_run(db: Database, migrations: List[MigrationNode]):
+    """
+    Run the migrations of an upgrade against a dry run proxy of the database, and
+    print the documents and bytes each one would write.
+    The reads of the migrations are sent to the database, the writes are not.
+    Args:
+        db: The database.
+        migrations: The migrations to run.
+    """
+    print(f"[*] Dry run of {len(migrations)} migrations. Nothing is written.")
+    documents = size = 0
+    for migration in migrations:
+        print(f"[*] Dry run of migration: {migration}")
+        proxy = DryRunDatabase(db)
+        error = run_on_proxy(proxy, migration)
+        if error:
+            print(f"[!] Raised during the dry run: {error}")
+        for estimate in proxy.estimates.values():
+            target = estimate.collection or db.name
+            approx = "~" if estimate.estimated else ""
+            print(
+                f"    {estimate.operation} {target}: {estimate.calls} calls, "
+                f"{estimate.documents} docs, "
+                f"{approx}{format_size(estimate.bytes)}"
+            )
+        print(f"[+] Would write {proxy.documents} docs ({format_size(proxy.bytes)})")
+        documents += proxy.documents
+        size += proxy.bytes
+    print(
+        f"[+] Dry run total: {documents} docs ({format_size(size)}). "
+        "Current version unchanged."
+    )
@@ -0,0 +1,115 @@
+"""
+CPU and memory profiling of the migrations.
+
+With --profile, each migration runs under cProfile and its stats are written to
+'<directory>/<version>_<direction>.pstats' (readable with pstats or snakeviz).
+With --profile-memory, allocations are traced with tracemalloc and the peak and
+top allocations are written to '<directory>/<version>_<direction>.memory.txt'.
+"""
+
+import cProfile
+import os
+import tracemalloc
+
+from contextlib import contextmanager
+from typing import Iterator, List
+
+DEFAULT_DIRECTORY = "profiles"
+DEFAULT_TOP_N = 20
+
+
+def format_size(size: int) -> str:
+    """
+    Format a size in bytes for humans.
+    Args:
+        size: The size in bytes.
+    Returns:
+        The formatted size (e.g. '1.5 MiB').
+    """
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def write_memory_report(
+    file_path: str, peak: int, snapshot: tracemalloc.Snapshot, top_n: int
+):
+    """
+    Write the peak memory and top allocations of a migration.
+    Args:
+        file_path: The path of the report.
+        peak: The peak of traced memory in bytes.
+        snapshot: The snapshot of the allocations at the end of the migration.
+        top_n: The number of allocations to report.
+    """
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+    )
+    lines: List[str] = [f"Peak memory: {format_size(peak)}", ""]
+    lines.append(f"Top {top_n} allocations alive at the end of the migration:")
+    for index, stat in enumerate(snapshot.statistics("lineno")[:top_n], 1):
+        frame = stat.traceback[0]
+        lines.append(
+            f"{index:>3}. {frame.filename}:{frame.lineno}: "
+            f"{format_size(stat.size)} in {stat.count} blocks"
+        )
+    with open(file_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@contextmanager
+def profile(
+    name: str,
+    directory: str = DEFAULT_DIRECTORY,
+    cpu: bool = True,
+    memory: bool = False,
+    top_n: int = DEFAULT_TOP_N,
+) -> Iterator[None]:
+    """
+    Profile the code run inside the context.
+    Args:
+        name: The name of the profile files (e.g. '<version>_upgrade').
+        directory: The directory of the profile files. Created if needed.
+        cpu: Whether to profile the CPU time with cProfile.
+        memory: Whether to trace the memory allocations with tracemalloc.
+        top_n: The number of allocations of the memory report.
+    """
+    if not cpu and not memory:
+        yield
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    profiler = cProfile.Profile() if cpu else None
+    started_tracing = False
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracemalloc.reset_peak()
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            stats_path = os.path.join(directory, f"{name}.pstats")
+            profiler.dump_stats(stats_path)
+            print(f"[+] CPU profile written to: {stats_path}")
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            report_path = os.path.join(directory, f"{name}.memory.txt")
+            write_memory_report(report_path, peak, snapshot, top_n)
+            print(
+                f"[+] Memory report written to: {report_path} "
+                f"(peak {format_size(peak)})"
+            )
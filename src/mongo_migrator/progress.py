@@ -0,0 +1,186 @@
+"""
+Progress reporting of the migrations.
+
+Migrations whose upgrade or downgrade functions declare a ctx parameter (or a
+second positional parameter without a default) receive a MigrationContext, to
+report their progress while they run:
+```
+def upgrade(db, ctx):
+    total = db["users"].estimated_document_count()
+    for done, batch in enumerate(batches, 1):
+        ...
+        ctx.progress(total, done * len(batch))
+```
+
+The CLI prints the percentage, rate (docs/s) and ETA of the progress, or one JSON
+object per line with --progress-json. The ops helpers report their progress to
+the context of the running migration too.
+"""
+
+import json
+import sys
+import time
+
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, TextIO
+
+# Context of the migration running in the current context (see MigrationContext)
+_current_context: ContextVar[Optional["MigrationContext"]] = ContextVar(
+    "current_context", default=None
+)
+
+
+def get_current_context() -> Optional["MigrationContext"]:
+    """
+    Get the context of the running migration.
+    Returns:
+        The context, or None if no migration is running.
+    """
+    return _current_context.get()
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    """
+    Format the remaining time of a migration.
+    Args:
+        seconds: The remaining seconds. None if unknown.
+    Returns:
+        The formatted time (e.g. '1h 02m 03s').
+    """
+    if seconds is None:
+        return "--"
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m {seconds:02d}s"
+    return f"{minutes}m {seconds:02d}s"
+
+
+class ProgressReporter:
+    """
+    Renders the progress reported by the migrations.
+    """
+
+    def __init__(
+        self, json_lines: bool = False, interval: float = 1.0, stream: TextIO = None
+    ):
+        """
+        Create the reporter.
+        Args:
+            json_lines: Whether to write one JSON object per line instead of text.
+            interval: The minimum seconds between two reports of a migration.
+                The first and the last reports are always written.
+            stream: Where the reports are written. stdout by default.
+        """
+        self.json_lines = json_lines
+        self.interval = interval
+        self.stream = stream
+
+    def report(self, ctx: "MigrationContext", snapshot: Dict[str, Any]):
+        """
+        Write a snapshot of the progress of a migration.
+        Args:
+            ctx: The context of the migration.
+            snapshot: The progress (see MigrationContext.snapshot).
+        """
+        stream = self.stream or sys.stdout
+        if self.json_lines:
+            line = json.dumps({"event": "progress", **snapshot})
+        else:
+            total = snapshot["total"]
+            percent = f"{snapshot['percent']:.1f}%" if total else "?%"
+            line = (
+                f"[*] {ctx.migration}: {percent} "
+                f"({snapshot['done']}/{total if total else '?'}) | "
+                f"{snapshot['rate']:.0f} docs/s | ETA {format_eta(snapshot['eta'])}"
+            )
+        stream.write(line + "\n")
+        stream.flush()
+
+
+class MigrationContext:
+    """
+    Context passed to the migrations that accept it, to report their progress.
+    """
+
+    def __init__(self, migration, direction: str, reporter: ProgressReporter = None):
+        """
+        Create the context of a migration run.
+        Args:
+            migration: The migration node being run.
+            direction: 'upgrade' or 'downgrade'.
+            reporter: Where the progress is reported. Nowhere by default.
+        Attributes:
+            migration: The migration node being run.
+            direction: 'upgrade' or 'downgrade'.
+        """
+        self.migration = migration
+        self.direction = direction
+        self.reporter = reporter
+        self._started = time.perf_counter()
+        self._last_done = 0
+        self._last_report = None
+        self._token = None
+
+    def __enter__(self) -> "MigrationContext":
+        """Make this context the one of the running migration."""
+        self._token = _current_context.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_context.reset(self._token)
+
+    def snapshot(self, total: Optional[int], done: int) -> Dict[str, Any]:
+        """
+        Compute the rate and ETA of the progress of the migration.
+        Args:
+            total: The total number of documents. None if unknown.
+            done: The number of documents processed.
+        Returns:
+            The progress, as a JSON serializable dictionary.
+        """
+        now = time.perf_counter()
+        if done < self._last_done:
+            # A new operation of the migration started counting from zero
+            self._started = now
+        self._last_done = done
+        elapsed = now - self._started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if total and rate > 0:
+            eta = max(total - done, 0) / rate
+        return {
+            "version": self.migration.version,
+            "title": self.migration.title,
+            "direction": self.direction,
+            "total": total,
+            "done": done,
+            "percent": min(100.0, done * 100 / total) if total else None,
+            "rate": rate,
+            "elapsed": elapsed,
+            "eta": eta,
+            "time": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def progress(self, total: Optional[int], done: int):
+        """
+        Report the progress of the migration. Meant to be called once per batch.
+        Reports are throttled by the interval of the reporter.
+        Args:
+            total: The total number of documents to process. None if unknown.
+            done: The number of documents processed so far.
+        """
+        if self.reporter is None:
+            return
+        now = time.perf_counter()
+        finished = total is not None and done >= total
+        if (
+            self._last_report is not None
+            and not finished
+            and now - self._last_report < self.reporter.interval
+        ):
+            return
+        self._last_report = now
+        self.reporter.report(self, self.snapshot(total, done))
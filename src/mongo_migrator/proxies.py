@@ -0,0 +1,567 @@
+"""
+Proxies of pymongo databases used to inspect migrations without running them.
+
+RecordingDatabase records the operations a migration issues (with their filters)
+instead of running them. Reads return no documents and writes are not sent, so
+nothing is modified. Metadata (e.g. collection names and estimated counts) is
+read from the real database.
+
+DryRunDatabase lets the reads through to the real database and measures each
+write instead: the documents it would touch (matched, deleted or inserted) and
+their size in bytes.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bson
+from pymongo import (
+    DeleteMany,
+    DeleteOne,
+    InsertOne,
+    ReplaceOne,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+# Operation names of the write models of bulk_write
+WRITE_MODEL_OPERATIONS = {
+    InsertOne: "insert_one",
+    UpdateOne: "update_one",
+    UpdateMany: "update_many",
+    ReplaceOne: "replace_one",
+    DeleteOne: "delete_one",
+    DeleteMany: "delete_many",
+}
+# Writes that touch at most one document
+SINGLE_DOCUMENT_OPERATIONS = {
+    "update_one",
+    "replace_one",
+    "delete_one",
+    "find_one_and_update",
+    "find_one_and_replace",
+    "find_one_and_delete",
+}
+# Documents sampled to estimate the sizes when $bsonSize is not supported
+SAMPLE_SIZE = 100
+
+
+class RecordedOperation:
+    """An operation issued by a migration on a proxy"""
+
+    def __init__(
+        self,
+        collection: Optional[str],
+        operation: str,
+        filter: dict = None,
+        update: Any = None,
+        documents: List[dict] = None,
+    ):
+        """
+        Args:
+            collection: The name of the collection. None for database operations.
+            operation: The name of the method called (e.g. 'update_many').
+            filter: The filter of the operation, if any.
+            update: The update, replacement or pipeline of the operation, if any.
+            documents: The documents inserted by the operation, if any.
+        """
+        self.collection = collection
+        self.operation = operation
+        self.filter = filter
+        self.update = update
+        self.documents = documents or []
+
+    def __repr__(self):
+        return (
+            f"RecordedOperation(collection={self.collection}, "
+            f"operation={self.operation}, filter={self.filter})"
+        )
+
+
+class EmptyCursor:
+    """Cursor without documents, returned by the reads of the proxies"""
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter([])
+
+    def __next__(self) -> dict:
+        raise StopIteration
+
+    def _chain(self, *args, **kwargs) -> "EmptyCursor":
+        return self
+
+    sort = limit = skip = batch_size = hint = max_time_ms = comment = _chain
+    collation = allow_disk_use = projection = _chain
+
+    def to_list(self, *args, **kwargs) -> List[dict]:
+        return []
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> "EmptyCursor":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class RecordingCollection:
+    """
+    Proxy of a collection that records the operations instead of running them.
+    """
+
+    def __init__(self, database: "RecordingDatabase", collection: Collection):
+        """
+        Args:
+            database: The proxy of the database of the collection.
+            collection: The real collection.
+        """
+        self._database = database
+        self._collection = collection
+
+    @property
+    def name(self) -> str:
+        return self._collection.name
+
+    @property
+    def full_name(self) -> str:
+        return self._collection.full_name
+
+    @property
+    def database(self) -> "RecordingDatabase":
+        return self._database
+
+    def _record(
+        self,
+        operation: str,
+        filter: dict = None,
+        update: Any = None,
+        documents: List[dict] = None,
+    ) -> RecordedOperation:
+        """Private method to record an operation on the collection."""
+        recorded = RecordedOperation(self.name, operation, filter, update, documents)
+        self._database.operations.append(recorded)
+        return recorded
+
+    def __getitem__(self, name: str) -> "RecordingCollection":
+        return type(self)(self._database, self._collection[name])
+
+    def __getattr__(self, name: str) -> "RecordingCollection":
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def with_options(self, *args, **kwargs) -> "RecordingCollection":
+        return self
+
+    # Metadata, read from the real collection
+    def estimated_document_count(self, **kwargs) -> int:
+        return self._collection.estimated_document_count(**kwargs)
+
+    def index_information(self, **kwargs) -> Dict[str, Any]:
+        return self._collection.index_information(**kwargs)
+
+    # Reads, recorded without documents
+    def find(self, filter: dict = None, *args, **kwargs) -> EmptyCursor:
+        self._record("find", filter or {})
+        return EmptyCursor()
+
+    def find_one(self, filter: Any = None, *args, **kwargs) -> None:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        self._record("find_one", filter or {})
+        return None
+
+    def count_documents(self, filter: dict, **kwargs) -> int:
+        self._record("count_documents", filter)
+        return 0
+
+    def distinct(self, key: str, filter: dict = None, **kwargs) -> List[Any]:
+        self._record("distinct", filter or {})
+        return []
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> EmptyCursor:
+        filter = pipeline[0].get("$match") if pipeline else None
+        self._record("aggregate", filter, pipeline)
+        return EmptyCursor()
+
+    # Writes, recorded and not sent
+    def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        self._record("insert_one", documents=[document])
+        return InsertOneResult(document.get("_id"), True)
+
+    def insert_many(self, documents: List[dict], **kwargs) -> InsertManyResult:
+        documents = list(documents)
+        self._record("insert_many", documents=documents)
+        return InsertManyResult([doc.get("_id") for doc in documents], True)
+
+    def _update(self, operation: str, filter: dict, update: Any) -> UpdateResult:
+        self._record(operation, filter, update)
+        return UpdateResult({"n": 0, "nModified": 0}, True)
+
+    def update_one(self, filter: dict, update: Any, **kwargs) -> UpdateResult:
+        return self._update("update_one", filter, update)
+
+    def update_many(self, filter: dict, update: Any, **kwargs) -> UpdateResult:
+        return self._update("update_many", filter, update)
+
+    def replace_one(self, filter: dict, replacement: dict, **kwargs) -> UpdateResult:
+        return self._update("replace_one", filter, replacement)
+
+    def _delete(self, operation: str, filter: dict) -> DeleteResult:
+        self._record(operation, filter)
+        return DeleteResult({"n": 0}, True)
+
+    def delete_one(self, filter: dict, **kwargs) -> DeleteResult:
+        return self._delete("delete_one", filter)
+
+    def delete_many(self, filter: dict, **kwargs) -> DeleteResult:
+        return self._delete("delete_many", filter)
+
+    def find_one_and_update(self, filter: dict, update: Any, **kwargs) -> None:
+        self._record("find_one_and_update", filter, update)
+        return None
+
+    def find_one_and_replace(self, filter: dict, replacement: dict, **kwargs) -> None:
+        self._record("find_one_and_replace", filter, replacement)
+        return None
+
+    def find_one_and_delete(self, filter: dict, **kwargs) -> None:
+        self._record("find_one_and_delete", filter)
+        return None
+
+    def bulk_write(self, requests: List[Any], **kwargs) -> BulkWriteResult:
+        for request in requests:
+            operation = WRITE_MODEL_OPERATIONS.get(type(request), "bulk_write")
+            if isinstance(request, InsertOne):
+                self._record(operation, documents=[request._doc])
+            else:
+                self._record(
+                    operation,
+                    getattr(request, "_filter", None),
+                    getattr(request, "_doc", None),
+                )
+        result = {
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+        }
+        return BulkWriteResult(result, True)
+
+    def create_index(self, keys: Any, **kwargs) -> str:
+        self._record("create_index", update=keys)
+        return "recorded"
+
+    def create_indexes(self, indexes: List[Any], **kwargs) -> List[str]:
+        self._record("create_indexes", update=indexes)
+        return ["recorded"] * len(indexes)
+
+    def drop_index(self, index: Any, **kwargs) -> None:
+        self._record("drop_index", update=index)
+
+    def drop_indexes(self, **kwargs) -> None:
+        self._record("drop_indexes")
+
+    def drop(self, **kwargs) -> None:
+        self._record("drop")
+
+    def rename(self, new_name: str, **kwargs) -> None:
+        self._record("rename", update=new_name)
+
+
+class RecordingDatabase:
+    """
+    Proxy of a database that records the operations of a migration instead of
+    running them.
+    """
+
+    collection_class = RecordingCollection
+
+    def __init__(self, db: Database):
+        """
+        Args:
+            db: The real database.
+        Attributes:
+            operations: The operations recorded, in order.
+        """
+        self._db = db
+        self.operations: List[RecordedOperation] = []
+
+    @property
+    def name(self) -> str:
+        return self._db.name
+
+    @property
+    def client(self) -> None:
+        """
+        Not available, so the helpers that open their own connections (e.g. the
+        worker processes of ops.parallel_update) refuse to run.
+        """
+        return None
+
+    def __getitem__(self, name: str) -> RecordingCollection:
+        return self.collection_class(self, self._db[name])
+
+    def __getattr__(self, name: str) -> RecordingCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name: str, *args, **kwargs) -> RecordingCollection:
+        return self[name]
+
+    def with_options(self, *args, **kwargs) -> "RecordingDatabase":
+        return self
+
+    # Metadata, read from the real database
+    def list_collection_names(self, **kwargs) -> List[str]:
+        return self._db.list_collection_names(**kwargs)
+
+    # Writes, recorded and not sent
+    def create_collection(self, name: str, **kwargs) -> RecordingCollection:
+        self.operations.append(RecordedOperation(name, "create_collection"))
+        return self[name]
+
+    def drop_collection(self, name: Any, **kwargs) -> None:
+        name = getattr(name, "name", name)
+        self.operations.append(RecordedOperation(name, "drop_collection"))
+
+    def command(self, command: Any, *args, **kwargs) -> Dict[str, Any]:
+        if isinstance(command, str):
+            command = {command: args[0] if args else 1}
+        self.operations.append(RecordedOperation(None, "command", update=command))
+        return {"ok": 1.0}
+
+
+class WriteEstimate:
+    """Documents and bytes touched by the writes of an operation on a collection"""
+
+    def __init__(self, collection: Optional[str], operation: str):
+        """
+        Args:
+            collection: The name of the collection. None for database operations.
+            operation: The name of the method called (e.g. 'update_many').
+        Attributes:
+            calls: The number of writes.
+            documents: The documents matched, deleted or inserted by the writes.
+            bytes: The size of those documents (before the writes).
+            estimated: Whether the bytes were estimated from a sample.
+        """
+        self.collection = collection
+        self.operation = operation
+        self.calls = 0
+        self.documents = 0
+        self.bytes = 0
+        self.estimated = False
+
+    def add(self, documents: int, size: int, estimated: bool = False, calls: int = 1):
+        """
+        Add the documents touched by writes.
+        Args:
+            documents: The documents touched.
+            size: Their size in bytes.
+            estimated: Whether the size was estimated from a sample.
+            calls: The number of writes.
+        """
+        self.calls += calls
+        self.documents += documents
+        self.bytes += size
+        self.estimated = self.estimated or estimated
+
+
+def _is_id_filter(filter: Any) -> bool:
+    """Private function to check if a filter matches a single _id by equality."""
+    if not isinstance(filter, dict) or list(filter) != ["_id"]:
+        return False
+    value = filter["_id"]
+    return not (isinstance(value, dict) and any(k.startswith("$") for k in value))
+
+
+class DryRunCollection(RecordingCollection):
+    """
+    Proxy of a collection that lets the reads through and measures the writes
+    instead of running them.
+    """
+
+    # Reads, from the real collection
+    def find(self, *args, **kwargs):
+        return self._collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        return self._collection.find_one(*args, **kwargs)
+
+    def count_documents(self, filter: dict, **kwargs) -> int:
+        return self._collection.count_documents(filter, **kwargs)
+
+    def distinct(self, key: str, filter: dict = None, **kwargs) -> List[Any]:
+        return self._collection.distinct(key, filter, **kwargs)
+
+    def aggregate(self, pipeline: List[dict], **kwargs):
+        if pipeline and ("$out" in pipeline[-1] or "$merge" in pipeline[-1]):
+            # Writes the results to a collection
+            self._record("aggregate", pipeline[0].get("$match", {}), pipeline)
+            return EmptyCursor()
+        return self._collection.aggregate(pipeline, **kwargs)
+
+    def find_one_and_update(self, filter: dict, update: Any, **kwargs):
+        self._record("find_one_and_update", filter, update)
+        return self._collection.find_one(filter)
+
+    def find_one_and_replace(self, filter: dict, replacement: dict, **kwargs):
+        self._record("find_one_and_replace", filter, replacement)
+        return self._collection.find_one(filter)
+
+    def find_one_and_delete(self, filter: dict, **kwargs):
+        self._record("find_one_and_delete", filter)
+        return self._collection.find_one(filter)
+
+    # Writes, measured and not sent
+    def measure(self, filter: dict, limit: int = None) -> Tuple[int, int, bool]:
+        """
+        Measure the documents matched by a filter in one round trip.
+        Servers without $bsonSize (< 4.4) estimate the size from a sample.
+        Args:
+            filter: The filter.
+            limit: The maximum number of documents matched.
+        Returns:
+            The number of documents, their size in bytes and whether the size is
+            estimated.
+        """
+        pipeline: List[dict] = [{"$match": filter}]
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.append(
+            {
+                "$group": {
+                    "_id": None,
+                    "documents": {"$sum": 1},
+                    "bytes": {"$sum": {"$bsonSize": "$$ROOT"}},
+                }
+            }
+        )
+        try:
+            result = next(iter(self._collection.aggregate(pipeline)), None)
+        except OperationFailure:
+            kwargs = {"limit": limit} if limit else {}
+            documents = self._collection.count_documents(filter, **kwargs)
+            sample = list(self._collection.find(filter, limit=SAMPLE_SIZE))
+            if not sample:
+                return documents, 0, False
+            average = sum(len(bson.encode(doc)) for doc in sample) / len(sample)
+            return documents, int(average * documents), True
+        if result is None:
+            return 0, 0, False
+        return result["documents"], result["bytes"], False
+
+    def _record(
+        self,
+        operation: str,
+        filter: dict = None,
+        update: Any = None,
+        documents: List[dict] = None,
+    ) -> RecordedOperation:
+        """Private method to record and measure a write on the collection."""
+        recorded = super()._record(operation, filter, update, documents)
+        estimate = self._database.get_estimate(self.name, operation)
+        if documents:
+            size = sum(len(bson.encode(doc)) for doc in documents)
+            estimate.add(len(documents), size)
+        elif filter is not None:
+            limit = 1 if operation in SINGLE_DOCUMENT_OPERATIONS else None
+            estimate.add(*self.measure(filter, limit))
+        elif operation == "drop":
+            estimate.add(*self.measure({}))
+        else:
+            estimate.add(0, 0)
+        return recorded
+
+    def bulk_write(self, requests: List[Any], **kwargs) -> BulkWriteResult:
+        # Writes by _id are measured together, one round trip per operation
+        by_id: Dict[str, List[Any]] = {}
+        others = []
+        for request in requests:
+            operation = WRITE_MODEL_OPERATIONS.get(type(request), "bulk_write")
+            filter = getattr(request, "_filter", None)
+            if _is_id_filter(filter):
+                by_id.setdefault(operation, []).append(filter["_id"])
+                RecordingCollection._record(
+                    self, operation, filter, getattr(request, "_doc", None)
+                )
+            else:
+                others.append(request)
+        for operation, ids in by_id.items():
+            documents, size, estimated = self.measure({"_id": {"$in": ids}})
+            self._database.get_estimate(self.name, operation).add(
+                documents, size, estimated, calls=len(ids)
+            )
+        return super().bulk_write(others, **kwargs)
+
+
+class DryRunDatabase(RecordingDatabase):
+    """
+    Proxy of a database that lets the reads of a migration through and measures
+    its writes instead of running them.
+    """
+
+    collection_class = DryRunCollection
+
+    def __init__(self, db: Database):
+        """
+        Args:
+            db: The real database.
+        Attributes:
+            operations: The writes recorded, in order.
+            estimates: The documents and bytes touched by the writes, by
+                collection and operation.
+        """
+        super().__init__(db)
+        self.estimates: Dict[Tuple[Optional[str], str], WriteEstimate] = {}
+
+    def get_estimate(self, collection: Optional[str], operation: str) -> WriteEstimate:
+        """
+        Get the estimate of an operation on a collection, created if needed.
+        Args:
+            collection: The name of the collection.
+            operation: The name of the operation.
+        Returns:
+            The estimate.
+        """
+        key = (collection, operation)
+        if key not in self.estimates:
+            self.estimates[key] = WriteEstimate(collection, operation)
+        return self.estimates[key]
+
+    @property
+    def documents(self) -> int:
+        """The documents touched by all the writes."""
+        return sum(estimate.documents for estimate in self.estimates.values())
+
+    @property
+    def bytes(self) -> int:
+        """The size of the documents touched by all the writes."""
+        return sum(estimate.bytes for estimate in self.estimates.values())
+
+    def create_collection(self, name: str, **kwargs) -> DryRunCollection:
+        self.get_estimate(name, "create_collection").add(0, 0)
+        return super().create_collection(name, **kwargs)
+
+    def drop_collection(self, name: Any, **kwargs) -> None:
+        self[getattr(name, "name", name)].drop()
+
+    def command(self, command: Any, *args, **kwargs) -> Dict[str, Any]:
+        response = super().command(command, *args, **kwargs)
+        self.get_estimate(None, "command").add(0, 0)
+        return response
@@ -0,0 +1,288 @@
+"""
+Throttling of the data migrations by replication lag and server load.
+
+When a [throttle] section is configured, the ops helpers check the cluster between
+batches: the replication lag of the secondaries (replSetGetStatus), the operations
+queued for the global lock and the available write tickets of the storage engine
+(serverStatus). While a threshold is exceeded, the batches are halved and the
+helpers sleep with exponential backoff. Once the cluster recovers, the batches grow
+back to their configured size.
+```
+[throttle]
+max_lag = 10
+max_queued = 50
+min_available_tickets = 8
+```
+"""
+
+import threading
+import time
+
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo.errors import OperationFailure
+
+DEFAULT_MAX_LAG = 10.0
+DEFAULT_MAX_QUEUED = 50
+DEFAULT_MIN_AVAILABLE_TICKETS = 8
+DEFAULT_CHECK_INTERVAL = 1.0
+DEFAULT_MIN_SLEEP = 0.5
+DEFAULT_MAX_SLEEP = 30.0
+# Smallest fraction of the configured batch size
+MIN_BATCH_FACTOR = 0.1
+# Fraction of the configured batch size recovered after each healthy check
+RAMP_UP_STEP = 0.1
+# State of the secondaries in replSetGetStatus
+SECONDARY_STATE = 2
+# Error codes of the commands the server (or the user) cannot run: Unauthorized,
+# CommandNotFound (e.g. replSetGetStatus on mongos) and NoReplicationEnabled
+UNSUPPORTED_CODES = (13, 59, 76)
+
+
+class ServerLoad:
+    """Load metrics of a cluster. Metrics that could not be read are None"""
+
+    def __init__(
+        self,
+        lag: Optional[float] = None,
+        queued: Optional[int] = None,
+        available_tickets: Optional[int] = None,
+    ):
+        """
+        Args:
+            lag: The replication lag of the slowest secondary in seconds.
+            queued: The operations queued for the global lock.
+            available_tickets: The available write tickets of the storage engine.
+        """
+        self.lag = lag
+        self.queued = queued
+        self.available_tickets = available_tickets
+
+
+def get_replication_lag(status: Dict[str, Any]) -> Optional[float]:
+    """
+    Get the replication lag of the slowest secondary.
+    Args:
+        status: The output of replSetGetStatus.
+    Returns:
+        The lag in seconds, or None if there is no primary or no secondary.
+    """
+    members = status.get("members", [])
+    primary = next((m for m in members if m.get("stateStr") == "PRIMARY"), None)
+    secondaries = [m for m in members if m.get("state") == SECONDARY_STATE]
+    if primary is None or not secondaries:
+        return None
+    optimes = [m.get("optimeDate") for m in secondaries]
+    optimes = [optime for optime in optimes if isinstance(optime, datetime)]
+    if not optimes or not isinstance(primary.get("optimeDate"), datetime):
+        return None
+    return max(0.0, (primary["optimeDate"] - min(optimes)).total_seconds())
+
+
+def get_available_tickets(status: Dict[str, Any]) -> Optional[int]:
+    """
+    Get the available write tickets of the storage engine.
+    Args:
+        status: The output of serverStatus.
+    Returns:
+        The available tickets, or None if they are not reported.
+    """
+    # MongoDB 7.0+ reports them in queues.execution
+    for section in (
+        status.get("queues", {}).get("execution", {}),
+        status.get("wiredTiger", {}).get("concurrentTransactions", {}),
+    ):
+        available = section.get("write", {}).get("available")
+        if available is not None:
+            return available
+    return None
+
+
+class Throttle:
+    """
+    Slows the data migrations down while the cluster is overloaded.
+    """
+
+    OPTIONS = (
+        "max_lag",
+        "max_queued",
+        "min_available_tickets",
+        "check_interval",
+        "min_sleep",
+        "max_sleep",
+    )
+
+    def __init__(
+        self,
+        max_lag: Optional[float] = DEFAULT_MAX_LAG,
+        max_queued: Optional[int] = DEFAULT_MAX_QUEUED,
+        min_available_tickets: Optional[int] = DEFAULT_MIN_AVAILABLE_TICKETS,
+        check_interval: float = DEFAULT_CHECK_INTERVAL,
+        min_sleep: float = DEFAULT_MIN_SLEEP,
+        max_sleep: float = DEFAULT_MAX_SLEEP,
+    ):
+        """
+        Create the throttle.
+        Args:
+            max_lag: The maximum replication lag in seconds. None to ignore it.
+            max_queued: The maximum operations queued for the global lock. None to
+                ignore them.
+            min_available_tickets: The minimum available write tickets. None to
+                ignore them.
+            check_interval: The minimum seconds between two checks of the cluster.
+            min_sleep: The first sleep when the cluster is overloaded, in seconds.
+                Doubled while it stays overloaded.
+            max_sleep: The maximum sleep in seconds.
+        Attributes:
+            factor: The fraction of the configured batch size to use.
+            throttled: The seconds slept because the cluster was overloaded.
+        """
+        self.max_lag = max_lag
+        self.max_queued = max_queued
+        self.min_available_tickets = min_available_tickets
+        self.check_interval = check_interval
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.factor = 1.0
+        self.throttled = 0.0
+        self._last_check: Optional[float] = None
+        # Commands the server refused (e.g. replSetGetStatus on a standalone)
+        self._unsupported = set()
+        # Whether a thread is checking the cluster (and backing off while it is
+        # overloaded). The other threads wait for it without holding the lock
+        self._checking = False
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_options(cls, options: Dict[str, Any]) -> "Throttle":
+        """
+        Create the throttle from the options of the [throttle] section.
+        Args:
+            options: The options, by name.
+        Raises:
+            ValueError: If an option is unknown.
+        Returns:
+            The throttle.
+        """
+        unknown = set(options) - set(cls.OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown throttle options: {', '.join(sorted(unknown))}")
+        return cls(**options)
+
+    def _command(self, client, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Private method to run an admin command, None if it is not supported or
+        failed. Only the commands the server refuses are not sent again, other
+        errors (e.g. a network error) skip this check.
+        """
+        if name in self._unsupported:
+            return None
+        try:
+            return client.admin.command(name)
+        except OperationFailure as err:
+            if err.code in UNSUPPORTED_CODES:
+                self._unsupported.add(name)
+            return None
+        except Exception:
+            return None
+
+    def get_load(self, client) -> ServerLoad:
+        """
+        Read the load metrics of the cluster.
+        Args:
+            client: The client of the cluster.
+        Returns:
+            The load. Metrics the server does not report (or the user cannot read)
+            are None.
+        """
+        load = ServerLoad()
+        if self.max_lag is not None:
+            status = self._command(client, "replSetGetStatus")
+            if status is not None:
+                load.lag = get_replication_lag(status)
+        if self.max_queued is not None or self.min_available_tickets is not None:
+            status = self._command(client, "serverStatus")
+            if status is not None:
+                queue = status.get("globalLock", {}).get("currentQueue", {})
+                load.queued = queue.get("total")
+                load.available_tickets = get_available_tickets(status)
+        return load
+
+    def get_overload(self, load: ServerLoad) -> Optional[str]:
+        """
+        Check the load against the thresholds.
+        Args:
+            load: The load of the cluster.
+        Returns:
+            The exceeded threshold, or None if the cluster is healthy.
+        """
+        if self.max_lag is not None and load.lag is not None:
+            if load.lag > self.max_lag:
+                return f"replication lag {load.lag:.1f}s > {self.max_lag}s"
+        if self.max_queued is not None and load.queued is not None:
+            if load.queued > self.max_queued:
+                return f"{load.queued} queued operations > {self.max_queued}"
+        if self.min_available_tickets is not None:
+            if load.available_tickets is not None:
+                if load.available_tickets < self.min_available_tickets:
+                    return (
+                        f"{load.available_tickets} write tickets available "
+                        f"< {self.min_available_tickets}"
+                    )
+        return None
+
+    def batch_size(self, batch_size: int) -> int:
+        """
+        Scale a batch size by the current load.
+        Args:
+            batch_size: The configured batch size.
+        Returns:
+            The batch size to use.
+        """
+        return max(1, int(batch_size * self.factor))
+
+    def wait(self, client, verbose: bool = True):
+        """
+        Check the cluster, and sleep while it is overloaded. Meant to be called
+        between batches. The cluster is checked at most once per check_interval, by
+        one thread at a time: the other threads calling wait meanwhile wait for it
+        to recover.
+        Args:
+            client: The client of the cluster.
+            verbose: Whether to print a message when the migration is throttled.
+        """
+        with self._condition:
+            if self._checking:
+                self._condition.wait_for(lambda: not self._checking)
+                return
+            now = time.monotonic()
+            if (
+                self._last_check is not None
+                and now - self._last_check < self.check_interval
+            ):
+                return
+            self._checking = True
+
+        # The lock is not held while the cluster is checked or while sleeping
+        try:
+            delay = self.min_sleep
+            while True:
+                overload = self.get_overload(self.get_load(client))
+                self._last_check = time.monotonic()
+                if overload is None:
+                    self.factor = min(1.0, self.factor + RAMP_UP_STEP)
+                    return
+                self.factor = max(MIN_BATCH_FACTOR, self.factor / 2)
+                if verbose:
+                    print(
+                        f"[!] Throttling: {overload}. Sleeping {delay:.1f}s, "
+                        f"batches at {self.factor:.0%}"
+                    )
+                time.sleep(delay)
+                self.throttled += delay
+                delay = min(delay * 2, self.max_sleep)
+        finally:
+            with self._condition:
+                self._checking = False
+                self._condition.notify_all()
@@ -0,0 +1,528 @@
+"""
+Distributed work queue for migrations that update very large collections.
+
+distributed_update splits a collection into _id ranges (see ops.partition) and
+stores each range as a work item in a collection next to the version collection
+('<collection>_partitions'). Any number of workers, on any host, claim the items
+with leases, renew them while they work and mark them as done:
+```
+from mongo_migrator import work_queue
+
+def transform(doc):
+    return {"$set": {"migrated": True}}
+
+def upgrade(db):
+    work_queue.distributed_update(db["events"], transform, partitions=64)
+```
+```
+$ mongo-migrator worker  # on every host
+```
+
+The coordinator (the upgrade command) works on the items too, and only returns
+once every item is done, so the version is not advanced before that. Items whose
+lease expires (e.g. their worker died) are claimed again by other workers.
+"""
+
+import os
+import socket
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import bson
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from mongo_migrator import ops
+
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_PARTITIONS = 16
+
+
+def get_worker_id() -> str:
+    """
+    Get the identifier of the current worker process.
+    Returns:
+        The hostname and the process id.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Work items of distributed updates, stored in the partitions collection.
+    Each item is an _id range of a collection to transform with a function of a
+    migration file.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, db: Database, collection_name: str = None):
+        """
+        Create the work queue.
+        Args:
+            db: The database where the partitions collection is stored.
+            collection_name: The name of the partitions collection.
+                By default, the one of ops.get_partitions_collection_name.
+        """
+        name = collection_name or ops.get_partitions_collection_name()
+        self.collection: Collection = db[name]
+
+    @staticmethod
+    def _now() -> datetime:
+        """Private method to get the current time, comparable across hosts."""
+        return datetime.now(timezone.utc)
+
+    def has_job(self, job: str) -> bool:
+        """
+        Check if the items of a job exist.
+        Args:
+            job: The name of the job.
+        Returns:
+            True if the job exists, False otherwise.
+        """
+        return self.collection.count_documents({"job": job}, limit=1) > 0
+
+    def create_job(
+        self,
+        job: str,
+        collection: Collection,
+        migration: str,
+        function: str,
+        ranges: List[Tuple[Any, Any]],
+        filter: dict = None,
+        projection: Any = None,
+        batch_size: int = 1000,
+    ) -> int:
+        """
+        Store one pending item per _id range of a collection.
+        Args:
+            job: The unique name of the job.
+            collection: The collection to update.
+            migration: The file name of the migration that defines the transform.
+            function: The name of the transform function.
+            ranges: The (lower, upper) _id ranges (see ops.partition).
+            filter: The filter of the documents to transform.
+            projection: The fields to read from each document.
+            batch_size: The number of documents per bulk_write.
+        Returns:
+            The number of items created.
+        """
+        self.collection.create_index([("job", ASCENDING), ("state", ASCENDING)])
+        now = self._now()
+        items = [
+            {
+                "_id": f"{job}:{index}",
+                "job": job,
+                "index": index,
+                "database": collection.database.name,
+                "collection": collection.name,
+                "migration": migration,
+                "function": function,
+                "lower": lower,
+                "upper": upper,
+                # Encoded, since the operators of a filter are not valid field names
+                "filter": bson.encode(filter) if filter else None,
+                "projection": projection,
+                "batch_size": batch_size,
+                "state": self.PENDING,
+                "owner": None,
+                "lease_until": None,
+                "attempts": 0,
+                "error": None,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for index, (lower, upper) in enumerate(ranges)
+        ]
+        self.collection.insert_many(items)
+        return len(items)
+
+    def retry_failed(self, job: str) -> int:
+        """
+        Make the failed items of a job pending again.
+        Args:
+            job: The name of the job.
+        Returns:
+            The number of items to retry.
+        """
+        result = self.collection.update_many(
+            {"job": job, "state": self.FAILED},
+            {"$set": {"state": self.PENDING, "owner": None, "error": None}},
+        )
+        return result.modified_count
+
+    def claim(
+        self,
+        worker_id: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        job: str = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Atomically claim a pending item, or a running item whose lease expired.
+        Args:
+            worker_id: The identifier of the worker.
+            lease_seconds: The time the item is leased to the worker.
+            job: If set, only items of this job are claimed.
+        Returns:
+            The claimed item, or None if there is no work.
+        """
+        now = self._now()
+        query = {
+            "$or": [
+                {"state": self.PENDING},
+                {"state": self.RUNNING, "lease_until": {"$lt": now}},
+            ]
+        }
+        if job is not None:
+            query["job"] = job
+        return self.collection.find_one_and_update(
+            query,
+            {
+                "$set": {
+                    "state": self.RUNNING,
+                    "owner": worker_id,
+                    "lease_until": now + timedelta(seconds=lease_seconds),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("job", ASCENDING), ("index", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def heartbeat(
+        self,
+        item_id: str,
+        worker_id: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    ) -> bool:
+        """
+        Renew the lease of an item.
+        Args:
+            item_id: The _id of the item.
+            worker_id: The identifier of the worker.
+            lease_seconds: The time the item is leased to the worker from now.
+        Returns:
+            True if the worker still owns the item, False if it was reclaimed.
+        """
+        now = self._now()
+        result = self.collection.update_one(
+            {"_id": item_id, "owner": worker_id, "state": self.RUNNING},
+            {
+                "$set": {
+                    "lease_until": now + timedelta(seconds=lease_seconds),
+                    "updated_at": now,
+                }
+            },
+        )
+        return result.matched_count == 1
+
+    def finish(self, item_id: str, worker_id: str, result: ops.PartitionResult) -> bool:
+        """
+        Mark an item as done, or as failed if the result has an error.
+        Args:
+            item_id: The _id of the item.
+            worker_id: The identifier of the worker.
+            result: The result of the update of the item.
+        Returns:
+            True if the worker still owned the item, False if it was reclaimed.
+        """
+        update = self.collection.update_one(
+            {"_id": item_id, "owner": worker_id, "state": self.RUNNING},
+            {
+                "$set": {
+                    "state": self.FAILED if result.error else self.DONE,
+                    "error": result.error,
+                    "processed": result.processed,
+                    "matched": result.matched,
+                    "modified": result.modified,
+                    "inserted": result.inserted,
+                    "deleted": result.deleted,
+                    "elapsed": result.elapsed,
+                    "lease_until": None,
+                    "updated_at": self._now(),
+                }
+            },
+        )
+        return update.matched_count == 1
+
+    def get_items(self, job: str) -> List[Dict[str, Any]]:
+        """
+        Get the items of a job.
+        Args:
+            job: The name of the job.
+        Returns:
+            The items sorted by _id range.
+        """
+        return list(self.collection.find({"job": job}).sort("index", ASCENDING))
+
+    def is_finished(self, job: str) -> bool:
+        """
+        Check if every item of a job is done or failed.
+        Args:
+            job: The name of the job.
+        Returns:
+            True if no item is pending or running, False otherwise.
+        """
+        query = {"job": job, "state": {"$in": [self.PENDING, self.RUNNING]}}
+        return self.collection.count_documents(query, limit=1) == 0
+
+    def delete_job(self, job: str):
+        """
+        Delete the items of a job.
+        Args:
+            job: The name of the job.
+        """
+        self.collection.delete_many({"job": job})
+
+
+def _to_result(item: Dict[str, Any]) -> ops.PartitionResult:
+    """
+    Private function to build the result of a partition from its item.
+    """
+    result = ops.PartitionResult(
+        item["collection"], item["index"], item["lower"], item["upper"]
+    )
+    result.error = item.get("error")
+    for counter in ("processed", "matched", "modified", "inserted", "deleted"):
+        setattr(result, counter, item.get(counter, 0))
+    result.finish()
+    return result
+
+
+def _keep_leased(
+    queue: WorkQueue,
+    item_id: str,
+    worker_id: str,
+    lease_seconds: float,
+    stop: threading.Event,
+    lost: threading.Event,
+):
+    """
+    Private function to renew the lease of an item until stopped.
+    Runs in a thread while the item is being updated. If the lease is lost, lost
+    is set, so the update stops before its next batch.
+    """
+    while not stop.wait(lease_seconds / 3):
+        if not queue.heartbeat(item_id, worker_id, lease_seconds):
+            print(f"[!] Lease of {item_id} lost. Another worker took it over.")
+            lost.set()
+            return
+
+
+def run_item(
+    queue: WorkQueue,
+    item: Dict[str, Any],
+    transform: Callable[[dict], Any],
+    worker_id: str,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+) -> ops.PartitionResult:
+    """
+    Update the _id range of a claimed item, renewing its lease meanwhile.
+    The progress is checkpointed, so an item reclaimed after a failure continues
+    from the last written batch. If the lease is lost, the update stops before
+    its next batch and its result is discarded.
+    Args:
+        queue: The work queue.
+        item: The claimed item.
+        transform: The transform of the item.
+        worker_id: The identifier of the worker.
+        lease_seconds: The time the item is leased to the worker.
+    Returns:
+        The result of the update.
+    """
+    client = queue.collection.database.client
+    collection = client[item["database"]][item["collection"]]
+
+    stop = threading.Event()
+    lost = threading.Event()
+    heartbeat = threading.Thread(
+        target=_keep_leased,
+        args=(queue, item["_id"], worker_id, lease_seconds, stop, lost),
+        daemon=True,
+    )
+    heartbeat.start()
+    try:
+        result = ops.update_partition(
+            collection,
+            transform,
+            item["index"],
+            item["lower"],
+            item["upper"],
+            bson.decode(item["filter"]) if item["filter"] else None,
+            item["projection"],
+            item["batch_size"],
+            resumable=item["job"],
+            cancelled=lost,
+        )
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    if not queue.finish(item["_id"], worker_id, result):
+        print(f"[!] Result of {item['_id']} discarded. Another worker took it over.")
+    return result
+
+
+def work(
+    queue: WorkQueue,
+    resolve: Callable[[Dict[str, Any]], Callable[[dict], Any]],
+    worker_id: str = None,
+    job: str = None,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    poll_interval: float = 1.0,
+    once: bool = False,
+    verbose: bool = True,
+) -> int:
+    """
+    Claim and update items until there is no work left (once) or forever.
+    Args:
+        queue: The work queue.
+        resolve: Function that returns the transform of an item.
+        worker_id: The identifier of the worker. By default, get_worker_id.
+        job: If set, only items of this job are claimed.
+        lease_seconds: The time each item is leased to the worker.
+        poll_interval: The seconds to wait for new work when the queue is empty.
+        once: Whether to return when the queue is empty instead of waiting.
+        verbose: Whether to print each item when it finishes.
+    Returns:
+        The number of items run.
+    """
+    worker_id = worker_id or get_worker_id()
+    count = 0
+    while True:
+        item = queue.claim(worker_id, lease_seconds, job)
+        if item is None:
+            if once:
+                return count
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            transform = resolve(item)
+        except Exception as err:
+            result = _to_result(item)
+            result.error = f"{type(err).__name__}: {err}"
+            queue.finish(item["_id"], worker_id, result)
+        else:
+            result = run_item(queue, item, transform, worker_id, lease_seconds)
+        count += 1
+        if verbose:
+            print(f"[*] {item['job']}: {result}")
+
+
+def distributed_update(
+    collection: Collection,
+    transform: Callable[[dict], Any],
+    partitions: int = DEFAULT_PARTITIONS,
+    job: str = None,
+    work_items: bool = True,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    poll_interval: float = 1.0,
+    timeout: float = None,
+    filter: dict = None,
+    projection: Any = None,
+    batch_size: int = 1000,
+    verbose: bool = True,
+) -> List[ops.PartitionResult]:
+    """
+    Apply a transform to every document of a collection with the help of the
+    workers ('mongo-migrator worker') connected to the same database.
+    The collection is split into _id ranges stored as work items, and the call
+    returns once every item is done.
+    Args:
+        collection: The collection to update.
+        transform: Function called with each document (see ops.bulk_update). It must
+            be defined at the top level of the migration file, since the workers
+            load it from their own migrations directory (or bundle).
+        partitions: The number of _id ranges.
+        job: The unique name of the job. By default, built from the migration file,
+            the transform and the collection. If the job already exists (e.g. a
+            previous run failed), its pending and failed items are run again.
+        work_items: Whether the current process updates items too, besides waiting.
+        lease_seconds: The time each item is leased to a worker. Leases are renewed
+            while the item is updated, and reclaimed by other workers once expired.
+        poll_interval: The seconds between checks of the state of the job.
+        timeout: The maximum seconds to wait for the workers. Forever by default.
+        filter: The filter of the documents to transform. All documents by default.
+        projection: The fields to read from each document. All fields by default.
+        batch_size: The number of documents per cursor batch and per bulk_write.
+        verbose: Whether to print the items when they finish.
+    Raises:
+        ValueError: If the transform cannot be loaded by the workers.
+        TimeoutError: If the items are not finished before the timeout.
+        ops.PartitionError: If any item fails. The items are kept, so the failed
+            ones are retried when the migration is run again.
+    Returns:
+        The results of every item, sorted by _id range.
+    """
+    reference = ops.get_function_reference(transform)
+    migration = os.path.basename(reference["file_path"])
+    function = reference["function_name"]
+    job = job or f"{os.path.splitext(migration)[0]}:{function}:{collection.name}"
+
+    queue = WorkQueue(collection.database)
+    if queue.has_job(job):
+        retried = queue.retry_failed(job)
+        if verbose:
+            print(f"[*] Resuming job {job} ({retried} failed partitions retried)...")
+    else:
+        ranges = ops.partition(collection, partitions)
+        queue.create_job(
+            job,
+            collection,
+            migration,
+            function,
+            ranges,
+            filter,
+            projection,
+            batch_size,
+        )
+        if verbose:
+            print(f"[*] Created job {job} with {len(ranges)} partitions...")
+
+    if work_items:
+        work(
+            queue,
+            lambda item: transform,
+            job=job,
+            lease_seconds=lease_seconds,
+            once=True,
+            verbose=verbose,
+        )
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while not queue.is_finished(job):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Job {job} did not finish in {timeout} seconds.")
+        time.sleep(poll_interval)
+        if work_items:
+            # Take over the items of workers that died
+            work(
+                queue,
+                lambda item: transform,
+                job=job,
+                lease_seconds=lease_seconds,
+                once=True,
+                verbose=verbose,
+            )
+
+    results = [_to_result(item) for item in queue.get_items(job)]
+    for result in results:
+        ops.track(result)
+    if any(result.error for result in results):
+        raise ops.PartitionError(results)
+
+    queue.delete_job(job)
+    if verbose:
+        processed = sum(result.processed for result in results)
+        modified = sum(result.modified for result in results)
+        print(f"[+] {collection.name}: {processed} docs processed, {modified} modified")
+    return results
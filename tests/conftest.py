@@ -6,8 +6,30 @@ from unittest import mock
 import mongomock
 import pytest
 
+from bson import Timestamp
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 
+from mongo_migrator.migration_template import MigrationTemplate  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def mongomock_types(monkeypatch):
+    """
+    Fixture that implements the $type aliases mongomock is missing, used by the
+    filters of the _id ranges (see id_ranges).
+    """
+    types = {
+        "minKey": lambda value: isinstance(value, MinKey),
+        "null": lambda value: value is None,
+        "timestamp": lambda value: isinstance(value, Timestamp),
+        "maxKey": lambda value: isinstance(value, MaxKey),
+    }
+    for alias, check in types.items():
+        monkeypatch.setitem(mongomock.filtering.TYPE_MAP, alias, check)
+
 
 @pytest.fixture
 def mongo_client():
@@ -31,14 +53,86 @@ def mock_config():
     config.db_name = "test_db"
     config.db_user = "user"
     config.db_password = "password"
+    config.db_uri = None
+    config.driver_options = {}
+    config.throttle_options = {}
     config.mm_collection = "mongo-migrator"
     config.migrations_dir = "/tmp/migrations"
+    config.migrations_bundle = None
     yield config
 
 
+@pytest.fixture
+def create_migrations(mock_config):
+    """
+    Fixture that returns a function creating a linear history of migration files
+    in the migrations directory, with versions 1 to count.
+    The upgrade of each migration is the one of the template, or the given body
+    formatted with the number of the migration (e.g. "db.create_collection('c_{i}')").
+    """
+
+    def create(count: int, upgrade: str = None) -> list:
+        os.makedirs(mock_config.migrations_dir, exist_ok=True)
+        paths = []
+        last_version = None
+        for i in range(1, count + 1):
+            version = str(i)
+            path = os.path.join(
+                mock_config.migrations_dir, f"{version}_migration_{i}.py"
+            )
+            MigrationTemplate.create_migration_file(
+                path, f"Migration {i}", version, last_version
+            )
+            if upgrade:
+                with open(path, "r") as file:
+                    content = file.read()
+                content = content.replace(
+                    "def upgrade(db: Database):\n"
+                    "    # Implement this method in the generated migration file\n"
+                    "    pass",
+                    f"def upgrade(db: Database):\n    {upgrade.format(i=i)}",
+                )
+                with open(path, "w") as file:
+                    file.write(content)
+            paths.append(path)
+            last_version = version
+        return paths
+
+    return create
+
+
+@pytest.fixture
+def write_migration(mock_config):
+    """
+    Fixture that returns a function writing a migration file with its header and
+    the given body in the migrations directory, and returning its path.
+    """
+
+    def write(body: str, version: str = "1", last_version: str = None) -> str:
+        os.makedirs(mock_config.migrations_dir, exist_ok=True)
+        path = os.path.join(mock_config.migrations_dir, f"{version}_migration.py")
+        with open(path, "w") as file:
+            file.write(
+                f'"""\ntitle: Migration {version}\nversion: {version}\n'
+                f'last_version: {last_version}\n"""\n{body}'
+            )
+        return path
+
+    return write
+
+
 @pytest.fixture(autouse=True)
 def cleanup(mock_config):
     """Fixture that cleans up the database after each test."""
     yield
     if os.path.exists(mock_config.migrations_dir):
         shutil.rmtree(mock_config.migrations_dir)
+
+
+@pytest.fixture(autouse=True)
+def close_pooled_clients():
+    """Fixture that closes the pooled database clients after each test."""
+    yield
+    from mongo_migrator.db_utils import close_clients
+
+    close_clients()
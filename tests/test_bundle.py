@@ -0,0 +1,245 @@
+import importlib.util
+import os
+import shutil
+
+from unittest import mock
+
+import pytest
+
+from mongo_migrator.bundle import (
+    BUNDLE_MAGIC,
+    create_bundle,
+    get_bundle_last_version,
+    is_bundle_current,
+    load_bundle,
+    load_valid_history,
+    rebuild_bundle,
+)
+from mongo_migrator.migration_history import EmptyHistoryError, InvalidHistoryError
+from mongo_migrator.cli import (
+    init as init_command,
+    create as create_command,
+    upgrade as upgrade_command,
+    bundle as bundle_command,
+)
+
+BUNDLE_PATH = "/tmp/migrations.bundle"
+BUNDLED_UPGRADE = "db.create_collection('bundled_{i}')"
+
+
+@pytest.fixture(autouse=True)
+def cleanup_bundle():
+    """Fixture that removes the bundle file after each test."""
+    yield
+    if os.path.exists(BUNDLE_PATH):
+        os.remove(BUNDLE_PATH)
+
+
+def test_bundle_roundtrip(mock_config, mongo_db, create_migrations):
+    """Test that a bundle loads the same history without the directory."""
+    create_migrations(3, BUNDLED_UPGRADE)
+    assert create_bundle(mock_config.migrations_dir, BUNDLE_PATH) == 3
+
+    # The directory is not needed anymore
+    shutil.rmtree(mock_config.migrations_dir)
+
+    history = load_bundle(BUNDLE_PATH)
+    assert history.validate()
+    assert [node.version for node in history.get_migrations()] == ["1", "2", "3"]
+    assert history.get_last_node().title == "Migration 3"
+
+    for node in history.get_migrations():
+        node.upgrade(mongo_db)
+    for i in range(1, 4):
+        assert f"bundled_{i}" in mongo_db.list_collection_names()
+
+
+def test_bundle_invalid_history(mock_config, create_migrations):
+    """Test that invalid histories or files are not bundled."""
+    os.makedirs(mock_config.migrations_dir)
+    with pytest.raises(ValueError, match="Invalid migration history"):
+        create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+
+    create_migrations(1, BUNDLED_UPGRADE)
+    with open(os.path.join(mock_config.migrations_dir, "1_migration_1.py"), "a") as f:
+        f.write("def broken(:\n")
+    with pytest.raises(SyntaxError):
+        create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+    assert not os.path.exists(BUNDLE_PATH)
+
+
+def test_load_invalid_bundle(mock_config):
+    """Test that files which are not bundles of this Python are rejected."""
+    with open(BUNDLE_PATH, "wb") as file:
+        file.write(b"not a bundle")
+    with pytest.raises(ValueError, match="Invalid migration bundle"):
+        load_bundle(BUNDLE_PATH)
+
+    with open(BUNDLE_PATH, "wb") as file:
+        file.write(BUNDLE_MAGIC + b"\x00" * len(importlib.util.MAGIC_NUMBER))
+    with pytest.raises(ValueError, match="another Python version"):
+        load_bundle(BUNDLE_PATH)
+
+
+def test_bundle_command(mock_config, mongo_db):
+    """Test the bundle command and that upgrade uses the bundle."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            # If no directory exists, error
+            args = mock.Mock()
+            args.output = BUNDLE_PATH
+            bundle_command(args)
+            assert not os.path.exists(BUNDLE_PATH)
+
+            init_command(None)
+
+            # If no bundle path, error
+            args.output = None
+            bundle_command(args)
+            assert not os.path.exists(BUNDLE_PATH)
+
+            # If the history is empty, error
+            args.output = BUNDLE_PATH
+            bundle_command(args)
+            assert not os.path.exists(BUNDLE_PATH)
+
+            for i in range(1, 3):
+                args = mock.Mock()
+                args.template = None
+                args.title = f"Test migration {i}"
+                create_command(args)
+
+            # The configured bundle path is used by default
+            mock_config.migrations_bundle = BUNDLE_PATH
+            args = mock.Mock()
+            args.output = None
+            bundle_command(args)
+            assert os.path.exists(BUNDLE_PATH)
+
+            # Upgrade works from the bundle without the directory
+            shutil.rmtree(mock_config.migrations_dir)
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            upgrade_command(args)
+            current_version = mongo_db[mock_config.mm_collection].find_one()
+            assert (
+                current_version["current_version"]
+                == load_bundle(BUNDLE_PATH).get_last_version()
+            )
+
+
+def test_bundle_last_version(mock_config, create_migrations):
+    """Test that the last version is read from the bundle metadata."""
+    create_migrations(3, BUNDLED_UPGRADE)
+    create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+
+    with mock.patch("mongo_migrator.bundle.marshal.load") as marshal_load:
+        assert get_bundle_last_version(BUNDLE_PATH) == "3"
+        marshal_load.assert_not_called()
+
+
+def test_outdated_bundle(mock_config, mongo_db, create_migrations):
+    """Test that a bundle does not shadow the migrations created after it."""
+    create_migrations(2, BUNDLED_UPGRADE)
+    create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+    assert is_bundle_current(BUNDLE_PATH, mock_config.migrations_dir)
+    assert is_bundle_current(BUNDLE_PATH, "/tmp/missing_migrations")
+
+    # A migration edited in place without rebuilding the bundle
+    file_path = os.path.join(mock_config.migrations_dir, "2_migration_2.py")
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert not is_bundle_current(BUNDLE_PATH, mock_config.migrations_dir)
+    with open(file_path, "a") as f:
+        f.write("\n")
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert not is_bundle_current(BUNDLE_PATH, mock_config.migrations_dir)
+    create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+    assert is_bundle_current(BUNDLE_PATH, mock_config.migrations_dir)
+
+    # A migration added without rebuilding the bundle
+    create_migrations(3, BUNDLED_UPGRADE)
+    assert not is_bundle_current(BUNDLE_PATH, mock_config.migrations_dir)
+
+    mock_config.migrations_bundle = BUNDLE_PATH
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            mongo_db[mock_config.mm_collection].update_one(
+                {}, {"$set": {"current_version": "2"}}
+            )
+            # The fast path does not trust the last version of the bundle
+            args = mock.Mock()
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            upgrade_command(args)
+            current_version = mongo_db[mock_config.mm_collection].find_one()
+            assert current_version["current_version"] == "3"
+            assert "bundled_3" in mongo_db.list_collection_names()
+
+            # Creating a migration rebuilds the bundle
+            args = mock.Mock()
+            args.template = None
+            args.title = "New migration"
+            create_command(args)
+            assert is_bundle_current(BUNDLE_PATH, mock_config.migrations_dir)
+            assert load_bundle(BUNDLE_PATH).get_migrations()[-1].title == (
+                "New migration"
+            )
+
+
+def test_rebuild_bundle_error(mock_config, create_migrations):
+    """Test that a failed rebuild removes the bundle and raises its own error."""
+    create_migrations(2)
+    create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+    with mock.patch(
+        "mongo_migrator.bundle.create_bundle", side_effect=ValueError("invalid")
+    ):
+        with pytest.raises(ValueError, match="invalid"):
+            rebuild_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+        assert not os.path.exists(BUNDLE_PATH)
+        # The bundle is already gone
+        with pytest.raises(ValueError, match="invalid"):
+            rebuild_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+
+
+def test_load_valid_history(mock_config, create_migrations, capfd):
+    """Test that the history is loaded from the current bundle and validated."""
+    os.makedirs(mock_config.migrations_dir)
+    with pytest.raises(EmptyHistoryError):
+        load_valid_history(mock_config.migrations_dir, BUNDLE_PATH)
+
+    create_migrations(2)
+    create_bundle(mock_config.migrations_dir, BUNDLE_PATH)
+    history = load_valid_history(mock_config.migrations_dir, BUNDLE_PATH)
+    assert history.get_last_node().code is not None
+
+    # An outdated bundle is ignored
+    create_migrations(3)
+    history = load_valid_history(mock_config.migrations_dir, BUNDLE_PATH)
+    assert history.get_last_version() == "3"
+    assert "bundle is outdated" in capfd.readouterr().out
+
+    # A bifurcation: a fourth migration after the second one
+    with open(os.path.join(mock_config.migrations_dir, "3_migration_3.py")) as f:
+        content = f.read().replace("version: 3", "version: 4", 1)
+    with open(os.path.join(mock_config.migrations_dir, "4_migration_4.py"), "w") as f:
+        f.write(content)
+    with pytest.raises(InvalidHistoryError):
+        load_valid_history(mock_config.migrations_dir)
@@ -62,3 +62,75 @@ def test_no_subcommand():
             mock_print_help.assert_called_once()
             assert pytest_wrapped_e.type == SystemExit
             assert pytest_wrapped_e.value.code == 1
+
+
+def test_bundle():
+    """Test the bundle subcommand."""
+    test_args = ["mongo-migrator", "bundle", "--output", "migrations.bundle"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.bundle") as mock_bundle:
+            main()
+            mock_bundle.assert_called_once_with(mock.ANY)
+            assert mock_bundle.call_args[0][0].output == "migrations.bundle"
+
+
+def test_worker():
+    """Test the worker subcommand."""
+    test_args = ["mongo-migrator", "worker", "--once", "--lease", "30"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.worker") as mock_worker:
+            main()
+            mock_worker.assert_called_once_with(mock.ANY)
+            assert mock_worker.call_args[0][0].once is True
+            assert mock_worker.call_args[0][0].lease == 30
+
+
+def test_history_ledger():
+    """Test the ledger option of the history subcommand."""
+    test_args = ["mongo-migrator", "history", "--ledger"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.history") as mock_history:
+            main()
+            assert mock_history.call_args[0][0].ledger is True
+
+
+def test_plan():
+    """Test the plan subcommand and the estimate option of upgrade."""
+    test_args = ["mongo-migrator", "plan", "--version", "1"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.plan") as mock_plan:
+            main()
+            assert mock_plan.call_args[0][0].version == "1"
+
+    test_args = ["mongo-migrator", "upgrade", "--estimate"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.upgrade") as mock_upgrade:
+            main()
+            assert mock_upgrade.call_args[0][0].estimate is True
+
+
+def test_preflight():
+    """Test the preflight subcommand."""
+    test_args = ["mongo-migrator", "preflight", "--execution-stats"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.preflight") as mock_preflight:
+            main()
+            assert mock_preflight.call_args[0][0].execution_stats is True
+
+
+def test_upgrade_dry_run():
+    """Test the dry run option of upgrade."""
+    test_args = ["mongo-migrator", "upgrade", "--dry-run"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.upgrade") as mock_upgrade:
+            main()
+            assert mock_upgrade.call_args[0][0].dry_run is True
+
+
+def test_create_template():
+    """Test the template option of the create subcommand."""
+    test_args = ["mongo-migrator", "create", "Test Migration", "--template", "bulk"]
+    with mock.patch.object(sys, "argv", test_args):
+        with mock.patch("mongo_migrator.cli.create") as mock_create:
+            main()
+            assert mock_create.call_args[0][0].template == "bulk"
@@ -1,16 +1,26 @@
+from concurrent.futures import Future
+import contextvars
 from datetime import datetime
+import json
 import os
+import pickle
 import re
 
 from unittest import mock
 
+import pytest
+
 from mongo_migrator.cli import (
     init as init_command,
     create as create_command,
     upgrade as upgrade_command,
     downgrade as downgrade_command,
     history as history_command,
+    plan as plan_command,
+    preflight as preflight_command,
 )
+from mongo_migrator.db_utils import create_version_collection, set_current_version
+from mongo_migrator.migration_template import MigrationTemplate
 
 
 # Utility
@@ -125,6 +135,7 @@ def test_create(mock_config, mongo_db):
         with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
             # If no migration directory exists, error
             args = mock.Mock()
+            args.template = None
             args.title = "Test migration"
             create_command(args)
             assert not os.path.exists(mock_config.migrations_dir)
@@ -134,6 +145,7 @@ def test_create(mock_config, mongo_db):
 
             # Try creating a new migration without title
             args = mock.Mock()
+            args.template = None
             args.title = None
             create_command(args)
             # assert no files
@@ -210,6 +222,8 @@ def test_upgrade(mock_config, mongo_db):
             # If no directory exists, error
             args = mock.Mock()
             args.all = True
+            args.databases = None
+            args.database_pattern = None
             upgrade_command(args)
             assert not os.path.exists(mock_config.migrations_dir)
 
@@ -228,7 +242,7 @@ def test_upgrade(mock_config, mongo_db):
 
             # If history cant load, error
             with mock.patch(
-                "mongo_migrator.cli.MigrationHistory", side_effect=Exception
+                "mongo_migrator.bundle.MigrationHistory", side_effect=Exception
             ):
                 upgrade_command(args)
                 assert get_current_db_version(mongo_db, mock_config) is None
@@ -243,6 +257,7 @@ def test_upgrade(mock_config, mongo_db):
             migrations = []
             for i in range(1, 6):
                 args = mock.Mock()
+                args.template = None
                 args.title = f"Test migration {i}"
                 create_command(args)
 
@@ -272,6 +287,14 @@ def test_upgrade(mock_config, mongo_db):
             args = mock.Mock()
             args.all = False
             args.version = migrations[1]["version"]
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             upgrade_command(args)
 
             # Verify the collection in the 1st 2nd migration was created
@@ -285,6 +308,14 @@ def test_upgrade(mock_config, mongo_db):
             args = mock.Mock()
             args.all = False
             args.version = migrations[0]["version"]
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             upgrade_command(args)
             # Verify the collection in the 3rd migration was still not created
             assert "test_collection_3" not in mongo_db.list_collection_names()
@@ -293,6 +324,14 @@ def test_upgrade(mock_config, mongo_db):
             args = mock.Mock()
             args.all = True
             args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             with mock.patch(
                 "mongo_migrator.migration_history.MigrationNode.upgrade",
                 side_effect=Exception,
@@ -313,6 +352,14 @@ def test_upgrade(mock_config, mongo_db):
             args = mock.Mock()
             args.all = True
             args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             upgrade_command(args)
             for i in range(1, 6):
                 assert f"test_collection_{i}" in mongo_db.list_collection_names()
@@ -340,6 +387,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = True
             args.all = False
             args.version = None
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
             assert not os.path.exists(mock_config.migrations_dir)
 
@@ -355,6 +408,7 @@ def test_downgrade(mock_config, mongo_db):
             migrations = []
             for i in range(1, 6):
                 args = mock.Mock()
+                args.template = None
                 args.title = f"Test migration {i}"
                 create_command(args)
 
@@ -378,7 +432,7 @@ def test_downgrade(mock_config, mongo_db):
 
             # If history cant load, error
             with mock.patch(
-                "mongo_migrator.cli.MigrationHistory", side_effect=Exception
+                "mongo_migrator.bundle.MigrationHistory", side_effect=Exception
             ):
                 downgrade_command(args)
                 assert get_current_db_version(mongo_db, mock_config) is None
@@ -396,6 +450,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = True
             args.all = False
             args.version = None
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
             # Nothing should happen
             assert get_current_db_version(mongo_db, mock_config) is None
@@ -404,6 +464,14 @@ def test_downgrade(mock_config, mongo_db):
             args = mock.Mock()
             args.all = True
             args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             upgrade_command(args)
             assert get_current_db_version(mongo_db, mock_config) is not None
 
@@ -412,6 +480,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = True
             args.all = False
             args.version = None
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
             # Verify the last collection was dropped
             assert "test_collection_5" not in mongo_db.list_collection_names()
@@ -426,6 +500,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = False
             args.all = False
             args.version = migrations[-1]["version"]
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
             # Verify the collection in the 4th migration was not dropped
             assert "test_collection_4" in mongo_db.list_collection_names()
@@ -440,6 +520,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = False
             args.all = False
             args.version = migrations[3]["version"]
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
 
             # Downgrade (version)
@@ -447,6 +533,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = False
             args.all = False
             args.version = migrations[2]["version"]
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
             # Verify the collection in the fourth migration was dropped
             assert "test_collection_4" not in mongo_db.list_collection_names()
@@ -463,6 +555,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = False
             args.all = True
             args.version = None
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             with mock.patch(
                 "mongo_migrator.migration_history.MigrationNode.downgrade",
                 side_effect=Exception,
@@ -482,6 +580,12 @@ def test_downgrade(mock_config, mongo_db):
             args.single = False
             args.all = True
             args.version = None
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             downgrade_command(args)
             # Verify all collections were dropped
             for i in range(1, 6):
@@ -514,6 +618,7 @@ def test_history(mock_config, mongo_db, capfd):
             migrations = []
             for i in range(1, 6):
                 args = mock.Mock()
+                args.template = None
                 args.title = f"Test migration {i}"
                 create_command(args)
 
@@ -531,6 +636,14 @@ def test_history(mock_config, mongo_db, capfd):
             args = mock.Mock()
             args.all = False
             args.version = migrations[2]["version"]
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
             upgrade_command(args)
             assert (
                 get_current_db_version(mongo_db, mock_config)
@@ -543,7 +656,7 @@ def test_history(mock_config, mongo_db, capfd):
 
             # If history cant load, error
             with mock.patch(
-                "mongo_migrator.cli.MigrationHistory", side_effect=Exception
+                "mongo_migrator.bundle.MigrationHistory", side_effect=Exception
             ):
                 history_command(None)
 
@@ -567,3 +680,563 @@ def test_history(mock_config, mongo_db, capfd):
             history_command(None)
             captured = capfd.readouterr()
             assert captured.out.strip() == expected_output_str
+
+
+def test_upgrade_up_to_date(mock_config, mongo_db, capfd):
+    """Test that upgrade does not load the history when it is up to date."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            for i in range(1, 4):
+                args = mock.Mock()
+                args.template = None
+                args.title = f"Test migration {i}"
+                create_command(args)
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            upgrade_command(args)
+            last_version = get_current_db_version(mongo_db, mock_config)
+
+            # The last version is taken from the manifest
+            with mock.patch(
+                "mongo_migrator.bundle.MigrationHistory", side_effect=Exception
+            ) as migration_history:
+                capfd.readouterr()
+                upgrade_command(args)
+                migration_history.assert_not_called()
+            captured = capfd.readouterr()
+            assert "[+] No migrations to run." in captured.out
+            assert get_current_db_version(mongo_db, mock_config) == last_version
+
+            # A migration file unknown to the manifest disables the fast path
+            migration_file_path = os.path.join(
+                mock_config.migrations_dir, "99999999999999999999_new.py"
+            )
+            MigrationTemplate.create_migration_file(
+                migration_file_path,
+                "New migration",
+                "99999999999999999999",
+                last_version,
+            )
+            upgrade_command(args)
+            assert (
+                get_current_db_version(mongo_db, mock_config) == "99999999999999999999"
+            )
+
+
+def test_commands_use_driver_options(mock_config, mongo_db):
+    """Test that commands connect with the configured uri and driver options."""
+    mock_config.db_uri = "mongodb://localhost:27017"
+    mock_config.driver_options = {"compressors": "zstd"}
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db) as get_db:
+            init_command(None)
+            kwargs = get_db.call_args.kwargs
+            assert kwargs["uri"] == "mongodb://localhost:27017"
+            assert kwargs["driver_options"] == {"compressors": "zstd"}
+
+
+def test_ledger(mock_config, mongo_db, capfd):
+    """Test that upgrades and downgrades are recorded in the ledger."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            for i in range(1, 4):
+                args = mock.Mock()
+                args.template = None
+                args.title = f"Test migration {i}"
+                create_command(args)
+            migration_files = sorted(
+                f for f in os.listdir(mock_config.migrations_dir) if f.endswith(".py")
+            )
+            failing_path = os.path.join(mock_config.migrations_dir, migration_files[2])
+            modify_migration(failing_path, upgrade_code="raise RuntimeError('boom')")
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            upgrade_command(args)
+
+            args = mock.Mock()
+            args.all = False
+            args.version = None
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            downgrade_command(args)
+
+            ledger = mongo_db[f"{mock_config.mm_collection}_ledger"]
+            entries = list(ledger.find().sort([("started_at", 1), ("_id", 1)]))
+            assert [(e["direction"], e["outcome"]) for e in entries] == [
+                ("upgrade", "applied"),
+                ("upgrade", "applied"),
+                ("upgrade", "failed"),
+                ("downgrade", "reverted"),
+            ]
+            assert entries[2]["error"] == "RuntimeError: boom"
+            assert all(e["duration"] >= 0 for e in entries)
+            assert all(e["commands"]["round_trips"] == 0 for e in entries)
+
+            capfd.readouterr()
+            args = mock.Mock()
+            args.ledger = True
+            history_command(args)
+            output = capfd.readouterr().out
+            assert "[+] Migration ledger:" in output
+            ledger_lines = output.split("[+] Migration ledger:\n")[1].splitlines()
+            assert len(ledger_lines) == 4
+            assert "DOWNGRADE" in ledger_lines[0]
+            assert "FAILED" in ledger_lines[1]
+
+            # A failure to collect the commands is recorded as the error
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            with mock.patch(
+                "mongo_migrator.cli.instrumentation.collect",
+                side_effect=RuntimeError("no collector"),
+            ):
+                upgrade_command(args)
+            entry = ledger.find_one({}, sort=[("started_at", -1), ("_id", -1)])
+            assert entry["error"] == "RuntimeError: no collector"
+            assert entry["commands"] is None
+
+
+def test_plan(mock_config, mongo_db, capfd):
+    """Test that the plan estimates the pending migrations from the ledger."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            for i in range(1, 4):
+                args = mock.Mock()
+                args.template = None
+                args.title = f"Test migration {i}"
+                create_command(args)
+            migration_files = sorted(
+                f for f in os.listdir(mock_config.migrations_dir) if f.endswith(".py")
+            )
+            versions = [f.split("_")[0] for f in migration_files]
+
+            # Apply the first migration, so the others are estimated from it
+            args = mock.Mock()
+            args.all = False
+            args.version = versions[0]
+            args.estimate = True
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            upgrade_command(args)
+            assert "[+] Estimated total: unknown" in capfd.readouterr().out
+
+            args = mock.Mock()
+            args.version = None
+            plan_command(args)
+            output = capfd.readouterr().out
+            assert "[+] Upgrade plan (2 migrations):" in output
+            assert f"    {versions[1]} - Test migration 2" in output
+            assert "(median)" in output
+            assert get_current_db_version(mongo_db, mock_config) == versions[0]
+
+
+def test_upgrade_progress_json(mock_config, mongo_db, capfd):
+    """Test that the progress of the migrations is printed as JSON lines."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            args = mock.Mock()
+            args.template = None
+            args.title = "Progress"
+            create_command(args)
+            migration_files = os.listdir(mock_config.migrations_dir)
+            migration_file = [f for f in migration_files if f.endswith(".py")][0]
+            migration_file_path = os.path.join(
+                mock_config.migrations_dir, migration_file
+            )
+            with open(migration_file_path, "a") as f:
+                f.write(
+                    "\n\ndef upgrade(db, ctx):\n"
+                    "    for done in range(0, 101, 50):\n"
+                    "        ctx.progress(100, done)\n"
+                )
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = True
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            capfd.readouterr()
+            upgrade_command(args)
+            lines = [
+                json.loads(line)
+                for line in capfd.readouterr().out.splitlines()
+                if line.startswith("{")
+            ]
+            assert lines[0]["done"] == 0
+            assert lines[-1]["done"] == 100
+            assert lines[-1]["percent"] == 100.0
+            assert all(line["title"] == "Progress" for line in lines)
+
+
+def test_upgrade_profile(mock_config, mongo_db, tmp_path):
+    """Test that each migration is profiled in the profile directory."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            for i in range(1, 3):
+                args = mock.Mock()
+                args.template = None
+                args.title = f"Test migration {i}"
+                create_command(args)
+            versions = sorted(
+                f.split("_")[0]
+                for f in os.listdir(mock_config.migrations_dir)
+                if f.endswith(".py")
+            )
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = True
+            args.profile_memory = True
+            args.isolate = False
+            args.databases = None
+            args.database_pattern = None
+            args.profile_dir = str(tmp_path)
+            upgrade_command(args)
+
+            assert sorted(os.listdir(tmp_path)) == [
+                f"{versions[0]}_upgrade.memory.txt",
+                f"{versions[0]}_upgrade.pstats",
+                f"{versions[1]}_upgrade.memory.txt",
+                f"{versions[1]}_upgrade.pstats",
+            ]
+
+
+def test_preflight(mock_config, mongo_db, capfd):
+    """Test that the preflight flags the filters that scan a whole collection."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            args = mock.Mock()
+            args.template = None
+            args.title = "Preflight"
+            create_command(args)
+            migration_files = os.listdir(mock_config.migrations_dir)
+            migration_file = [f for f in migration_files if f.endswith(".py")][0]
+            migration_file_path = os.path.join(
+                mock_config.migrations_dir, migration_file
+            )
+            with open(migration_file_path, "a") as f:
+                f.write(
+                    "\n\ndef upgrade(db):\n"
+                    '    db["users"].update_many({"status": "old"}, '
+                    '{"$set": {"status": "new"}})\n'
+                )
+            mongo_db["users"].insert_one({"_id": 1, "status": "old"})
+
+            args = mock.Mock()
+            args.version = None
+            args.execution_stats = False
+            plan = {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+            with mock.patch("mongo_migrator.preflight.explain", return_value=plan):
+                try:
+                    preflight_command(args)
+                    assert False, "preflight should exit with an error"
+                except SystemExit as err:
+                    assert err.code == 1
+            output = capfd.readouterr().out
+            assert '[F] update_many users {"status": "old"} -> COLLSCAN' in output
+            assert "Missing index on: status" in output
+            assert "[F] 1 filters would scan a whole collection." in output
+
+            # Nothing was written or applied
+            assert mongo_db["users"].find_one({"_id": 1})["status"] == "old"
+            assert get_current_db_version(mongo_db, mock_config) is None
+
+            plan = {
+                "queryPlanner": {
+                    "winningPlan": {
+                        "stage": "FETCH",
+                        "inputStage": {"stage": "IXSCAN", "indexName": "status_1"},
+                    }
+                }
+            }
+            with mock.patch("mongo_migrator.preflight.explain", return_value=plan):
+                preflight_command(args)
+            output = capfd.readouterr().out
+            assert "-> FETCH > IXSCAN (status_1)" in output
+            assert "[+] No collection scans on filtered operations." in output
+
+
+def test_upgrade_dry_run(mock_config, mongo_db, capfd):
+    """Test that the dry run reports the writes without running them."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            args = mock.Mock()
+            args.template = None
+            args.title = "Dry run"
+            create_command(args)
+            migration_files = os.listdir(mock_config.migrations_dir)
+            migration_file = [f for f in migration_files if f.endswith(".py")][0]
+            migration_file_path = os.path.join(
+                mock_config.migrations_dir, migration_file
+            )
+            with open(migration_file_path, "a") as f:
+                f.write(
+                    "\n\ndef upgrade(db, ctx):\n"
+                    '    total = db["users"].count_documents({})\n'
+                    '    db["users"].delete_many({"old": True})\n'
+                    "    ctx.progress(total, total)\n"
+                )
+            mongo_db["users"].insert_many([{"old": True}, {"old": False}])
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = True
+            args.databases = None
+            args.database_pattern = None
+            upgrade_command(args)
+            output = capfd.readouterr().out
+            assert "    delete_many users: 1 calls, 1 docs, ~" in output
+            assert "[+] Would write 1 docs" in output
+            assert "[+] Dry run total: 1 docs" in output
+
+            # Nothing was written or applied
+            assert mongo_db["users"].count_documents({}) == 2
+            assert get_current_db_version(mongo_db, mock_config) is None
+
+
+def test_create_declarative(mock_config, mongo_db):
+    """Test that declarative migrations are created and chained as JSON files."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            for template in ("default", "declarative", "default"):
+                args = mock.Mock()
+                args.template = template
+                args.title = f"Test {template}"
+                create_command(args)
+
+            migration_files = sorted(
+                f for f in os.listdir(mock_config.migrations_dir) if f[0].isdigit()
+            )
+            assert [f.split(".", 1)[1] for f in migration_files] == [
+                "py",
+                "migration.json",
+                "py",
+            ]
+            with open(
+                os.path.join(mock_config.migrations_dir, migration_files[1])
+            ) as f:
+                spec = json.load(f)
+            assert spec["title"] == "Test declarative"
+            assert spec["last_version"] == migration_files[0].split("_")[0]
+            assert spec["operations"][0]["rename"] == {"old_field": "new_field"}
+
+            last = get_migration_params(
+                os.path.join(mock_config.migrations_dir, migration_files[2])
+            )
+            assert last["last_version"] == spec["version"]
+
+
+class InlineExecutor:
+    """Runs the submitted task in the current process, pickled like a subprocess."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, function, task):
+        future = Future()
+        context = contextvars.copy_context()
+        result = context.run(function, pickle.loads(pickle.dumps(task)))
+        future.set_result(pickle.loads(pickle.dumps(result)))
+        return future
+
+
+def test_upgrade_isolated(mock_config, mongo_db, capfd):
+    """Test that isolated migrations run from a copy and report their results."""
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            init_command(None)
+            args = mock.Mock()
+            args.template = None
+            args.title = "Isolated"
+            create_command(args)
+            migration_files = os.listdir(mock_config.migrations_dir)
+            migration_file = [f for f in migration_files if f.endswith(".py")][0]
+            migration_file_path = os.path.join(
+                mock_config.migrations_dir, migration_file
+            )
+            with open(migration_file_path, "a") as f:
+                f.write(
+                    "\n\nfrom pymongo import InsertOne\n"
+                    "from mongo_migrator import ops\n\n"
+                    "def upgrade(db):\n"
+                    '    requests = (InsertOne({"n": n}) for n in range(3))\n'
+                    '    ops.bulk_write(db["numbers"], requests)\n'
+                )
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.profile_dir = None
+            args.isolate = True
+            args.databases = None
+            args.database_pattern = None
+
+            # Databases not connected with get_db cannot be isolated
+            upgrade_command(args)
+            assert "Isolated migrations need a database" in capfd.readouterr().out
+            assert get_current_db_version(mongo_db, mock_config) is None
+
+            connection = mock.patch(
+                "mongo_migrator.isolation.get_connection_params", return_value={}
+            )
+            client = mock.patch(
+                "mongo_migrator.isolation.get_client", return_value=mongo_db.client
+            )
+            executor = mock.patch(
+                "mongo_migrator.isolation.ProcessPoolExecutor", InlineExecutor
+            )
+            with connection, client, executor:
+                upgrade_command(args)
+
+            assert mongo_db["numbers"].count_documents({}) == 3
+            version = get_migration_params(migration_file_path)["version"]
+            assert get_current_db_version(mongo_db, mock_config) == version
+            entry = mongo_db[f"{mock_config.mm_collection}_ledger"].find_one(
+                {"outcome": "applied"}
+            )
+            assert entry["docs_processed"] == 3
+
+
+def test_upgrade_databases(mock_config, mongo_client, capfd):
+    """Test that several databases are upgraded with the same history."""
+    tenants = ["tenant_a", "tenant_b", "tenant_c"]
+
+    def get_db(host, port, db_name, *args, **kwargs):
+        return mongo_client[db_name]
+
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", side_effect=get_db):
+            init_command(None)
+            for i in range(1, 3):
+                args = mock.Mock()
+                args.template = None
+                args.title = f"Tenant migration {i}"
+                create_command(args)
+            migration_files = sorted(
+                f for f in os.listdir(mock_config.migrations_dir) if f.endswith(".py")
+            )
+            for i, migration_file in enumerate(migration_files):
+                modify_migration(
+                    os.path.join(mock_config.migrations_dir, migration_file),
+                    upgrade_code=f"db['items'].insert_one({{'n': {i}}})",
+                )
+            versions = [f.split("_")[0] for f in migration_files]
+
+            # tenant_b is already at the first version, tenant_c is not initialized
+            for tenant in tenants[:2]:
+                create_version_collection(
+                    mongo_client[tenant], mock_config.mm_collection
+                )
+            set_current_version(
+                mongo_client["tenant_b"], mock_config.mm_collection, versions[0]
+            )
+            mongo_client["tenant_c"]["items"].insert_one({"n": -1})
+            mongo_client["other"]["items"].insert_one({"n": -1})
+
+            args = mock.Mock()
+            args.all = True
+            args.version = None
+            args.estimate = False
+            args.dry_run = False
+            args.progress_json = False
+            args.profile = False
+            args.profile_memory = False
+            args.isolate = False
+            args.databases = "tenant_a, tenant_b"
+            args.database_pattern = r"tenant_\w"
+            args.workers = 2
+            capfd.readouterr()
+            with pytest.raises(SystemExit) as excinfo:
+                upgrade_command(args)
+            assert excinfo.value.code == 1
+            output = capfd.readouterr().out
+            assert (
+                f"[+] tenant_a: 2 migrations applied (None -> {versions[1]})" in output
+            )
+            assert "[F] tenant_c: FAILED after 0/0 migrations" in output
+            assert "Version collection not found" in output
+            assert (
+                "[+] 3 databases in" in output
+                and "2 succeeded (2 upgraded, 0 up to date), 1 failed. "
+                "3 migrations applied." in output
+            )
+            for tenant in tenants[:2]:
+                db = mongo_client[tenant]
+                assert get_current_db_version(db, mock_config) == versions[1]
+            assert mongo_client["tenant_b"]["items"].count_documents({}) == 1
+            assert "mongo-migrator" not in mongo_client["other"].list_collection_names()
+
+            # Every database is up to date
+            args.database_pattern = None
+            upgrade_command(args)
+            output = capfd.readouterr().out
+            assert "2 succeeded (0 upgraded, 2 up to date), 0 failed." in output
@@ -0,0 +1,168 @@
+import json
+
+from unittest import mock
+
+import pytest
+
+from mongo_migrator import declarative, planner
+from mongo_migrator.bundle import create_bundle, load_bundle
+from mongo_migrator.migration_history import MigrationHistory
+
+SPEC = {
+    "title": "Normalize users",
+    "version": "2",
+    "last_version": "1",
+    "operations": [
+        {"collection": "users", "rename": {"name": "full_name"}},
+        {"collection": "users", "convert": {"age": {"to": "int", "from": "string"}}},
+    ],
+}
+PYTHON_MIGRATION = '''"""
+title: First
+version: 1
+last_version: None
+"""
+def upgrade(db):
+    pass
+'''
+
+
+def mock_db():
+    """Build a database mock whose updates match and modify one document."""
+    db = mock.MagicMock()
+    db["users"].update_many.return_value = mock.Mock(matched_count=1, modified_count=1)
+    return db
+
+
+@pytest.fixture
+def migrations_dir(tmp_path):
+    """Fixture with a Python migration followed by a declarative one."""
+    (tmp_path / "1_first.py").write_text(PYTHON_MIGRATION)
+    (tmp_path / "2_normalize_users.migration.json").write_text(json.dumps(SPEC))
+    # Other JSON files are not migrations
+    (tmp_path / "fixtures.json").write_text("[]")
+    return tmp_path
+
+
+def test_compile_operation():
+    """Test the filters and pipelines of each action."""
+    collection, filter, pipeline = declarative.compile_operation(
+        {"collection": "users", "rename": {"name": "full_name"}}
+    )
+    assert collection == "users"
+    assert filter == {"name": {"$exists": True}}
+    assert pipeline[1] == {"$unset": ["name"]}
+    assert "$cond" in pipeline[0]["$set"]["full_name"]
+
+    _, filter, pipeline = declarative.compile_operation(
+        {
+            "collection": "users",
+            "set_default": {"active": True, "tags": "$none"},
+            "filter": {"type": "user"},
+        }
+    )
+    assert filter == {
+        "$and": [{"type": "user"}, {"$or": [{"active": None}, {"tags": None}]}]
+    }
+    assert pipeline == [
+        {
+            "$set": {
+                "active": {"$ifNull": ["$active", {"$literal": True}]},
+                "tags": {"$ifNull": ["$tags", {"$literal": "$none"}]},
+            }
+        }
+    ]
+
+    _, filter, pipeline = declarative.compile_operation(
+        {"collection": "users", "unset": "legacy"}
+    )
+    assert (filter, pipeline) == (
+        {"legacy": {"$exists": True}},
+        [{"$unset": ["legacy"]}],
+    )
+
+    _, filter, pipeline = declarative.compile_operation(
+        {"collection": "users", "convert": {"age": "int"}}
+    )
+    assert filter == {"age": {"$exists": True, "$ne": None, "$not": {"$type": "int"}}}
+    assert pipeline[0]["$set"]["age"]["$convert"]["to"] == "int"
+
+
+def test_reverse_operation():
+    """Test that renames and conversions with a source type are reversible."""
+    assert declarative.reverse_operation(SPEC["operations"][1]) == {
+        "collection": "users",
+        "convert": {"age": {"to": "string", "from": "int"}},
+    }
+    with pytest.raises(ValueError):
+        declarative.reverse_operation({"collection": "users", "unset": ["a"]})
+    with pytest.raises(ValueError):
+        declarative.reverse_operation({"collection": "users", "convert": {"a": "int"}})
+
+
+def test_functions():
+    """Test that each operation is one update_many, reversed by the downgrade."""
+    db = mock.MagicMock()
+    db["users"].update_many.return_value = mock.Mock(matched_count=3, modified_count=2)
+    upgrade, downgrade = declarative.get_functions(SPEC)
+    upgrade(db)
+    calls = db["users"].update_many.call_args_list
+    assert [call.args[0] for call in calls] == [
+        {"name": {"$exists": True}},
+        {"age": {"$exists": True, "$ne": None, "$not": {"$type": "int"}}},
+    ]
+
+    db["users"].update_many.reset_mock()
+    downgrade(db)
+    calls = db["users"].update_many.call_args_list
+    assert [call.args[0] for call in calls] == [
+        {"age": {"$exists": True, "$ne": None, "$not": {"$type": "string"}}},
+        {"full_name": {"$exists": True}},
+    ]
+
+    spec = {**SPEC, "operations": [{"collection": "users", "unset": ["a"]}]}
+    _, downgrade = declarative.get_functions(spec)
+    with pytest.raises(ValueError, match="Declare the downgrade operations"):
+        downgrade(db)
+
+
+def test_validate(tmp_path):
+    """Test that invalid migrations are refused."""
+    for spec in (
+        [],
+        {**SPEC, "version": "v2"},
+        {**SPEC, "operations": [{"rename": {"a": "b"}}]},
+        {**SPEC, "operations": [{"collection": "users", "drop": True}]},
+        {**SPEC, "operations": [{"collection": "users", "convert": {"a": "x"}}]},
+    ):
+        with pytest.raises(ValueError, match="Invalid declarative migration"):
+            declarative.validate(spec)
+
+    file_path = tmp_path / "1_broken.migration.json"
+    file_path.write_text("{")
+    with pytest.raises(ValueError, match="Invalid declarative migration"):
+        declarative.read_spec(str(file_path))
+
+
+def test_history_and_bundle(migrations_dir, tmp_path):
+    """Test that declarative migrations are loaded, bundled and inspected."""
+    history = MigrationHistory(str(migrations_dir))
+    assert history.validate()
+    node = history.get_last_node()
+    assert (node.title, node.version) == ("Normalize users", "2")
+    assert "users" in planner.get_string_literals(node)
+
+    # Cached in the manifest
+    history = MigrationHistory(str(migrations_dir))
+    assert history.get_last_version() == "2"
+
+    db = mock_db()
+    history.get_last_node().upgrade(db)
+    assert db["users"].update_many.call_count == 2
+
+    bundle_path = str(tmp_path / "migrations.bundle")
+    assert create_bundle(str(migrations_dir), bundle_path) == 2
+    node = load_bundle(bundle_path).get_last_node()
+    db = mock_db()
+    node.downgrade(db)
+    assert db["users"].update_many.call_count == 2
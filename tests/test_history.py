@@ -1,5 +1,9 @@
 import os
+import pickle
 import re
+import sys
+
+import pytest
 
 from unittest import mock
 
@@ -21,6 +25,7 @@ def test_history_invalid_migration(mock_config, mongo_db, capfd):
 
             # Create a migration with missing parameters
             args = mock.Mock()
+            args.template = None
             args.title = "Invalid migration"
             create_command(args)
             migration_files = os.listdir(mock_config.migrations_dir)
@@ -271,3 +276,121 @@ def test_get_migrations(mongo_db, mock_config):
                 node3,
                 node4,
             ]
+
+
+def test_migration_node_is_imported_lazily(mock_config):
+    """Test that loading the history does not import the migration files."""
+    os.makedirs(mock_config.migrations_dir)
+    migration_file_path = os.path.join(mock_config.migrations_dir, "1_lazy.py")
+    with open(migration_file_path, "w") as file:
+        file.write(
+            '"""\n'
+            "title: Lazy migration\n"
+            "version: 1\n"
+            "last_version: None\n"
+            '"""\n'
+            "raise RuntimeError('imported')\n"
+        )
+
+    # The history only parses the header, so the module body is not executed
+    history = MigrationHistory(mock_config.migrations_dir)
+    node = history.get_first_node()
+    assert node.title == "Lazy migration"
+    assert node.file_path == migration_file_path
+
+    # The module is imported the first time the migration is run
+    with pytest.raises(RuntimeError, match="imported"):
+        node.upgrade(None)
+
+
+def test_long_history_without_recursion(capfd):
+    """Test that long histories are validated, printed and sliced iteratively."""
+    size = sys.getrecursionlimit() * 3
+    nodes = [
+        MigrationNode(f"Migration {i}", str(i), str(i - 1) if i else None)
+        for i in range(size)
+    ]
+    history = MigrationHistory.from_nodes(nodes)
+    assert history.validate()
+    assert history.get_first_version() == "0"
+    assert history.get_last_node() is nodes[-1]
+    assert history.get_position(str(size - 1)) == size - 1
+    assert history.get_migrations("10", "12") == nodes[10:13]
+    assert history.get_migrations(str(size - 2)) == nodes[-2:]
+    # A target before the start returns every following migration
+    assert history.get_migrations("5", "3") == nodes[5:]
+
+    history.print_history(current_version="1")
+    lines = capfd.readouterr().out.splitlines()
+    assert len(lines) == size
+    assert lines[1] == "├──>(CURRENT) 1 - Migration 1"
+    assert lines[-1] == f"└── (PENDING) {size - 1} - Migration {size - 1}"
+
+
+def test_history_chain_is_rebuilt_on_changes():
+    """Test that the chain is rebuilt once the changes of the tree invalidate it."""
+    nodes = [MigrationNode(f"Migration {i}", str(i), str(i - 1)) for i in range(1, 4)]
+    nodes[0].last_version = None
+    history = MigrationHistory.from_nodes(nodes)
+    assert history.get_last_version() == "3"
+
+    node4 = MigrationNode("Migration 4", "4", "3")
+    nodes[2].add_child(node4)
+    history.migrations["4"] = node4
+    # Kept until it is invalidated
+    assert history.get_last_version() == "3"
+    history.invalidate_chain()
+    assert history.get_last_version() == "4"
+    assert history.validate()
+
+    # A bifurcation
+    other = MigrationNode("Other", "5", "3")
+    nodes[2].add_child(other)
+    history.migrations["5"] = other
+    history.invalidate_chain()
+    assert not history.validate()
+
+    history.roots = []
+    assert history.is_empty()
+    assert history.get_last_version() is None
+
+
+def test_migration_node_is_compact():
+    """Test that the nodes are slotted and share their interned versions."""
+    node = MigrationNode("Migration 2", "".join(["2", "0"]), "".join(["1", "0"]))
+    parent = MigrationNode("Migration 1", "10")
+    parent.add_child(node)
+    assert not hasattr(node, "__dict__")
+    assert node.last_version is parent.version
+    assert node.children == () and parent.children == (node,)
+    # Pickled without the history after it
+    copy = pickle.loads(pickle.dumps(parent))
+    assert (copy.version, copy.children) == ("10", ())
+
+
+def test_migration_module_is_released(mock_config):
+    """Test that the module of a migration is released after it runs."""
+    os.makedirs(mock_config.migrations_dir)
+    migration_file_path = os.path.join(mock_config.migrations_dir, "1_release.py")
+    with open(migration_file_path, "w") as file:
+        file.write(
+            '"""\n'
+            "title: Release migration\n"
+            "version: 1\n"
+            "last_version: None\n"
+            '"""\n'
+            "import weakref\n"
+            "class Payload:\n"
+            "    pass\n"
+            "PAYLOAD = Payload()\n"
+            "def upgrade(db):\n"
+            "    db.append(weakref.ref(PAYLOAD))\n"
+        )
+
+    node = MigrationHistory(mock_config.migrations_dir).get_first_node()
+    references = []
+    node.upgrade(references)
+    node.upgrade(references)
+    # Each run loads the module again, and nothing outlives the run
+    assert len(references) == 2
+    assert references[0]() is None and references[1]() is None
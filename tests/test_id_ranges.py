@@ -0,0 +1,33 @@
+from bson import ObjectId
+from bson.min_key import MinKey
+
+from mongo_migrator import id_ranges
+
+
+def test_type_order():
+    """Test that values are ordered by their BSON type."""
+    values = [ObjectId(), "a", 1.5, None, True, MinKey(), 2]
+    orders = [id_ranges.get_type_order(value) for value in values]
+    assert orders == [6, 3, 2, 1, 7, 0, 2]
+
+
+def test_partition_mixed_types(mongo_db):
+    """Test that the ranges of _ids of several types cover every document once."""
+    collection = mongo_db["items"]
+    collection.insert_many(
+        [{"_id": i} for i in range(40)]
+        + [{"_id": f"item-{i}"} for i in range(40)]
+        + [{"_id": ObjectId()} for _ in range(40)]
+    )
+
+    ranges = id_ranges.partition(collection, 6)
+    assert 1 < len(ranges) <= 6
+    counts = [
+        collection.count_documents(id_ranges.range_filter(None, lower, upper))
+        for lower, upper in ranges
+    ]
+    assert sum(counts) == 120
+
+    # A range between two types matches the types between them
+    only_strings = id_ranges.range_filter({"a": 1}, 5, ObjectId("0" * 24))
+    assert collection.count_documents(only_strings["$and"][1]) == 75
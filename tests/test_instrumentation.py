@@ -0,0 +1,162 @@
+import pickle
+import random
+
+from types import SimpleNamespace
+from unittest import mock
+
+from mongo_migrator import instrumentation
+
+
+def command_events(request_id, command_name, command, duration_micros, reply=None):
+    """Build the started and finished events of a command."""
+    common = {
+        "request_id": request_id,
+        "connection_id": ("localhost", 27017),
+        "operation_id": request_id,
+        "command_name": command_name,
+    }
+    started = SimpleNamespace(command=command, **common)
+    finished = SimpleNamespace(
+        duration_micros=duration_micros, reply=reply or {"ok": 1}, **common
+    )
+    return started, finished
+
+
+def test_command_filter():
+    """Test the extraction of the filter of each command."""
+    get_filter = instrumentation.get_command_filter
+    assert get_filter("find", {"find": "users", "filter": {"a": 1}}) == {"a": 1}
+    assert get_filter("update", {"updates": [{"q": {"b": 1}, "u": {}}]}) == {"b": 1}
+    assert get_filter("delete", {"deletes": [{"q": {"c": 1}}]}) == {"c": 1}
+    pipeline = [{"$sort": {"a": 1}}, {"$match": {"d": 1}}]
+    assert get_filter("aggregate", {"pipeline": pipeline}) == {"d": 1}
+    assert get_filter("insert", {"documents": []}) is None
+
+
+def test_listener_collects_per_context():
+    """Test that only the commands sent inside collect() are aggregated."""
+    listener = instrumentation.CommandInstrumentation()
+
+    # Outside of collect, commands are ignored
+    started, finished = command_events(1, "find", {"find": "users"}, 1000)
+    listener.started(started)
+    listener.succeeded(finished)
+
+    with instrumentation.collect(top_n=2) as collector:
+        for i in range(100):
+            started, finished = command_events(
+                i,
+                "update",
+                {"update": "users", "updates": [{"q": {"_id": i}, "u": {}}]},
+                (i + 1) * 1000,
+            )
+            listener.started(started)
+            listener.succeeded(finished)
+        started, failed = command_events(100, "find", {"find": "users"}, 500)
+        listener.started(started)
+        listener.failed(failed)
+
+    assert collector.round_trips == 101
+    summary = collector.to_dict()
+    update = summary["by_command"]["update"]
+    assert update["count"] == 100
+    assert update["p50_ms"] == 50
+    assert update["p99_ms"] == 99
+    assert update["total_ms"] == 5050
+    assert update["bytes_sent"] > 0 and update["bytes_received"] > 0
+    assert summary["by_command"]["find"]["failures"] == 1
+    assert summary["slowest"] == [
+        {
+            "command": "update",
+            "collection": "users",
+            "duration_ms": 100,
+            "filter": '{"_id": 99}',
+        },
+        {
+            "command": "update",
+            "collection": "users",
+            "duration_ms": 99,
+            "filter": '{"_id": 98}',
+        },
+    ]
+
+    report = collector.format_report()
+    assert report.startswith("[+] Commands: 101 round trips")
+    assert "update               100 calls | p50 50.0ms | p99 99.0ms" in report
+    assert "find                   1 calls (1 failed)" in report
+    assert '100.0ms update users {"_id": 99}' in report
+
+
+def test_listener_samples_bytes():
+    """Test that the size of a sample of the commands is measured and extrapolated."""
+    listener = instrumentation.CommandInstrumentation()
+    with mock.patch.object(instrumentation, "_bson_size", return_value=50) as size:
+        with instrumentation.collect() as collector:
+            for i in range(100):
+                started, finished = command_events(i, "insert", {"insert": "a"}, 10)
+                listener.started(started)
+                listener.succeeded(finished)
+
+    # The commands 0, 16, ..., 96 and their replies
+    assert size.call_count == 2 * 7
+    insert = collector.to_dict()["by_command"]["insert"]
+    assert insert["bytes_sent"] == insert["bytes_received"] == 5000
+
+
+def test_listener_counts_writes():
+    """Test that the documents written by the update commands are counted."""
+    listener = instrumentation.CommandInstrumentation()
+    with instrumentation.collect() as collector:
+        for i, reply in enumerate(
+            [{"ok": 1, "n": 3, "nModified": 2}, {"ok": 1, "n": 1, "nModified": 0}]
+        ):
+            started, finished = command_events(
+                i, "update", {"update": "users", "updates": []}, 10, reply
+            )
+            listener.started(started)
+            listener.succeeded(finished)
+        started, finished = command_events(
+            2, "delete", {"delete": "users"}, 10, {"ok": 1, "n": 5}
+        )
+        listener.started(started)
+        listener.succeeded(finished)
+
+    assert collector.to_dict()["writes"] == {"users": {"matched": 4, "modified": 2}}
+
+
+def test_collector_merge():
+    """Test that collectors pickle and merge, e.g. from a subprocess."""
+    collector = instrumentation.CommandCollector(top_n=2)
+    collector.add("find", 5.0, collection="users", filter={"a": 1})
+    other = instrumentation.CommandCollector(top_n=2)
+    other.add("find", 20.0, bytes_sent=10, collection="users")
+    other.add("update", 10.0, failed=True)
+    other.add_batch_size(100)
+    other.add_writes("users", 2, 1)
+    collector.add_writes("users", 1, 1)
+
+    collector.merge(pickle.loads(pickle.dumps(other)))
+    summary = collector.to_dict()
+    # The size of the unmeasured find is estimated from the measured one
+    assert summary["round_trips"] == 3 and summary["bytes_sent"] == 20
+    assert summary["by_command"]["update"]["failures"] == 1
+    assert [slow["duration_ms"] for slow in summary["slowest"]] == [20.0, 10.0]
+    assert summary["batch_sizes"]["batches"] == 1
+    assert summary["writes"] == {"users": {"matched": 3, "modified": 2}}
+
+
+def test_reservoir_is_bounded():
+    """Test that the latencies kept are a bounded sample of every latency."""
+    random.seed(0)
+    reservoir = instrumentation.Reservoir(size=100)
+    for i in range(10000):
+        reservoir.add(i)
+    assert len(reservoir.values) == 100 and reservoir.seen == 10000
+
+    # The values of a reservoir that saw 9 times more values are kept 9 times more
+    other = instrumentation.Reservoir(size=100)
+    for i in range(1000):
+        other.add(-1)
+    reservoir.merge(other)
+    assert len(reservoir.values) == 100 and reservoir.seen == 11000
+    assert 70 < sum(value >= 0 for value in reservoir.values) < 100
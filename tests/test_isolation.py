@@ -0,0 +1,68 @@
+import marshal
+import pickle
+import sys
+
+import pytest
+
+from mongo_migrator import isolation
+
+MIGRATION = """
+import pickle
+
+class Record:
+    pass
+
+RECORD = Record()
+
+def upgrade(db):
+    db.append(pickle.dumps(RECORD))
+"""
+
+
+def test_module_names_are_unique():
+    """Test that each load of a migration gets its own module name."""
+    first = isolation.get_module_name("/migrations/1_add-users.py")
+    second = isolation.get_module_name("/migrations/1_add-users.py")
+    assert first != second
+    assert first.startswith(isolation.MODULE_PREFIX + "1_add_users_")
+    assert first.isidentifier()
+
+
+def test_loaded_module_is_released(write_migration):
+    """Test that the module is registered while loaded and released on exit."""
+    file_path = write_migration(MIGRATION)
+    pickled = []
+    with isolation.loaded_module(file_path) as module:
+        name = module.__name__
+        assert sys.modules[name] is module
+        # Registered modules allow pickling what the migration defines
+        module.upgrade(pickled)
+        assert pickle.loads(pickled[0]).__class__ is module.Record
+        with isolation.loaded_module(file_path) as other:
+            assert other is not module and other.RECORD is not module.RECORD
+
+    assert name not in sys.modules
+    assert module.__dict__ == {}
+
+
+def test_failed_module_is_released(write_migration):
+    """Test that a module that fails to execute is not left in sys.modules."""
+    file_path = write_migration("raise RuntimeError('broken')\n")
+    names = set(sys.modules)
+    with pytest.raises(RuntimeError, match="broken"):
+        isolation.load_module(file_path)
+    assert set(sys.modules) == names
+
+
+def test_module_from_code_and_source():
+    """Test that bundled code and sources are executed in their own module."""
+    code = compile("VALUE = 1\n", "/migrations/1_code.py", "exec")
+    module = isolation.load_module("/migrations/1_code.py", marshal.dumps(code))
+    assert module.VALUE == 1 and module.__migration_code__
+    isolation.release_module(module)
+
+    module = isolation.load_module("/migrations/2_source.json", source="VALUE = 2\n")
+    name = module.__name__
+    assert module.VALUE == 2 and module.__file__ == "/migrations/2_source.json"
+    isolation.release_module(module)
+    assert name not in sys.modules
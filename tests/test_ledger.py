@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+from mongo_migrator import ledger, ops
+from mongo_migrator.migration_history import MigrationNode
+
+
+def test_record(mongo_db):
+    """Test that each run is recorded with its timings and counters."""
+    migration_ledger = ledger.Ledger(mongo_db, "mongo-migrator")
+    migration = MigrationNode("Backfill", "1")
+
+    result = ops.BulkResult("users")
+    result.processed = 10
+    result.matched = 8
+    result.modified = 6
+    started_at = ledger.now()
+    entry = migration_ledger.record(
+        migration,
+        ledger.UPGRADE,
+        started_at,
+        started_at + timedelta(seconds=2.5),
+        [result],
+    )
+
+    assert entry["outcome"] == ledger.APPLIED
+    assert entry["duration"] == 2.5
+    assert entry["collections"] == ["users"]
+    assert entry["docs_matched"] == 8
+    assert entry["docs_modified"] == 6
+    assert "mongo-migrator_ledger" in mongo_db.list_collection_names()
+    assert len(mongo_db["mongo-migrator_ledger"].index_information()) == 3
+
+    failed = migration_ledger.record(
+        migration,
+        ledger.DOWNGRADE,
+        started_at + timedelta(seconds=5),
+        started_at + timedelta(seconds=6),
+        error="RuntimeError: boom",
+    )
+    assert failed["outcome"] == ledger.FAILED
+    # Unknown without the ops helpers or the replies of the writes
+    assert failed["docs_matched"] is None
+
+    entries = migration_ledger.get_entries()
+    assert [entry["direction"] for entry in entries] == ["downgrade", "upgrade"]
+    assert len(migration_ledger.get_entries(version="2")) == 0
+    assert len(migration_ledger.get_entries(limit=1)) == 1
+
+    line = ledger.Ledger.format_entry(entries[0])
+    assert "DOWNGRADE 1 - Backfill | FAILED in 1.0s | ? matched" in line
+    assert line.endswith("| RuntimeError: boom")
+
+
+def test_record_writes_of_the_commands(mongo_db):
+    """Test that the documents written by plain pymongo calls are recorded."""
+    migration_ledger = ledger.Ledger(mongo_db, "mongo-migrator")
+    result = ops.BulkResult("users")
+    result.matched = result.modified = 1
+    commands = {
+        "writes": {
+            "users": {"matched": 5, "modified": 4},
+            "orders": {"matched": 2, "modified": 2},
+            ops.get_progress_collection_name(): {"matched": 9, "modified": 9},
+        }
+    }
+    started_at = ledger.now()
+    entry = migration_ledger.record(
+        MigrationNode("Backfill", "1"),
+        ledger.UPGRADE,
+        started_at,
+        started_at,
+        [result],
+        commands=commands,
+    )
+
+    # The replies already include the writes of the helpers, but not the progress
+    assert entry["collections"] == ["orders", "users"]
+    assert entry["docs_matched"] == 7
+    assert entry["docs_modified"] == 6
+
+
+def test_track_results():
+    """Test that the results of the helpers are tracked only when enabled."""
+    ops.track(ops.BulkResult("ignored"))
+    results = ops.track_results()
+    result = ops.BulkResult("users")
+    ops.track(result)
+    ops.stop_tracking()
+    ops.track(ops.BulkResult("ignored"))
+    assert results == [result]
@@ -0,0 +1,123 @@
+import json
+import os
+
+from unittest import mock
+
+from mongo_migrator.manifest import Manifest
+from mongo_migrator.migration_history import MigrationHistory, MigrationNode
+from mongo_migrator.migration_template import MigrationTemplate
+
+
+def test_manifest_is_written(mock_config, create_migrations):
+    """Test that loading the history writes the manifest of the directory."""
+    create_migrations(3)
+    MigrationHistory(mock_config.migrations_dir)
+
+    manifest_path = os.path.join(mock_config.migrations_dir, Manifest.FILE_NAME)
+    assert os.path.exists(manifest_path)
+    with open(manifest_path, "r") as file:
+        content = json.load(file)
+    assert content["format"] == Manifest.FORMAT_VERSION
+    assert content["entries"]["2_migration_2.py"]["version"] == "2"
+    assert content["entries"]["2_migration_2.py"]["last_version"] == "1"
+    assert content["entries"]["1_migration_1.py"]["last_version"] is None
+
+
+def test_manifest_skips_unchanged_files(mock_config, create_migrations):
+    """Test that unchanged files are not parsed again."""
+    create_migrations(3)
+    MigrationHistory(mock_config.migrations_dir)
+
+    with mock.patch(
+        "mongo_migrator.migration_history.MigrationNode.from_file"
+    ) as from_file:
+        history = MigrationHistory(mock_config.migrations_dir)
+        from_file.assert_not_called()
+
+    assert history.validate()
+    assert history.get_first_version() == "1"
+    assert history.get_last_version() == "3"
+    assert history.get_last_node().title == "Migration 3"
+
+
+def test_manifest_reparses_changed_files(mock_config, create_migrations):
+    """Test that changed, new and deleted files are detected."""
+    paths = create_migrations(3)
+    MigrationHistory(mock_config.migrations_dir)
+
+    # Change the title of a migration
+    with open(paths[1], "r") as file:
+        content = file.read()
+    with open(paths[1], "w") as file:
+        file.write(content.replace("Migration 2", "Renamed migration 2"))
+    # Remove the last migration
+    os.remove(paths[2])
+
+    with mock.patch(
+        "mongo_migrator.migration_history.MigrationNode.from_file",
+        wraps=MigrationNode.from_file,
+    ) as from_file:
+        history = MigrationHistory(mock_config.migrations_dir)
+        from_file.assert_called_once_with(paths[1])
+
+    assert history.migrations["2"].title == "Renamed migration 2"
+    assert history.get_last_version() == "2"
+    assert "3_migration_3.py" not in Manifest(mock_config.migrations_dir).entries
+
+
+def test_manifest_invalid_file_is_ignored(mock_config, create_migrations):
+    """Test that a corrupt manifest is ignored and rewritten."""
+    create_migrations(2)
+    manifest_path = os.path.join(mock_config.migrations_dir, Manifest.FILE_NAME)
+    with open(manifest_path, "w") as file:
+        file.write("not a manifest")
+
+    history = MigrationHistory(mock_config.migrations_dir)
+    assert history.get_last_version() == "2"
+    assert len(Manifest(mock_config.migrations_dir).entries) == 2
+
+
+def test_manifest_disabled(mock_config, create_migrations):
+    """Test that the manifest is not used when disabled."""
+    create_migrations(2)
+    history = MigrationHistory(mock_config.migrations_dir, use_manifest=False)
+    assert history.get_last_version() == "2"
+    assert not os.path.exists(
+        os.path.join(mock_config.migrations_dir, Manifest.FILE_NAME)
+    )
+
+
+def test_manifest_save_errors_are_ignored(mock_config, create_migrations):
+    """Test that the history loads even if the manifest cannot be written."""
+    create_migrations(2)
+    with mock.patch("mongo_migrator.manifest.os.replace", side_effect=OSError):
+        history = MigrationHistory(mock_config.migrations_dir)
+    assert history.get_last_version() == "2"
+    assert Manifest.FILE_NAME not in os.listdir(mock_config.migrations_dir)
+    assert not any(f.endswith(".tmp") for f in os.listdir(mock_config.migrations_dir))
+
+
+def test_manifest_last_version(mock_config, create_migrations):
+    """Test that the manifest stores the last version of the history."""
+    paths = create_migrations(3)
+    MigrationHistory(mock_config.migrations_dir)
+
+    manifest = Manifest(mock_config.migrations_dir)
+    assert manifest.last_version == "3"
+    file_names = [os.path.basename(path) for path in paths]
+    assert manifest.is_current(file_names)
+    assert not manifest.is_current(file_names[:2])
+
+    # A header edited in place is not trusted until the history is loaded again
+    with open(paths[2], "a") as f:
+        f.write("\n")
+    assert not manifest.is_current(file_names)
+    MigrationHistory(mock_config.migrations_dir)
+    assert Manifest(mock_config.migrations_dir).is_current(file_names)
+
+    # A bifurcation has no last version
+    MigrationTemplate.create_migration_file(
+        os.path.join(mock_config.migrations_dir, "4_fork.py"), "Fork", "4", "2"
+    )
+    MigrationHistory(mock_config.migrations_dir)
+    assert Manifest(mock_config.migrations_dir).last_version is None
@@ -0,0 +1,138 @@
+import asyncio
+
+from unittest import mock
+
+import pytest
+
+from mongo_migrator.db_utils import create_version_collection
+from mongo_migrator.migration_history import MigrationNode
+from mongo_migrator.migrator import Migrator
+
+
+class AsyncFacade:
+    """Asyncio facade of a mongomock object: its methods are awaited."""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getitem__(self, name):
+        return AsyncFacade(self._target[name])
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        async def method(*args, **kwargs):
+            return attribute(*args, **kwargs)
+
+        return method
+
+
+@pytest.fixture
+def migrator(mock_config, mongo_db, write_migration):
+    """Fixture that returns a migrator of two migrations on mongomock."""
+    # An async migration that overlaps its writes
+    write_migration(
+        "import asyncio\n\n"
+        "async def upgrade(db):\n"
+        "    await asyncio.gather(\n"
+        '        db["users"].insert_one({"name": "a"}),\n'
+        '        db["orders"].insert_one({"user": "a"}),\n'
+        "    )\n\n"
+        "async def downgrade(db):\n"
+        '    await db["users"].drop()\n'
+        '    await db["orders"].drop()\n',
+        "1",
+    )
+    # A synchronous migration, run in a thread with the synchronous database
+    write_migration(
+        "def upgrade(db, ctx):\n"
+        '    db["users"].update_many({}, {"$set": {"active": True}})\n'
+        "    ctx.progress(1, 1)\n\n"
+        "def downgrade(db):\n"
+        '    db["users"].update_many({}, {"$unset": {"active": ""}})\n',
+        "2",
+        "1",
+    )
+    create_version_collection(mongo_db, mock_config.mm_collection)
+
+    async def get_async_client(**kwargs):
+        return AsyncFacade(mongo_db.client)
+
+    with mock.patch("mongo_migrator.migrator.get_async_client", get_async_client):
+        with mock.patch("mongo_migrator.migrator.get_db", return_value=mongo_db):
+            yield Migrator(mock_config)
+
+
+def test_migrator_upgrade_and_downgrade(migrator, mongo_db):
+    """Test that async and synchronous migrations are run and recorded."""
+
+    async def upgrade():
+        async with migrator:
+            applied = await migrator.upgrade()
+            return applied, await migrator.get_current_version()
+
+    applied, current_version = asyncio.run(upgrade())
+    assert [migration.version for migration in applied] == ["1", "2"]
+    assert current_version == "2"
+    assert mongo_db["users"].find_one({}, {"_id": 0}) == {"name": "a", "active": True}
+    assert mongo_db["orders"].count_documents({}) == 1
+    ledger_collection = mongo_db["mongo-migrator_ledger"]
+    assert ledger_collection.count_documents({"outcome": "applied"}) == 2
+
+    # Nothing pending
+    assert asyncio.run(migrator.upgrade()) == []
+
+    reverted = asyncio.run(migrator.downgrade(full=True))
+    assert [migration.version for migration in reverted] == ["2", "1"]
+    assert asyncio.run(migrator.get_current_version()) is None
+    assert "users" not in mongo_db.list_collection_names()
+
+
+def test_migrator_errors(migrator, mongo_db):
+    """Test the errors of the upgrade and downgrade of the migrator."""
+    with pytest.raises(ValueError, match="No migrations have been run yet"):
+        asyncio.run(migrator.downgrade())
+    with pytest.raises(ValueError, match="Migration 3 not found"):
+        asyncio.run(migrator.upgrade("3"))
+
+    # A failure to collect the commands is raised and recorded as it is
+    with mock.patch(
+        "mongo_migrator.migrator.instrumentation.collect",
+        side_effect=RuntimeError("no collector"),
+    ):
+        with pytest.raises(RuntimeError, match="no collector"):
+            asyncio.run(migrator.upgrade("1"))
+    entry = mongo_db["mongo-migrator_ledger"].find_one({"outcome": "failed"})
+    assert entry["error"] == "RuntimeError: no collector"
+
+    applied = asyncio.run(migrator.upgrade("1"))
+    assert [migration.version for migration in applied] == ["1"]
+    with pytest.raises(ValueError, match="Migration 2 not found"):
+        asyncio.run(migrator.downgrade("2"))
+
+
+def test_async_migration_from_sync_code(mongo_db):
+    """Test that async migrations run from synchronous code get an async client."""
+
+    async def upgrade(db):
+        await db["users"].insert_one({"name": "a"})
+
+    node = MigrationNode("Async", "1", upgrade=upgrade)
+    # A database that was not connected with get_db
+    with pytest.raises(ValueError, match="connected with get_db"):
+        node.upgrade(mongo_db)
+
+    async def get_async_client(**kwargs):
+        return AsyncFacade(mongo_db.client)
+
+    params = mock.patch(
+        "mongo_migrator.migration_history.get_connection_params", return_value={}
+    )
+    client = mock.patch(
+        "mongo_migrator.migration_history.get_async_client", get_async_client
+    )
+    with params, client:
+        node.upgrade(mongo_db)
+    assert mongo_db["users"].count_documents({}) == 1
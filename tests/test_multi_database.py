@@ -0,0 +1,52 @@
+import time
+
+from unittest import mock
+
+from mongo_migrator import multi_database
+from mongo_migrator.db_utils import create_version_collection, get_current_version
+from mongo_migrator.migration_history import MigrationNode
+
+
+def test_get_target_databases(mongo_client):
+    """Test that the listed databases come first, then those matching the pattern."""
+    for name in ["tenant_b", "tenant_a", "other", "tenant_ab"]:
+        mongo_client[name]["items"].insert_one({})
+
+    names = multi_database.get_target_databases(
+        mongo_client, "tenant_b, extra,,tenant_b", r"tenant_\w"
+    )
+    assert names == ["tenant_b", "extra", "tenant_a"]
+
+
+def test_upgrade_databases(mongo_client, mock_config, capfd):
+    """Test that the databases share the client and are reported in their order."""
+    migrations = [MigrationNode("First", "1"), MigrationNode("Second", "2", "1")]
+    history = mock.Mock()
+    history.get_migrations.return_value = migrations
+
+    db_names = ["slow", "fast", "missing"]
+    for name in db_names[:2]:
+        create_version_collection(mongo_client[name], mock_config.mm_collection)
+    clients = set()
+
+    def run_migration(db, migration_ledger, migration):
+        clients.add(id(db.client))
+        if db.name == "slow":
+            time.sleep(0.05)
+
+    results = multi_database.upgrade_databases(
+        mongo_client,
+        db_names,
+        mock_config.mm_collection,
+        history,
+        run_migration,
+        workers=3,
+    )
+
+    assert [result.db_name for result in results] == db_names
+    assert clients == {id(mongo_client)}
+    assert [result.applied for result in results] == [2, 2, 0]
+    assert "Version collection not found" in results[2].error
+    assert get_current_version(mongo_client["fast"], mock_config.mm_collection) == "2"
+    output = capfd.readouterr().out
+    assert output.index("[+] fast:") < output.index("[+] slow:")
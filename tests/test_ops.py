@@ -0,0 +1,448 @@
+import os
+
+from unittest import mock
+
+import pytest
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+from mongo_migrator import id_ranges, instrumentation, ops
+from mongo_migrator.migration_history import MigrationNode
+from mongo_migrator.migration_template import MigrationTemplate
+
+
+def fake_bulk_write(collection):
+    """
+    Build a replacement of bulk_write for a mongomock collection.
+    mongomock does not support UpdateOne in bulk_write with recent pymongo versions,
+    so the requests are applied one by one.
+    """
+
+    def bulk_write(requests, ordered=True):
+        result = mock.Mock(
+            matched_count=0, modified_count=0, inserted_count=0, deleted_count=0
+        )
+        for request in requests:
+            if isinstance(request, UpdateOne):
+                update = collection.update_one(request._filter, request._doc)
+                result.matched_count += update.matched_count
+                result.modified_count += update.modified_count
+            elif isinstance(request, DeleteOne):
+                result.deleted_count += collection.delete_one(
+                    request._filter
+                ).deleted_count
+            elif isinstance(request, InsertOne):
+                collection.insert_one(request._doc)
+                result.inserted_count += 1
+        return result
+
+    return mock.Mock(side_effect=bulk_write)
+
+
+@pytest.fixture
+def users(mongo_db):
+    """Fixture that returns a collection with some users."""
+    collection = mongo_db["users"]
+    collection.insert_many(
+        [{"_id": i, "name": f"user{i}", "age": 20 + i} for i in range(1, 6)]
+    )
+    with mock.patch.object(collection, "bulk_write", fake_bulk_write(collection)):
+        yield collection
+
+
+def test_bulk_update(users):
+    """Test that every document is transformed in batches."""
+    result = ops.bulk_update(
+        users,
+        lambda doc: {"$set": {"upper_name": doc["name"].upper()}},
+        batch_size=2,
+        verbose=False,
+    )
+
+    assert result.processed == 5
+    assert result.matched == 5
+    assert result.modified == 5
+    assert result.batches == 3
+    assert [call.kwargs["ordered"] for call in users.bulk_write.call_args_list] == [
+        False
+    ] * 3
+    for doc in users.find():
+        assert doc["upper_name"] == doc["name"].upper()
+
+
+def test_bulk_update_filter_and_projection(users):
+    """Test that the filter and projection are applied to the cursor."""
+    seen = []
+
+    def transform(doc):
+        seen.append(doc)
+        return None
+
+    result = ops.bulk_update(
+        users,
+        transform,
+        filter={"age": {"$gt": 23}},
+        projection=["name"],
+        verbose=False,
+    )
+
+    assert result.processed == 2
+    assert result.batches == 0
+    assert sorted(doc["_id"] for doc in seen) == [4, 5]
+    assert all("age" not in doc for doc in seen)
+    users.bulk_write.assert_not_called()
+
+
+def test_bulk_update_write_models(users, capfd):
+    """Test that write models returned by the transform are sent as they are."""
+    result = ops.bulk_update(
+        users,
+        lambda doc: DeleteOne({"_id": doc["_id"]}) if doc["age"] > 22 else None,
+    )
+
+    assert result.processed == 5
+    assert result.deleted == 3
+    assert users.count_documents({}) == 2
+    assert "[+] users: 5 docs processed" in capfd.readouterr().out
+
+    with pytest.raises(TypeError, match="Unsupported transform output"):
+        ops.bulk_update(users, lambda doc: "invalid", verbose=False)
+
+
+def test_bulk_template(mock_config):
+    """Test that the bulk template is a valid migration using ops."""
+    os.makedirs(mock_config.migrations_dir)
+    file_path = os.path.join(mock_config.migrations_dir, "1_bulk.py")
+    MigrationTemplate.create_migration_file(file_path, "Bulk", "1", None, "bulk")
+
+    node = MigrationNode.from_file(file_path)
+    assert node.title == "Bulk"
+    assert node.last_version is None
+
+    db = mock.MagicMock()
+    with mock.patch("mongo_migrator.ops.bulk_update") as bulk_update:
+        node.upgrade(db)
+        bulk_update.assert_called_once()
+
+    with pytest.raises(ValueError, match="Unknown migration template"):
+        MigrationTemplate.create_migration_file(file_path, "Bulk", "1", None, "other")
+
+
+def test_iterate_resumable(mongo_db):
+    """Test that an interrupted iteration resumes after the last processed batch."""
+    collection = mongo_db["events"]
+    collection.insert_many([{"_id": i, "type": i % 2} for i in range(10)])
+    progress = mongo_db[ops.get_progress_collection_name()]
+
+    # Fail while processing the third batch
+    seen = []
+    with pytest.raises(RuntimeError):
+        for doc in ops.iterate_resumable(collection, "backfill", batch_size=3):
+            if doc["_id"] == 7:
+                raise RuntimeError("interrupted")
+            seen.append(doc["_id"])
+    assert seen == [0, 1, 2, 3, 4, 5, 6]
+    checkpoint = progress.find_one({"_id": "backfill"})
+    assert checkpoint["last_id"] == 5
+    assert checkpoint["processed"] == 6
+
+    # The next iteration starts with the batch that failed
+    resumed = [
+        doc["_id"]
+        for doc in ops.iterate_resumable(collection, "backfill", batch_size=3)
+    ]
+    assert resumed == [6, 7, 8, 9]
+    # The progress is removed once the iteration completes
+    assert progress.find_one({"_id": "backfill"}) is None
+
+    # Filters are combined with the checkpoint
+    filtered = ops.iterate_resumable(
+        collection, "odd", filter={"type": 1}, batch_size=2
+    )
+    assert [doc["_id"] for doc in filtered] == [1, 3, 5, 7, 9]
+
+
+def test_iterate_resumable_mixed_types(mongo_db):
+    """Test that the iteration resumes with the _ids of the later BSON types."""
+    collection = mongo_db["events"]
+    collection.insert_many([{"_id": _id} for _id in [0, 1, 2, "a", "b", "c"]])
+
+    ids = [doc["_id"] for doc in ops.iterate_resumable(collection, "ids", batch_size=3)]
+    assert ids == [0, 1, 2, "a", "b", "c"]
+    filtered = ops.iterate_resumable(
+        collection, "filtered", filter={"_id": {"$ne": "b"}}, batch_size=2
+    )
+    assert [doc["_id"] for doc in filtered] == [0, 1, 2, "a", "c"]
+
+
+def test_bulk_update_resumable(users):
+    """Test that a resumable bulk update stores its progress per written batch."""
+    progress = users.database[ops.get_progress_collection_name()]
+
+    def failing_transform(doc):
+        if doc["_id"] == 4:
+            raise RuntimeError("interrupted")
+        return {"$set": {"migrated": True}}
+
+    with pytest.raises(RuntimeError):
+        ops.bulk_update(
+            users, failing_transform, batch_size=2, resumable="users", verbose=False
+        )
+    assert progress.find_one({"_id": "users"})["last_id"] == 2
+    assert users.count_documents({"migrated": True}) == 2
+
+    transformed = []
+
+    def transform(doc):
+        transformed.append(doc["_id"])
+        return {"$set": {"migrated": True}}
+
+    result = ops.bulk_update(
+        users, transform, batch_size=2, resumable="users", verbose=False
+    )
+    assert transformed == [3, 4, 5]
+    assert result.processed == 3
+    assert users.count_documents({"migrated": True}) == 5
+    assert progress.find_one({"_id": "users"}) is None
+
+
+def test_configure_progress_collection():
+    """Test that the progress collection is named after the version collection."""
+    ops.configure("versions")
+    try:
+        assert ops.get_progress_collection_name() == "versions_progress"
+    finally:
+        ops.configure("mongo-migrator")
+
+
+def test_bulk_update_throttled(users):
+    """Test that the batches shrink while the cluster is overloaded."""
+    ops.configure("mongo-migrator", {"max_lag": 10, "check_interval": 0})
+    try:
+        limits = ops.get_throttle()
+        overloaded = iter([True, False, False, False, False])
+        with mock.patch.object(
+            limits,
+            "get_overload",
+            side_effect=lambda load: "lag" if next(overloaded) else None,
+        ):
+            with mock.patch("mongo_migrator.throttle.time.sleep"):
+                result = ops.bulk_update(
+                    users,
+                    lambda doc: {"$set": {"checked": True}},
+                    batch_size=2,
+                    verbose=False,
+                )
+    finally:
+        ops.configure("mongo-migrator")
+
+    assert ops.get_throttle() is None
+    assert result.modified == 5
+    # Halved after the overload, growing back by 10% of the batch size per check
+    assert [len(call.args[0]) for call in users.bulk_write.call_args_list] == [
+        2,
+        1,
+        1,
+        1,
+    ]
+    assert limits.throttled > 0
+
+
+def test_batch_sizer():
+    """Test the additive increase and multiplicative decrease of the batches."""
+    sizer = ops.BatchSizer(200, initial=100, min_size=30, max_size=120)
+    sizer.observe(100, 50)
+    assert sizer.size == 110
+    sizer.observe(110, 50)
+    sizer.observe(120, 50)
+    assert sizer.size == 120
+    # A short batch does not grow the size
+    sizer.observe(10, 1)
+    assert sizer.size == 120
+    sizer.observe(120, 500)
+    assert sizer.size == 60
+    sizer.observe(60, 500)
+    sizer.observe(30, 500)
+    assert sizer.size == 30
+    assert sizer.sizes == [100, 110, 120, 10, 120, 60, 30]
+
+
+def test_adaptive_bulk_write(users):
+    """Test that the batches follow the latency and are instrumented."""
+    requests = (DeleteOne({"_id": i}) for i in range(1, 6))
+    with instrumentation.collect() as collector:
+        # Every batch is slower than the target
+        result = ops.bulk_write(
+            users, requests, batch_size=2, target_latency_ms=0, verbose=False
+        )
+    assert (result.processed, result.deleted) == (5, 5)
+    assert collector.batch_sizes == [2, 1, 1, 1]
+    assert collector.get_batch_sizes() == {
+        "batches": 4,
+        "min": 1,
+        "p50": 1,
+        "max": 2,
+        "last": 1,
+    }
+    assert "Adaptive batches: 4 | min 1 | p50 1 | max 2" in collector.format_report()
+
+
+def test_bulk_update_target_latency(users):
+    """Test that bulk_update grows the batches while they are fast."""
+    with instrumentation.collect() as collector:
+        result = ops.bulk_update(
+            users,
+            lambda doc: {"$set": {"checked": True}},
+            batch_size=1,
+            verbose=False,
+            target_latency_ms=60000,
+        )
+    assert result.modified == 5
+    assert collector.batch_sizes == [1, 2, 2]
+
+
+def test_partition(mongo_db):
+    """Test that the ranges cover every document exactly once."""
+    collection = mongo_db["items"]
+    collection.insert_many([{"_id": i} for i in range(100)])
+
+    assert ops.partition(collection, 1) == [(None, None)]
+
+    ranges = ops.partition(collection, 4)
+    assert 1 < len(ranges) <= 4
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    for (_, upper), (lower, _) in zip(ranges, ranges[1:]):
+        assert upper == lower
+
+    counts = [
+        collection.count_documents(id_ranges.range_filter(None, lower, upper))
+        for lower, upper in ranges
+    ]
+    assert sum(counts) == 100
+    assert all(counts)
+
+
+def test_parallel_update_inline(users, capfd):
+    """Test a parallel update run in the current process."""
+    results = ops.parallel_update(
+        users,
+        lambda doc: {"$set": {"migrated": True}},
+        partitions=3,
+        processes=1,
+        filter={"age": {"$gt": 21}},
+        batch_size=2,
+    )
+
+    assert [result.index for result in results] == list(range(len(results)))
+    assert sum(result.processed for result in results) == 4
+    assert users.count_documents({"migrated": True}) == 4
+    assert "[+] users: 4 docs processed, 4 modified" in capfd.readouterr().out
+
+
+def test_parallel_update_errors(users):
+    """Test that failed partitions are reported once every partition finished."""
+
+    def transform(doc):
+        if doc["_id"] == 1:
+            raise RuntimeError("broken document")
+        return {"$set": {"migrated": True}}
+
+    with mock.patch(
+        "mongo_migrator.ops.partition", return_value=[(None, 3), (3, None)]
+    ):
+        with pytest.raises(ops.PartitionError, match="1/2 partitions") as err:
+            ops.parallel_update(
+                users, transform, processes=1, resumable="users", verbose=False
+            )
+
+    failed, done = err.value.results
+    assert "broken document" in failed.error
+    assert done.error is None and done.processed == 3
+    assert users.count_documents({"migrated": True}) == 3
+
+    # The ranges are stored, so the update resumes the failed partition only
+    progress = users.database[ops.get_progress_collection_name()]
+    stored = progress.find_one({"_id": "users:partitions"})
+    assert stored["done"] == [1]
+    assert stored["ranges"] == [
+        [None, 3],
+        [3, None],
+    ]
+    results = ops.parallel_update(
+        users,
+        lambda doc: {"$set": {"migrated": True}},
+        processes=1,
+        resumable="users",
+        verbose=False,
+    )
+    assert [(result.index, result.processed) for result in results] == [(0, 2)]
+    assert users.count_documents({"migrated": True}) == 5
+    assert progress.count_documents({}) == 0
+
+
+def test_update_partition_resumable_mixed_types(mongo_db):
+    """Test that a resumable partition crossing BSON types updates every document."""
+    collection = mongo_db["items"]
+    collection.insert_many(
+        [{"_id": i} for i in range(6)] + [{"_id": f"item-{i}"} for i in range(6)]
+    )
+    with mock.patch.object(collection, "bulk_write", fake_bulk_write(collection)):
+        result = ops.update_partition(
+            collection,
+            lambda doc: {"$set": {"migrated": True}},
+            0,
+            2,
+            "item-4",
+            batch_size=2,
+            resumable="items",
+        )
+
+    assert result.error is None and result.processed == 8
+    migrated = [doc["_id"] for doc in collection.find({"migrated": True})]
+    assert migrated == [2, 3, 4, 5, "item-0", "item-1", "item-2", "item-3"]
+    assert mongo_db[ops.get_progress_collection_name()].count_documents({}) == 0
+
+
+def test_parallel_update_needs_pooled_client(users):
+    """Test that worker processes need the connection details of the database."""
+    with pytest.raises(ValueError, match="get_db"):
+        ops.parallel_update(users, lambda doc: None, processes=2, verbose=False)
+
+
+def test_run_partition(mongo_db, tmp_path):
+    """Test that a worker loads the transform from the migration file."""
+    file_path = tmp_path / "1_parallel.py"
+    file_path.write_text(
+        "from pymongo import DeleteOne\n\n\n"
+        "def transform(doc):\n"
+        "    return DeleteOne({'_id': doc['_id']})\n"
+    )
+    mongo_db["items"].insert_many([{"_id": i} for i in range(10)])
+
+    with pytest.raises(ValueError, match="top level"):
+        ops.get_function_reference(lambda doc: None)
+
+    transform = ops.load_function(str(file_path), "transform")
+    task = {
+        **ops.get_function_reference(transform),
+        "connection": {"db_host": "localhost", "db_port": 27017},
+        "mm_collection": "mongo-migrator",
+        "throttle": {},
+        "db_name": mongo_db.name,
+        "collection_name": "items",
+        "filter": None,
+        "projection": None,
+        "batch_size": 3,
+        "resumable": None,
+        "index": 1,
+        "lower": 2,
+        "upper": 8,
+    }
+    assert task["function_name"] == "transform"
+    assert task["code"] is None
+
+    with mock.patch("mongo_migrator.ops.get_client", return_value=mongo_db.client):
+        result = ops._run_partition(task)
+
+    assert result.error is None
+    assert result.deleted == 6
+    assert sorted(doc["_id"] for doc in mongo_db["items"].find()) == [0, 1, 8, 9]
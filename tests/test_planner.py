@@ -0,0 +1,93 @@
+import marshal
+
+from datetime import timedelta
+
+from mongo_migrator import ledger, ops, planner
+from mongo_migrator.migration_history import MigrationNode
+
+MIGRATION_CODE = """
+def upgrade(db):
+    db["users"].update_many({}, {"$set": {"active": True}})
+    db.get_collection("orders").drop()
+"""
+
+
+def record(migration_ledger, version, duration, processed, collections):
+    """Record an applied migration in the ledger."""
+    result = ops.BulkResult(collections[0] if collections else "other")
+    result.processed = processed
+    started_at = ledger.now()
+    migration_ledger.record(
+        MigrationNode(f"Migration {version}", version),
+        ledger.UPGRADE,
+        started_at,
+        started_at + timedelta(seconds=duration),
+        [result] if collections else [],
+    )
+
+
+def test_format_duration():
+    """Test the formatting of the estimates."""
+    assert planner.format_duration(None) == "unknown"
+    assert planner.format_duration(4.4) == "~4s"
+    assert planner.format_duration(125) == "~2m 5s"
+    assert planner.format_duration(3723) == "~1h 2m 3s"
+
+
+def test_referenced_collections(mongo_db, tmp_path):
+    """Test that the collections are found in the source or the bundled code."""
+    mongo_db["users"].insert_many([{"_id": i} for i in range(3)])
+    mongo_db["orders"].insert_one({"_id": 1})
+    mongo_db["other"].insert_one({"_id": 1})
+
+    file_path = tmp_path / "1_test.py"
+    file_path.write_text(MIGRATION_CODE)
+    migration = MigrationNode("Test", "1", file_path=str(file_path))
+    assert planner.get_referenced_collections(mongo_db, migration) == {
+        "orders": 1,
+        "users": 3,
+    }
+
+    code = marshal.dumps(compile(MIGRATION_CODE, "1_test.py", "exec"))
+    bundled = MigrationNode("Test", "1", file_path="missing.py", code=code)
+    assert planner.get_string_literals(bundled) >= {"users", "orders"}
+
+
+def test_estimate(mongo_db):
+    """Test the estimates from the own runs, the throughput and the median."""
+    migration_ledger = ledger.Ledger(mongo_db, "mongo-migrator")
+    migration = MigrationNode("Test", "3")
+    assert planner.estimate(migration, {"users": 10}, []).seconds is None
+
+    record(migration_ledger, "1", 10, 0, [])
+    entries = migration_ledger.get_entries()
+    estimate = planner.estimate(migration, {"users": 10}, entries)
+    assert (estimate.method, estimate.seconds) == (planner.MEDIAN, 10)
+
+    # 1000 docs in 20 seconds
+    record(migration_ledger, "2", 20, 1000, ["users"])
+    entries = migration_ledger.get_entries()
+    estimate = planner.estimate(migration, {"users": 500}, entries)
+    assert (estimate.method, estimate.seconds) == (planner.THROUGHPUT, 10)
+
+    # The same migration ran before on 1000 docs, and now there are 3000
+    record(migration_ledger, "3", 5, 1000, ["users"])
+    entries = migration_ledger.get_entries()
+    estimate = planner.estimate(migration, {"users": 3000}, entries)
+    assert (estimate.method, estimate.seconds) == (planner.OWN_RUNS, 15)
+
+
+def test_print_plan(capfd):
+    """Test the output of the plan."""
+    estimates = [
+        planner.Estimate(MigrationNode("First", "1"), 60, planner.MEDIAN, {}),
+        planner.Estimate(MigrationNode("Second", "2"), None, None, {"users": 5}),
+    ]
+    planner.print_plan(estimates)
+    output = capfd.readouterr().out.splitlines()
+    assert output == [
+        "[+] Upgrade plan (2 migrations):",
+        "    1 - First | no known collections | ~1m 0s (median)",
+        "    2 - Second | users: 5 docs | unknown",
+        "[+] Estimated total: ~1m 0s (1 migrations without estimate)",
+    ]
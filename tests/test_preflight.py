@@ -0,0 +1,86 @@
+from unittest import mock
+
+from mongo_migrator import preflight
+from mongo_migrator.migration_history import MigrationNode
+from mongo_migrator.proxies import RecordedOperation
+
+COLLSCAN_PLAN = {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+IXSCAN_PLAN = {
+    "queryPlanner": {
+        "winningPlan": {
+            "queryPlan": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "indexName": "email_1"},
+            }
+        }
+    },
+    "executionStats": {"totalDocsExamined": 1},
+}
+
+
+def test_get_plan_stages():
+    """Test that the stages and indexes are found in classic and SBE plans."""
+    plan = IXSCAN_PLAN["queryPlanner"]["winningPlan"]
+    assert preflight.get_plan_stages(plan) == (["FETCH", "IXSCAN"], ["email_1"])
+    plan = {
+        "stage": "SUBPLAN",
+        "inputStage": {
+            "stage": "OR",
+            "inputStages": [
+                {"stage": "IXSCAN", "indexName": "a_1"},
+                {"stage": "COLLSCAN"},
+            ],
+        },
+    }
+    assert preflight.get_plan_stages(plan) == (
+        ["SUBPLAN", "OR", "IXSCAN", "COLLSCAN"],
+        ["a_1"],
+    )
+
+
+def test_get_filter_fields():
+    """Test the fields suggested for an index."""
+    filter = {"status": "active", "$or": [{"age": {"$gt": 1}}, {"status": "x"}]}
+    assert preflight.get_filter_fields(filter) == ["status", "age"]
+
+
+def test_analyze(mongo_db):
+    """Test that each distinct filter is explained once and scans are flagged."""
+    mongo_db["users"].insert_many([{"_id": i} for i in range(4)])
+    operations = [
+        RecordedOperation("users", "find", {"status": "active"}),
+        RecordedOperation("users", "update_many", {"status": "active"}),
+        RecordedOperation("users", "update_many", {}),
+        RecordedOperation("users", "find", {"email": "a@b.c"}),
+        RecordedOperation("users", "insert_one", documents=[{"_id": 5}]),
+    ]
+    outputs = [COLLSCAN_PLAN, COLLSCAN_PLAN, IXSCAN_PLAN]
+    with mock.patch.object(preflight, "explain", side_effect=outputs) as explain:
+        reports = preflight.analyze(mongo_db, operations)
+    assert explain.call_count == 3
+
+    active, everything, email = reports
+    assert active.operations == ["find", "update_many"]
+    assert active.blocking and (active.examined, active.estimated) == (4, True)
+    assert "Missing index on: status" in str(active)
+    assert everything.collscan and not everything.blocking
+    assert not email.collscan and email.indexes == ["email_1"]
+    assert (email.examined, email.estimated) == (1, False)
+
+
+def test_record(mongo_db):
+    """Test that the migrations run against the proxy and errors are reported."""
+    migration = MigrationNode(
+        "Test", "1", upgrade=lambda db: db["users"].delete_many({"old": True})
+    )
+    operations, error = preflight.record(mongo_db, migration)
+    assert error is None
+    assert [op.filter for op in operations] == [{"old": True}]
+
+    def failing(db):
+        db["users"].find_one({"_id": 1})["name"]
+
+    migration._upgrade = failing
+    operations, error = preflight.record(mongo_db, migration)
+    assert len(operations) == 1
+    assert error.startswith("TypeError")
@@ -0,0 +1,41 @@
+import os
+import pstats
+import tracemalloc
+
+from mongo_migrator import profiling
+
+
+def materialize():
+    """Allocate a list to be found in the memory report."""
+    return [str(i) * 10 for i in range(10000)]
+
+
+def test_profile_cpu_and_memory(tmp_path, capfd):
+    """Test that the stats and the memory report are written."""
+    directory = str(tmp_path / "profiles")
+    with profiling.profile("1_upgrade", directory, cpu=True, memory=True, top_n=3):
+        data = materialize()
+    assert len(data) == 10000
+    assert not tracemalloc.is_tracing()
+
+    stats = pstats.Stats(os.path.join(directory, "1_upgrade.pstats"))
+    assert any(func[2] == "materialize" for func in stats.stats)
+
+    with open(os.path.join(directory, "1_upgrade.memory.txt")) as f:
+        report = f.read().splitlines()
+    assert report[0].startswith("Peak memory: ")
+    assert "Top 3 allocations" in report[2]
+    assert len(report) == 6
+    assert "test_profiling.py" in report[3]
+
+    output = capfd.readouterr().out
+    assert "[+] CPU profile written to:" in output
+    assert "[+] Memory report written to:" in output
+
+
+def test_profile_disabled(tmp_path):
+    """Test that nothing is written without profiling."""
+    directory = str(tmp_path / "profiles")
+    with profiling.profile("1_upgrade", directory, cpu=False, memory=False):
+        materialize()
+    assert not os.path.exists(directory)
@@ -0,0 +1,123 @@
+import io
+import json
+
+from unittest import mock
+
+from mongo_migrator import ops, progress
+from mongo_migrator.migration_history import MigrationNode
+
+
+def test_context_is_passed_when_accepted():
+    """Test that only migrations accepting a second argument receive the context."""
+    calls = []
+    node = MigrationNode(
+        "Test",
+        "1",
+        upgrade=lambda db, ctx: calls.append(("upgrade", db, ctx)),
+        downgrade=lambda db: calls.append(("downgrade", db)),
+    )
+    ctx = progress.MigrationContext(node, "upgrade")
+    node.upgrade("db", ctx)
+    node.downgrade("db", ctx)
+    node.upgrade("db")
+    assert calls == [
+        ("upgrade", "db", ctx),
+        ("downgrade", "db"),
+        ("upgrade", "db", None),
+    ]
+
+
+def test_context_is_not_passed_to_optional_parameters():
+    """Test that the context only fills a ctx or a required second parameter."""
+    node = MigrationNode("Test", "1")
+    ctx = progress.MigrationContext(node, "upgrade")
+
+    def with_default(db, batch_size=1000):
+        return batch_size
+
+    def with_keyword(db, *, ctx=None):
+        return ctx
+
+    def with_args(db, *args):
+        return args
+
+    assert MigrationNode._call(with_default, "db", ctx) == 1000
+    assert MigrationNode._call(with_keyword, "db", ctx) is ctx
+    assert MigrationNode._call(lambda db, ctx=None: ctx, "db", ctx) is ctx
+    assert MigrationNode._call(with_args, "db", ctx) == ()
+
+
+def test_report_text_and_json():
+    """Test the rendering of the progress as text and as JSON lines."""
+    node = MigrationNode("Backfill", "1")
+    stream = io.StringIO()
+    reporter = progress.ProgressReporter(stream=stream)
+    with mock.patch("mongo_migrator.progress.time.perf_counter", return_value=0):
+        ctx = progress.MigrationContext(node, "upgrade", reporter)
+    with mock.patch("mongo_migrator.progress.time.perf_counter", return_value=10):
+        ctx.progress(1000, 250)
+    assert stream.getvalue() == (
+        "[*] 1 - Backfill: 25.0% (250/1000) | 25 docs/s | ETA 0m 30s\n"
+    )
+
+    stream = io.StringIO()
+    reporter = progress.ProgressReporter(json_lines=True, stream=stream)
+    ctx = progress.MigrationContext(node, "upgrade", reporter)
+    ctx.progress(None, 10)
+    line = json.loads(stream.getvalue())
+    assert line["event"] == "progress"
+    assert line["version"] == "1"
+    assert line["done"] == 10
+    assert line["percent"] is None and line["eta"] is None
+
+
+def test_progress_is_throttled():
+    """Test that reports are written at most once per interval, except the last."""
+    stream = io.StringIO()
+    reporter = progress.ProgressReporter(interval=60, stream=stream)
+    ctx = progress.MigrationContext(MigrationNode("Test", "1"), "upgrade", reporter)
+    for done in range(0, 101, 10):
+        ctx.progress(100, done)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2
+    assert "(0/100)" in lines[0]
+    assert "(100/100)" in lines[1]
+
+
+def test_bulk_update_reports_progress(mongo_db):
+    """Test that ops helpers report their progress to the running migration."""
+    collection = mongo_db["items"]
+    collection.insert_many([{"_id": i} for i in range(10)])
+    ctx = progress.MigrationContext(MigrationNode("Test", "1"), "upgrade")
+
+    with mock.patch.object(ctx, "progress") as report:
+        with ctx:
+            assert progress.get_current_context() is ctx
+            ops.bulk_update(collection, lambda doc: None, batch_size=3, verbose=False)
+        assert progress.get_current_context() is None
+
+    report.assert_called_with(10, 10)
+
+
+def test_bulk_update_does_not_count_filtered_documents(mongo_db):
+    """Test that the total of a filtered update is not counted, unless passed."""
+    collection = mongo_db["items"]
+    collection.insert_many([{"_id": i} for i in range(10)])
+    ctx = progress.MigrationContext(MigrationNode("Test", "1"), "upgrade")
+
+    with mock.patch.object(ctx, "progress") as report, ctx:
+        with mock.patch.object(collection, "count_documents") as count:
+            ops.bulk_update(
+                collection, lambda doc: None, {"_id": {"$lt": 5}}, verbose=False
+            )
+            count.assert_not_called()
+            report.assert_called_with(None, 5)
+
+            ops.bulk_update(
+                collection,
+                lambda doc: None,
+                {"_id": {"$lt": 5}},
+                verbose=False,
+                total=5,
+            )
+            report.assert_called_with(5, 5)
@@ -0,0 +1,88 @@
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+import bson
+
+from mongo_migrator.proxies import DryRunDatabase, RecordingDatabase
+
+
+def test_recording_database(mongo_db):
+    """Test that the operations are recorded and nothing is written."""
+    mongo_db["users"].insert_many([{"_id": i, "age": i} for i in range(3)])
+    proxy = RecordingDatabase(mongo_db)
+
+    assert list(proxy["users"].find({"age": {"$gt": 1}}).sort("age").limit(5)) == []
+    assert proxy.users.find_one(1) is None
+    assert proxy["users"].count_documents({}) == 0
+    assert proxy["users"].estimated_document_count() == 3
+    proxy["users"].update_many({"age": 2}, {"$set": {"adult": True}})
+    proxy.get_collection("users").delete_one({"_id": 0})
+    proxy["users"].aggregate([{"$match": {"age": 1}}, {"$count": "n"}])
+    proxy["users"].insert_one({"_id": 10})
+    proxy["orders"].bulk_write(
+        [
+            InsertOne({"_id": 1}),
+            UpdateOne({"_id": 2}, {"$set": {"a": 1}}),
+            DeleteOne({"_id": 3}),
+        ]
+    )
+    proxy["orders"].drop()
+    proxy.command("collMod", "users")
+
+    recorded = [(op.collection, op.operation, op.filter) for op in proxy.operations]
+    assert recorded == [
+        ("users", "find", {"age": {"$gt": 1}}),
+        ("users", "find_one", {"_id": 1}),
+        ("users", "count_documents", {}),
+        ("users", "update_many", {"age": 2}),
+        ("users", "delete_one", {"_id": 0}),
+        ("users", "aggregate", {"age": 1}),
+        ("users", "insert_one", None),
+        ("orders", "insert_one", None),
+        ("orders", "update_one", {"_id": 2}),
+        ("orders", "delete_one", {"_id": 3}),
+        ("orders", "drop", None),
+        (None, "command", None),
+    ]
+    assert proxy.operations[-1].update == {"collMod": "users"}
+
+    # The real database is unchanged
+    assert sorted(doc["_id"] for doc in mongo_db["users"].find()) == [0, 1, 2]
+    assert all("adult" not in doc for doc in mongo_db["users"].find())
+    assert "orders" not in mongo_db.list_collection_names()
+    assert proxy.client is None
+
+
+def test_dry_run_database(mongo_db):
+    """Test that the reads go through and the writes are measured, not sent."""
+    docs = [{"_id": i, "age": i} for i in range(4)]
+    mongo_db["users"].insert_many(docs)
+    size = len(bson.encode(docs[0]))
+    proxy = DryRunDatabase(mongo_db)
+
+    assert proxy["users"].count_documents({"age": {"$gte": 2}}) == 2
+    cursor = proxy["users"].find({}, sort=[("_id", 1)])
+    assert [doc["_id"] for doc in cursor] == [0, 1, 2, 3]
+    proxy["users"].update_many({"age": {"$gte": 2}}, {"$set": {"adult": True}})
+    proxy["users"].update_one({}, {"$set": {"first": True}})
+    proxy["users"].bulk_write(
+        [DeleteOne({"_id": 0}), DeleteOne({"_id": 1}), DeleteOne({"_id": 9})]
+    )
+    proxy["users"].insert_one({"_id": 10, "age": 10})
+    proxy.drop_collection("users")
+    proxy.command("ping")
+
+    estimates = proxy.estimates
+    update_many = estimates[("users", "update_many")]
+    assert (update_many.calls, update_many.documents) == (1, 2)
+    # mongomock has no $bsonSize, so the sizes are estimated from a sample
+    assert update_many.bytes == 2 * size and update_many.estimated
+    assert estimates[("users", "update_one")].documents == 1
+    delete_one = estimates[("users", "delete_one")]
+    assert (delete_one.calls, delete_one.documents) == (3, 2)
+    assert estimates[("users", "insert_one")].documents == 1
+    assert estimates[("users", "drop")].documents == 4
+    assert estimates[(None, "command")].calls == 1
+    assert proxy.documents == 10
+
+    # The real database is unchanged
+    assert list(mongo_db["users"].find({}, sort=[("_id", 1)])) == docs
@@ -0,0 +1,132 @@
+import threading
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from mongo_migrator import throttle
+from mongo_migrator.throttle import ServerLoad, Throttle
+
+
+def replica_set_status(lag: float) -> dict:
+    """Build the output of replSetGetStatus with a lagging secondary."""
+    now = datetime(2025, 1, 1)
+    return {
+        "members": [
+            {"stateStr": "PRIMARY", "state": 1, "optimeDate": now},
+            {"stateStr": "SECONDARY", "state": 2, "optimeDate": now},
+            {
+                "stateStr": "SECONDARY",
+                "state": 2,
+                "optimeDate": now - timedelta(seconds=lag),
+            },
+            {"stateStr": "ARBITER", "state": 7},
+        ]
+    }
+
+
+def test_metrics():
+    """Test that the lag and the tickets are read from the status outputs."""
+    assert throttle.get_replication_lag(replica_set_status(12)) == 12
+    assert throttle.get_replication_lag({"members": []}) is None
+
+    legacy = {"wiredTiger": {"concurrentTransactions": {"write": {"available": 3}}}}
+    assert throttle.get_available_tickets(legacy) == 3
+    recent = {"queues": {"execution": {"write": {"available": 5}}}}
+    assert throttle.get_available_tickets(recent) == 5
+    assert throttle.get_available_tickets({}) is None
+
+
+def test_get_overload():
+    """Test the thresholds, ignoring the metrics that are not reported."""
+    limits = Throttle(max_lag=10, max_queued=50, min_available_tickets=8)
+    assert limits.get_overload(ServerLoad()) is None
+    assert limits.get_overload(ServerLoad(5, 10, 100)) is None
+    assert "replication lag 12.0s" in limits.get_overload(ServerLoad(lag=12))
+    assert "60 queued" in limits.get_overload(ServerLoad(queued=60))
+    assert "2 write tickets" in limits.get_overload(ServerLoad(available_tickets=2))
+    assert Throttle(max_lag=None).get_overload(ServerLoad(lag=100)) is None
+
+
+def test_from_options():
+    """Test that unknown options are refused."""
+    assert Throttle.from_options({"max_lag": 5}).max_lag == 5
+    with pytest.raises(ValueError):
+        Throttle.from_options({"max_lagg": 5})
+
+
+def test_wait(capfd):
+    """Test the backoff while overloaded and the ramp up once recovered."""
+    client = mock.Mock()
+    statuses = [replica_set_status(lag) for lag in (20, 20, 20, 1, 1)]
+    client.admin.command.side_effect = lambda name: (
+        statuses.pop(0) if name == "replSetGetStatus" else {}
+    )
+    limits = Throttle(max_lag=10, check_interval=0, min_sleep=1, max_sleep=3)
+
+    with mock.patch("mongo_migrator.throttle.time.sleep") as sleep:
+        limits.wait(client)
+    assert [call.args[0] for call in sleep.call_args_list] == [1, 2, 3]
+    assert limits.throttled == 6
+    assert limits.factor == pytest.approx(0.225)
+    assert limits.batch_size(1000) == 225
+    assert "[!] Throttling: replication lag 20.0s > 10s" in capfd.readouterr().out
+
+    limits.wait(client)
+    assert limits.factor == pytest.approx(0.325)
+
+
+def test_wait_releases_the_lock():
+    """Test that other threads wait for the backoff without the lock being held."""
+    client = mock.Mock()
+    statuses = [replica_set_status(lag) for lag in (20, 1)]
+    client.admin.command.side_effect = lambda name: statuses.pop(0)
+    limits = Throttle(
+        max_queued=None, min_available_tickets=None, check_interval=0, min_sleep=1
+    )
+    waiter = threading.Thread(target=limits.wait, args=(client,))
+
+    def sleep(delay):
+        # Another thread waits for the recovery instead of checking the cluster
+        assert limits._condition.acquire(blocking=False)
+        limits._condition.release()
+        waiter.start()
+        waiter.join(timeout=0.05)
+        assert waiter.is_alive()
+
+    with mock.patch("mongo_migrator.throttle.time.sleep", side_effect=sleep):
+        limits.wait(client, verbose=False)
+    waiter.join(timeout=1)
+    assert not waiter.is_alive()
+    assert client.admin.command.call_count == 2
+
+
+def test_wait_unsupported():
+    """Test that the commands refused by the server are not sent again."""
+    client = mock.Mock()
+    client.admin.command.side_effect = OperationFailure(
+        "not running with --replSet", code=76
+    )
+    limits = Throttle(check_interval=0)
+    limits.wait(client)
+    limits.wait(client)
+    assert client.admin.command.call_count == 2
+    assert limits.factor == 1.0
+
+
+def test_wait_retries_failed_commands():
+    """Test that the commands that failed for another reason are sent again."""
+    client = mock.Mock()
+    client.admin.command.side_effect = [
+        AutoReconnect("connection reset"),
+        OperationFailure("interrupted", code=11601),
+        replica_set_status(20),
+    ]
+    limits = Throttle(max_queued=None, min_available_tickets=None, check_interval=0)
+    limits.wait(client)
+    limits.wait(client)
+    assert limits.factor == 1.0
+    assert limits.get_load(client).lag == 20
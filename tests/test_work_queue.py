@@ -0,0 +1,188 @@
+import threading
+import time
+
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+
+from mongo_migrator import ops, work_queue
+from mongo_migrator.cli import worker as worker_command
+from mongo_migrator.migration_template import MigrationTemplate
+
+# mongomock does not support UpdateOne in bulk_write, so deletions are used instead
+MIGRATION_CODE = """
+
+from pymongo import DeleteOne
+
+
+def transform(doc):
+    if doc.get("broken"):
+        raise RuntimeError("broken document")
+    return DeleteOne({"_id": doc["_id"]})
+"""
+
+
+@pytest.fixture
+def transform(tmp_path):
+    """Fixture that returns a transform defined in a migration file."""
+    file_path = tmp_path / "1_distributed.py"
+    MigrationTemplate.create_migration_file(str(file_path), "Distributed", "1", None)
+    with open(file_path, "a") as f:
+        f.write(MIGRATION_CODE)
+    return ops.load_function(str(file_path), "transform")
+
+
+@pytest.fixture
+def items(mongo_db):
+    """Fixture that returns a collection with some documents."""
+    collection = mongo_db["items"]
+    collection.insert_many([{"_id": i} for i in range(40)])
+    return collection
+
+
+def test_claim_and_reclaim_expired_lease(mongo_db, items):
+    """Test that items are leased to one worker until the lease expires."""
+    queue = work_queue.WorkQueue(mongo_db)
+    queue.create_job("job", items, "1_distributed.py", "transform", [(None, 20)])
+
+    item = queue.claim("worker-1", lease_seconds=60)
+    assert item["owner"] == "worker-1"
+    assert item["attempts"] == 1
+    assert queue.claim("worker-2") is None
+    assert queue.heartbeat(item["_id"], "worker-1")
+
+    # The lease of the first worker expires
+    queue.collection.update_one(
+        {"_id": item["_id"]},
+        {"$set": {"lease_until": queue._now() - timedelta(seconds=1)}},
+    )
+    reclaimed = queue.claim("worker-2")
+    assert reclaimed["_id"] == item["_id"]
+    assert reclaimed["attempts"] == 2
+    assert not queue.heartbeat(item["_id"], "worker-1")
+
+    # Only the owner can finish the item
+    result = ops.PartitionResult("items", 0, None, 20)
+    assert not queue.finish(item["_id"], "worker-1", result)
+    assert queue.finish(item["_id"], "worker-2", result)
+    assert queue.is_finished("job")
+
+
+def test_workers_share_a_job(mongo_db, items, transform):
+    """Test that several workers run the items of a job once each."""
+    queue = work_queue.WorkQueue(mongo_db)
+    ranges = [(None, 10), (10, 20), (20, 30), (30, None)]
+    queue.create_job(
+        "job",
+        items,
+        "1_distributed.py",
+        "transform",
+        ranges,
+        filter={"_id": {"$ne": 0}},
+    )
+
+    counts = []
+    threads = [
+        threading.Thread(
+            target=lambda worker_id: counts.append(
+                work_queue.work(
+                    queue, lambda item: transform, worker_id, once=True, verbose=False
+                )
+            ),
+            args=(f"worker-{i}",),
+        )
+        for i in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(counts) == 4
+    assert queue.is_finished("job")
+    assert [item["state"] for item in queue.get_items("job")] == ["done"] * 4
+    assert [item["_id"] for item in items.find()] == [0]
+
+
+def test_item_with_mixed_types(mongo_db, items, transform):
+    """Test that an item whose range covers several BSON types runs every document."""
+    items.insert_many([{"_id": f"item-{i}"} for i in range(10)])
+    queue = work_queue.WorkQueue(mongo_db)
+    queue.create_job(
+        "job", items, "1_distributed.py", "transform", [(30, None)], batch_size=4
+    )
+
+    assert work_queue.work(queue, lambda item: transform, "w", once=True) == 1
+    assert [item["state"] for item in queue.get_items("job")] == ["done"]
+    assert items.count_documents({}) == 30
+
+
+def test_lost_lease_stops_the_update(mongo_db, items, transform):
+    """Test that a worker stops writing once another worker takes its item over."""
+    queue = work_queue.WorkQueue(mongo_db)
+    queue.create_job(
+        "job", items, "1_distributed.py", "transform", [(None, None)], batch_size=5
+    )
+    item = queue.claim("worker-1", lease_seconds=0.03)
+
+    def slow_transform(doc):
+        time.sleep(0.01)
+        return transform(doc)
+
+    with mock.patch.object(queue, "heartbeat", return_value=False):
+        result = work_queue.run_item(queue, item, slow_transform, "worker-1", 0.03)
+
+    assert result.error.startswith("UpdateCancelled")
+    assert items.count_documents({}) > 30
+
+
+def test_distributed_update(mongo_db, items, transform, capfd):
+    """Test that the coordinator waits for every item and retries failed ones."""
+    items.update_one({"_id": 25}, {"$set": {"broken": True}})
+
+    with pytest.raises(ops.PartitionError, match="1/4 partitions") as err:
+        work_queue.distributed_update(items, transform, partitions=4, batch_size=5)
+    failed = [result for result in err.value.results if result.error]
+    assert failed[0].lower <= 25
+    assert "broken document" in failed[0].error
+
+    # The job is kept, so only the failed item runs again
+    items.update_one({"_id": 25}, {"$unset": {"broken": True}})
+    capfd.readouterr()
+    results = work_queue.distributed_update(items, transform, partitions=4)
+    assert "1 failed partitions retried" in capfd.readouterr().out
+    assert all(result.error is None for result in results)
+    assert items.count_documents({}) == 0
+    assert work_queue.WorkQueue(mongo_db).collection.count_documents({}) == 0
+
+
+def test_distributed_update_timeout(mongo_db, items, transform):
+    """Test that the coordinator stops waiting after the timeout."""
+    with mock.patch("mongo_migrator.work_queue.time.sleep"):
+        with pytest.raises(TimeoutError):
+            work_queue.distributed_update(
+                items, transform, work_items=False, timeout=0, verbose=False
+            )
+
+
+def test_worker_command(mock_config, mongo_db, items, transform, capfd):
+    """Test that the worker command loads the transforms from the migrations."""
+    mock_config.migrations_dir = transform.__globals__["__file__"].rsplit("/", 1)[0]
+    queue = work_queue.WorkQueue(mongo_db)
+    ranges = [(None, 20), (20, None)]
+    queue.create_job("job", items, "1_distributed.py", "transform", ranges)
+    queue.create_job("other", items, "2_missing.py", "transform", [(None, None)])
+
+    args = mock.Mock()
+    args.once = True
+    args.lease = None
+    args.poll_interval = None
+    with mock.patch("mongo_migrator.cli.Config", return_value=mock_config):
+        with mock.patch("mongo_migrator.cli.get_db", return_value=mongo_db):
+            worker_command(args)
+
+    assert "[+] 3 partitions run." in capfd.readouterr().out
+    assert items.count_documents({}) == 0
+    assert [item["state"] for item in queue.get_items("job")] == ["done"] * 2
+    assert "2_missing.py not found" in queue.get_items("other")[0]["error"]